@@ -9,12 +9,14 @@ import csv
 import os
 from typing import Tuple
 
-import nibabel as nib
 import numpy as np
-import pandas as pd
 import torch
 import cv2
 
+from TissueLabeling.data.label_mapping import N_LABELS, apply_lut, get_label_mapper
+from TissueLabeling.data.nifti_io import load_nifti
+from TissueLabeling.data.slice_stats import MATTHIAS_MIN_SIZE, MATTHIAS_MIN_SUM, get_slice_bboxes
+
 def load_brains(image_file: str, mask_file: str, file_path: str):
     """
     Loads the feature and label volumes corresponding to the specified file path and names.
@@ -29,8 +31,8 @@ def load_brains(image_file: str, mask_file: str, file_path: str):
         file_path (str): directory where both volumes are located
     
     Returns:
-        brain (torch.Tensor): the loaded skull-stripped feature volume
-        brain_mask (torch.Tensor): the loaded label volume containing the freesurfer labels
+        brain (np.array): the loaded skull-stripped feature volume, in its stored dtype
+        brain_mask (np.array): the loaded int32 label volume containing the freesurfer labels
         image_nr (int): the number used to identify the feature and label pair in the filename
     """
     # ensure that mask and image numbers match
@@ -41,14 +43,11 @@ def load_brains(image_file: str, mask_file: str, file_path: str):
     image_path = os.path.join(file_path, image_file)
     mask_path = os.path.join(file_path, mask_file)
 
-    brain = nib.load(image_path)
-    brain_mask = nib.load(mask_path)
-
-    brain = brain.get_fdata()
-    brain_mask = brain_mask.get_fdata()
-    brain_mask = brain_mask.astype(int)
-    # apply skull stripping
-    brain[brain_mask == 0] = 0
+    # stored dtypes (uint8 MRI) instead of float64, decompressed copies cached in NIFTI_CACHE_DIR if set
+    brain = load_nifti(image_path)
+    brain_mask = np.asarray(load_nifti(mask_path), dtype=np.int32)
+    # apply skull stripping (into a new array, the loaded volume may be a read-only memory map)
+    brain = np.where(brain_mask == 0, 0, brain).astype(brain.dtype, copy=False)
 
     return brain, brain_mask, image_nr
 
@@ -71,59 +70,120 @@ def crop(image: np.array, height: int, width: int) -> np.array:
         AssertionError if the image cannot be cropped to size (height, width) without
         resulting in loss of non-background pixels or the crop results in an all-background image.
     """
+    assert (image > 0).any(), "Crop is empty"
+
     # find image-optimal crop
-    for j in range(256):
-        if (image[j] != 0).any():
-            cut_top_temp = j
-            break
-    for j in range(256):
-        if (image[255 - j] != 0).any():
-            cut_bottom_temp = 255 - j
-            break
-    for j in range(256):
-        if (image[:, j] != 0).any():
-            cut_left_temp = j
-            break
-    for j in range(256):
-        if (image[:, 255 - j] != 0).any():
-            cut_right_temp = 255 - j
-            break
-
-    # image-optimal size:
-    height_temp = cut_bottom_temp - cut_top_temp + 1
-    width_temp = cut_right_temp - cut_left_temp + 1
-    assert height_temp <= height, "Crop height is too big"
-    assert width_temp <= width, "Crop width is too big"
-
-    # crop image-optimal patch:
-    image = image[
-        cut_top_temp : cut_bottom_temp + 1, cut_left_temp : cut_right_temp + 1
-    ]
+    rows = np.flatnonzero((image != 0).any(axis=1))
+    cols = np.flatnonzero((image != 0).any(axis=0))
+    bbox = np.array([[rows[0], rows[-1], cols[0], cols[-1]]])
 
-    if image.shape[0] < 50 or image.shape[1] < 50:
-        pass
+    # crop image-optimal patch and adjust the crop to largest rectangle
+    return crop_pad_slices(image[np.newaxis], bbox, height, width)[0]
 
-    assert (image > 0).any(), "Crop is empty"
 
-    # adjust the crop to largest rectangle
-    if height_temp < height:
-        diff = height - height_temp
-        # even difference
-        if (diff % 2) == 0:
-            image = np.pad(image, ((diff // 2, diff // 2), (0, 0)))
-        # odd difference
-        else:
-            image = np.pad(image, ((diff // 2, diff // 2 + 1), (0, 0)))
-    if width_temp < width:
-        diff = width - width_temp
-        # even difference
-        if (diff % 2) == 0:
-            image = np.pad(image, ((0, 0), (diff // 2, diff // 2)))
-        # odd difference
-        else:
-            image = np.pad(image, ((0, 0), (diff // 2, diff // 2 + 1)))
+def crop_pad_slices(slices: np.array, bboxes: np.array, height: int, width: int) -> np.array:
+    """
+    Crops a batch of slices to their bounding boxes and centre pads the crops to (height, width) with 0s.
+    Any odd remainder of the padding is added at the bottom and right, as in crop.
 
-    return image
+    Args:
+        slices (np.array): array of shape [N, H, W]
+        bboxes (np.array): array of shape [N, 4] with rows (row_min, row_max, col_min, col_max), e.g. from
+                           TissueLabeling.data.slice_stats.get_slice_bboxes
+        height (int): the height to which the slices should be cropped
+        width (int): the width to which the slices should be cropped
+
+    Returns:
+        np.array: array of shape [N, height, width] with the dtype of slices
+
+    Throws:
+        AssertionError if a bounding box is larger than (height, width).
+    """
+    bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+    heights = bboxes[:, 1] - bboxes[:, 0] + 1
+    widths = bboxes[:, 3] - bboxes[:, 2] + 1
+    assert (heights <= height).all(), "Crop height is too big"
+    assert (widths <= width).all(), "Crop width is too big"
+
+    # row and column of each slice that every output pixel is taken from
+    rows = (bboxes[:, 0] - (height - heights) // 2)[:, np.newaxis] + np.arange(height)
+    cols = (bboxes[:, 2] - (width - widths) // 2)[:, np.newaxis] + np.arange(width)
+    inside = (
+        ((rows >= bboxes[:, 0:1]) & (rows <= bboxes[:, 1:2]))[:, :, np.newaxis]
+        & ((cols >= bboxes[:, 2:3]) & (cols <= bboxes[:, 3:4]))[:, np.newaxis, :]
+    )
+    gathered = slices[
+        np.arange(len(slices))[:, np.newaxis, np.newaxis],
+        np.clip(rows, 0, slices.shape[1] - 1)[:, :, np.newaxis],
+        np.clip(cols, 0, slices.shape[2] - 1)[:, np.newaxis, :],
+    ]
+    return np.where(inside, gathered, 0).astype(slices.dtype, copy=False)
+
+
+def extract_volume_slices(
+    brain: np.array,
+    brain_mask: np.array,
+    height: int = 162,
+    width: int = 194,
+    min_sum: int = MATTHIAS_MIN_SUM,
+    min_size: int = MATTHIAS_MIN_SIZE,
+    crop_pad: bool = True,
+) -> dict:
+    """
+    Extracts the slices of a skull-stripped volume along all three axes that have enough brain
+    (sum of the intensities >= min_sum and a brain of at least min_size x min_size pixels), and
+    crops and centre pads them to (height, width) like crop.
+
+    Args:
+        brain (np.array): the skull-stripped feature volume of shape [H, W, D]
+        brain_mask (np.array): the corresponding label volume
+        height (int): the height to which the slices should be cropped
+        width (int): the width to which the slices should be cropped
+        min_sum (int): the minimum sum of the intensities of a slice
+        min_size (int): the minimum height and width of the brain in a slice
+        crop_pad (bool): whether to return the cropped images and masks or only the slice positions
+
+    Returns:
+        dict: with the stacked arrays of the N kept slices, in (axis, slice index) order
+            images (np.array): [N, height, width] feature slices, if crop_pad
+            masks (np.array): [N, height, width] label slices, if crop_pad
+            axes (np.array): [N] the axis along which each slice is taken
+            slice_indices (np.array): [N] the index of each slice along its axis
+            bboxes (np.array): [N, 4] (row_min, row_max, col_min, col_max) of the brain in each slice
+            sums (np.array): [N] the sum of the intensities of each slice
+            n_too_small (int): the number of slices with enough intensity but a brain smaller than min_size
+
+    Throws:
+        AssertionError if the brain of a kept slice is larger than (height, width).
+    """
+    bboxes = get_slice_bboxes(brain != 0)
+    heights = bboxes[..., 1] - bboxes[..., 0] + 1
+    widths = bboxes[..., 3] - bboxes[..., 2] + 1
+
+    extracted = {"images": [], "masks": [], "axes": [], "slice_indices": [], "bboxes": [], "sums": []}
+    n_too_small = 0
+    for axis in range(3):
+        n_slices = brain.shape[axis]
+        sums = brain.sum(axis=tuple(i for i in range(3) if i != axis))
+        enough_brain = sums >= min_sum
+        large_enough = (heights[axis, :n_slices] >= min_size) & (widths[axis, :n_slices] >= min_size)
+        n_too_small += int(np.sum(enough_brain & ~large_enough))
+
+        slice_indices = np.flatnonzero(enough_brain & large_enough)
+        extracted["axes"].append(np.full(len(slice_indices), axis))
+        extracted["slice_indices"].append(slice_indices)
+        extracted["bboxes"].append(bboxes[axis, slice_indices])
+        extracted["sums"].append(sums[slice_indices])
+        if crop_pad:
+            for kind, volume in [("images", brain), ("masks", brain_mask)]:
+                slices = np.moveaxis(np.take(volume, slice_indices, axis=axis), axis, 0)
+                extracted[kind].append(crop_pad_slices(slices, bboxes[axis, slice_indices], height, width))
+
+    extracted = {key: np.concatenate(arrays) for key, arrays in extracted.items() if arrays}
+    assert (extracted["bboxes"][:, 1] - extracted["bboxes"][:, 0] + 1 <= height).all(), "Crop height is too big"
+    assert (extracted["bboxes"][:, 3] - extracted["bboxes"][:, 2] + 1 <= width).all(), "Crop width is too big"
+    extracted["n_too_small"] = n_too_small
+    return extracted
 
 
 def brain_coord(slice: torch.tensor) -> Tuple[int, int, int, int]:
@@ -137,32 +197,16 @@ def brain_coord(slice: torch.tensor) -> Tuple[int, int, int, int]:
     Returns:
         Tuple(int, int, int, int): Coordinates of the rectangle
     """
-
-    H, W = slice.shape[-2:]
-    H, W = H - 1, W - 1
     # majority vote of the 4 corners
     bg_value = torch.stack(
         (slice[0, 0], slice[-1, -1], slice[0, -1], slice[-1, 0])
     ).mode()[0]
 
-    for j in range(H):
-        if (slice[j] != bg_value).any():
-            cut_top_temp = j
-            break
-    for j in range(H):
-        if (slice[H - j] != bg_value).any():
-            cut_bottom_temp = H - j
-            break
-    for j in range(W):
-        if (slice[:, j] != bg_value).any():
-            cut_left_temp = j
-            break
-    for j in range(W):
-        if (slice[:, W - j] != bg_value).any():
-            cut_right_temp = W - j
-            break
-
-    return (cut_top_temp, cut_bottom_temp, cut_left_temp, cut_right_temp)
+    foreground = slice != bg_value
+    rows = torch.nonzero(foreground.any(dim=1)).flatten()
+    cols = torch.nonzero(foreground.any(dim=0)).flatten()
+
+    return (int(rows[0]), int(rows[-1]), int(cols[0]), int(cols[-1]))
 
 
 def brain_area(slice: torch.tensor) -> torch.tensor:
@@ -187,75 +231,59 @@ def mapping(mask: np.array, nr_of_classes=50, reference_col="original", class_ma
     based on a mapping table if a mapping is not passed in.
 
     Args:
-        mask (np.array): a 2D array where each cell contains an integer label that is to be
-                         mapped to a new label according to the mapping table
+        mask (np.array | torch.tensor): an array where each cell contains an integer label that is to be
+                                        mapped to a new label according to the mapping table
         nr_of_classes (int): the number of classes to segment, which determines the mapping table
         reference_col (str): (optional) the name of the column that corresponds to the labels 
                              in the input mask
-        class_mapping (dict | None): (optional) a dictionary containing the mapping table from
-                                     reference_col to the nr_of_classes
+        class_mapping (np.array | None): (optional) the lookup table from reference_col to the nr_of_classes,
+                                         as returned by a previous call
     
     Returns:
-        mask (np.array): The same mask with all pixel values now mapped to new pixel values specified
-                         in the mapping table.
-        class_mapping (dict): A dictionary containing the mapping, where keys are the old pixel values
-                              and the values are the new values to map to.
+        mask (np.array | torch.tensor): The same mask with all pixel values now mapped to new pixel values specified
+                                        in the mapping table, with the dtype of the input mask.
+        class_mapping (np.array): The uint8 lookup table indexed by the old pixel values (see
+                                  TissueLabeling.data.label_mapping.LabelMapper.class_lut).
     """
     if class_mapping is None:
-        new_col = "index" if nr_of_classes==106 else f"{nr_of_classes}-class"
-        class_mapping = {}
-        df = pd.read_csv("/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv")
-        for value in df[reference_col].unique():
-            filtered_rows = df[df[reference_col] == value]
-            numbers = list(set(filtered_rows[new_col].tolist()))
-            assert len(numbers) <= 1, "unique mapping does not exist"
-            class_mapping[value] = numbers[0]
-
-    # class_mapping = {value.item(): index for index, value in enumerate(labels)}
-    u, inv = np.unique(mask, return_inverse=True)
-    # num_classes = 50  # len(class_mapping)
-    # for x in u:
-    #     if x not in class_mapping:
-    #         # class_mapping[x] = nr_of_classes - 1
-    #         class_mapping[x] = 0
-
-    # we collect all classes not in the mapping table as an additional "other" class
-    # mask = np.array([class_mapping[int(x)] if x in labels else len(labels) for x in u])[inv].reshape(mask.shape)
-    for old, new in class_mapping.items():
-        mask[mask == old] = -1 * new
-    mask[mask > 0] = 0 # all unknown classes are mapped to 0
-    mask = mask * -1
-
-    return mask, class_mapping
+        class_mapping = get_label_mapper(reference_col).class_lut(nr_of_classes)
+
+    if isinstance(mask, torch.Tensor):
+        mapped = apply_lut(torch.from_numpy(class_mapping).to(mask.device), mask)
+        return mapped.to(mask.dtype), class_mapping
+    mapped = apply_lut(class_mapping, mask)
+    return mapped.astype(np.asarray(mask).dtype, copy=False), class_mapping
 
 def null_cerebellum_brain_stem(image: np.array, mask: np.array, null_classes = None):
     """
     This function is used to set any pixels belonging to the cerebellum or brain stem to 0 in the image
     and its corresponding mask if this operation does not result in an image containing all 0s.
 
-    Requires that the mask contains the original freesurfer labels.
+    Requires that the mask contains the original freesurfer labels, unless null_classes is passed in.
 
     Args:
         image (np.array): the feature slice in which to null the cerebellum and brain stem
         mask (np.array): the label slice in which to null the cerebellum and brain stem
-        null_classes (list | None): a list containing which labels correspond to the cerebellum and brain stem
+        null_classes (np.array | list | None): a boolean lookup table (or a list) of which labels correspond
+                                               to the cerebellum and brain stem
     
     Returns:
         null_image (np.array): the feature slice after the cerebellum and brain stem have been nulled
         null_mask (np.array): the label slice after the cerebellum and brain stem have been nulled
-        null_classes (list | None): a list containing which labels correspond to the cerebellum and brain stem
+        null_classes (np.array): the boolean lookup table of which labels correspond to the cerebellum and brain stem
 
     """
+    if null_classes is None or len(null_classes) == 0:
+        null_classes = get_label_mapper('original').cerebellum_brain_stem_lut
+    null_classes = _membership_lut(null_classes)
+
+    null_elts = apply_lut(null_classes, mask)
+    if not null_elts.any():
+        return image, mask, null_classes
     null_image = image.copy()
     null_mask = mask.copy()
-    if not null_classes:
-        df = pd.read_csv("/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv")
-        null_classes = list({df['original'][i] for i in df['index'] if 'cerebellum' in df['label'][i].lower() or 'brain-stem' in df['label'][i].lower()})
-    
-    null_elts = np.isin(mask,null_classes)
-    if np.sum(null_elts) > 0:
-        null_image[null_elts] = 0.0
-        null_mask[null_elts] = 0
+    null_image[null_elts] = 0.0
+    null_mask[null_elts] = 0
 
     # prevent all-background samples
     if (null_mask == 0).all():
@@ -269,34 +297,39 @@ def null_half(image: np.array, mask: np.array, keep_left=True, right_classes = N
     This function is used to set pixels belonging to one hemisphere of the brain to 0 in the image
     and its corresponding mask if this operation does not result in an image containing all 0s.
 
-    Requires that the mask contains the original freesurfer labels.
+    Requires that the mask contains the original freesurfer labels, unless right_classes and left_classes
+    are passed in.
 
     Args:
         image (np.array): the feature slice in which to null half of the brain
         mask (np.array): the label slice in which to null half of the brain
         keep_left (bool): a flag to indicate whether to null the left hemisphere
-        right_classes (list | None): a list containing which labels correspond to right hemisphere labels
-        left_classes (list | None): a list containing which labels correspond to left hemisphere labels
+        right_classes (np.array | list | None): a boolean lookup table (or a list) of which labels correspond
+                                                to right hemisphere labels
+        left_classes (np.array | list | None): a boolean lookup table (or a list) of which labels correspond
+                                               to left hemisphere labels
     
     Returns:
         null_image (np.array): the feature slice after half of the brain has been nulled
         null_mask (np.array): the label slice after half of the brain has been nulled
-        right_classes (list | None): a list containing which labels correspond to right hemisphere labels
-        left_classes (list | None): a list containing which labels correspond to left hemisphere labels
+        right_classes (np.array): the boolean lookup table of which labels correspond to right hemisphere labels
+        left_classes (np.array): the boolean lookup table of which labels correspond to left hemisphere labels
 
     """
+    if right_classes is None or left_classes is None or len(right_classes) == 0 or len(left_classes) == 0:
+        label_mapper = get_label_mapper('original')
+        right_classes = label_mapper.right_lut
+        left_classes = label_mapper.left_lut
+    right_classes = _membership_lut(right_classes)
+    left_classes = _membership_lut(left_classes)
+
     null_image = image.copy()
     null_mask = mask.copy()
-    if not right_classes or not left_classes:
-        df = pd.read_csv("/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv")
-        right_classes = list({df['original'][i] for i in df['index'] if 'Right' in df['label'][i] or '-rh-' in df['label'][i]})
-        left_classes = list({df['original'][i] for i in df['index'] if 'Left' in df['label'][i] or '-lh-' in df['label'][i]})
-
     # only null half for slices that have labels from both halves
-    mask_set = np.unique(mask)
-    if np.isin(mask_set, right_classes).any() and np.isin(mask_set, left_classes).any():
-        null_classes = right_classes if keep_left else left_classes
-        null_elts = np.isin(mask, null_classes)
+    right_elts = apply_lut(right_classes, mask)
+    left_elts = apply_lut(left_classes, mask)
+    if right_elts.any() and left_elts.any():
+        null_elts = right_elts if keep_left else left_elts
         null_image[null_elts] = 0.0
         null_mask[null_elts] = 0
     
@@ -307,6 +340,22 @@ def null_half(image: np.array, mask: np.array, keep_left=True, right_classes = N
     
     return null_image, null_mask, right_classes, left_classes
 
+def _membership_lut(classes):
+    """
+    Converts a list of labels to a boolean lookup table; lookup tables are returned as is.
+
+    Args:
+        classes (np.array | list): a boolean lookup table or a list of labels
+
+    Returns:
+        np.array: boolean array of size TissueLabeling.data.label_mapping.N_LABELS
+    """
+    if isinstance(classes, np.ndarray) and classes.dtype == bool:
+        return classes
+    lut = np.zeros(N_LABELS, dtype=bool)
+    lut[np.asarray(classes, dtype=np.int64)] = True
+    return lut
+
 def apply_background(image,mask,background):
     """
     This function is used to apply new background behind the tissue on the feature image ONLY.
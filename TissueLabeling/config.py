@@ -68,6 +68,34 @@ class Configuration:
         self.background_percent_cutoff = getattr(args, "background_percent_cutoff", 0.99)
         self.data_dir = getattr(args, "data_dir", "")
         self.data_size = getattr(args, "data_size", "small")
+        self.num_workers = getattr(args, "num_workers", 4) # per GPU process, same default as --num_workers
+        self.prefetch_factor = getattr(args, "prefetch_factor", 2)
+        self.persistent_workers = getattr(args, "persistent_workers", 0)
+        self.h5_dir = getattr(args, "h5_dir", "/om/scratch/tmp/sabeen/kwyk_chunk/")
+        self.h5_rdcc_nbytes = getattr(args, "h5_rdcc_nbytes", 1024**2)
+        self.h5_rdcc_nslots = getattr(args, "h5_rdcc_nslots", 521)
+        self.h5_rdcc_w0 = getattr(args, "h5_rdcc_w0", 0.75)
+        self.h5_page_buf_size = getattr(args, "h5_page_buf_size", 0)
+        self.h5_read_ahead = getattr(args, "h5_read_ahead", 0)
+        self.volume_cache_bytes = getattr(args, "volume_cache_bytes", 0)
+        self.volume_cache_dir = getattr(args, "volume_cache_dir", "")
+        self.slice_cache_dir = getattr(args, "slice_cache_dir", "")
+        self.slice_cache_bytes = getattr(args, "slice_cache_bytes", 100 * 1024**3)
+        self.memmap_dir = getattr(args, "memmap_dir", "")
+        self.preprocessed_h5_dir = getattr(args, "preprocessed_h5_dir", "")
+        self.packed_data_dir = getattr(args, "packed_data_dir", "")
+        self.compact_samples = getattr(args, "compact_samples", 0)
+        self.roi_reads = getattr(args, "roi_reads", 0)
+        self.roi_margin = getattr(args, "roi_margin", 4)
+        self.use_vds = getattr(args, "use_vds", 0)
+        self.shm_dir = getattr(args, "shm_dir", "")
+        self.sampler = getattr(args, "sampler", "random")
+        self.shuffle_buffer_size = getattr(args, "shuffle_buffer_size", 4096)
+        self.sampler_temperature = getattr(args, "sampler_temperature", 0.5)
+        self.epoch_num_samples = getattr(args, "epoch_num_samples", 0)
+        self.class_counts_dir = getattr(args, "class_counts_dir", "/om/scratch/tmp/sabeen/kwyk_class_counts")
+        self.slice_index_dir = getattr(args, "slice_index_dir", "/om/scratch/tmp/sabeen/kwyk_slice_index")
+        self.slice_stats_file = getattr(args, "slice_stats_file", "")
         self.augment = getattr(args, "augment", 0)
         self.aug_percent = getattr(args, "aug_percent", 0.8)
         self.aug_mask = getattr(args, "aug_mask", 0)
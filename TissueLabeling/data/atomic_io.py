@@ -0,0 +1,43 @@
+"""
+File: atomic_io.py
+Author: Sabeen Lohawala
+Date: 2024-05-22
+Description: This file contains helpers to write files atomically: the content is written to a temporary
+file next to the destination, which is then renamed over it, so concurrent readers (other DataLoader
+workers, ranks, or jobs sharing a cache directory) see either the old file or the complete new one.
+"""
+
+import os
+
+import numpy as np
+
+
+def atomic_write(path: str, write_fn, mode: str = "wb") -> None:
+    """
+    Writes a file atomically.
+
+    Args:
+        path (str): the destination
+        write_fn (callable): function that writes the content to the open file object it is passed
+        mode (str): the mode to open the temporary file with, 'wb' or 'w'
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_save(path: str, array) -> None:
+    """
+    Saves an array in .npy format atomically, see atomic_write.
+
+    Args:
+        path (str): the destination, including the .npy extension
+        array (np.array): the array to save
+    """
+    atomic_write(path, lambda f: np.save(f, array))
@@ -0,0 +1,314 @@
+"""
+File: class_counts.py
+Author: Sabeen Lohawala
+Date: 2024-05-28
+Description: This file contains the layout and query API of the per-slice class-count index of the KWYK
+shards, which scripts/build_class_counts.py writes.
+
+Labels are counted in the 'index' column of class_mapping.csv (106 classes), from which every other class
+scheme can be derived. There is one row per (global volume index, axis, slice index), at
+row = (vol_idx * 3 + axis) * MAX_SLICES + slice_idx, so rows line up with the packed slice index
+(see slice_index.py). The counts are stored sparsely (CSR): offsets.npy holds the start of the entries of
+each row in classes.bin (uint8 class) and counts.bin (uint16 pixel count, saturated at 65535), and
+presence.npy holds a bit per (row, class) for fast presence tests.
+"""
+
+import fcntl
+import json
+import os
+import zlib
+
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_save
+from TissueLabeling.data.hdf5_io import get_shard_dataset, open_shard
+from TissueLabeling.data.label_mapping import get_label_mapper
+from TissueLabeling.data.slice_cache import get_file_namespace
+
+MAX_SLICES = 256 # slices per axis addressed by a row, same as the 8 bits of the packed slice index
+N_CLASSES = 106
+META_FILE = "class_counts_meta.json"
+
+
+def count_volume_classes(label_vol, lut, n_classes: int = N_CLASSES):
+    """
+    Counts the pixels of each class in every slice of a volume along all three axes.
+
+    Args:
+        label_vol (np.array): the freesurfer label volume of shape [H, W, D], each at most MAX_SLICES
+        lut (np.array): uint8 lookup table from the freesurfer labels to the classes
+                        (LabelMapper.class_lut(106) for the 'index' column)
+        n_classes (int): number of classes of lut
+
+    Returns:
+        lengths (np.array): number of entries of each of the 3 * MAX_SLICES rows of the volume
+        classes (np.array): uint8 class of each entry
+        counts (np.array): uint16 pixel count of each entry
+    """
+    label_vol = lut[label_vol].astype(np.int64)
+    dense = np.zeros((3, MAX_SLICES, n_classes), dtype=np.int64)
+    for axis in range(3):
+        n_slices = label_vol.shape[axis]
+        slice_ids = np.arange(n_slices).reshape([-1 if i == axis else 1 for i in range(3)])
+        dense[axis, :n_slices] = np.bincount(
+            (slice_ids * n_classes + label_vol).ravel(), minlength=n_slices * n_classes
+        ).reshape(n_slices, n_classes)
+    dense = dense.reshape(3 * MAX_SLICES, n_classes)
+    rows, classes = np.nonzero(dense)
+    lengths = np.bincount(rows, minlength=3 * MAX_SLICES)
+    counts = np.minimum(dense[rows, classes], 65535).astype(np.uint16)
+    return lengths, classes.astype(np.uint8), counts
+
+
+def slice_rows(slice_index) -> np.array:
+    """
+    Converts packed slice index values to rows of the class-count index.
+
+    Args:
+        slice_index (np.array): packed uint32 slice index values, see slice_index.pack_slice_rows
+
+    Returns:
+        np.array: int64 rows
+    """
+    packed = np.atleast_1d(np.asarray(slice_index, dtype=np.int64))
+    return ((packed >> 10) * 3 + ((packed >> 8) & 3)) * MAX_SLICES + (packed & 255)
+
+
+class ClassCountIndex:
+    """
+    A class for querying the per-slice class-count index without touching any pixels.
+    """
+
+    def __init__(self, index_dir: str):
+        """
+        Memory-maps the index.
+
+        Args:
+            index_dir (str): the directory written by scripts/build_class_counts.py
+        """
+        with open(os.path.join(index_dir, META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.n_vols = self.meta["n_vols"]
+        self.n_classes = self.meta["n_classes"]
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+        self.presence_bits = np.load(os.path.join(index_dir, "presence.npy"), mmap_mode="r")
+        n_entries = int(self.offsets[-1])
+        self.classes = np.memmap(os.path.join(index_dir, "classes.bin"), dtype=np.uint8, mode="r", shape=(n_entries,))
+        self.counts = np.memmap(os.path.join(index_dir, "counts.bin"), dtype=np.uint16, mode="r", shape=(n_entries,))
+        self.label_mapper = get_label_mapper(self.meta["label_column"])
+
+    def _rows(self, slice_index=None) -> np.array:
+        """
+        Gets the rows of the slices in slice_index, or all rows if None.
+        """
+        if slice_index is None:
+            return np.arange(len(self.offsets) - 1)
+        return slice_rows(slice_index)
+
+    def _entries(self, rows):
+        """
+        Gets the CSR entries of rows.
+
+        Returns:
+            entry_rows (np.array): position in rows of each entry
+            classes (np.array): class of each entry
+            counts (np.array): pixel count of each entry
+        """
+        starts = np.asarray(self.offsets[rows])
+        lengths = np.asarray(self.offsets[rows + 1]) - starts
+        entry_rows = np.repeat(np.arange(len(rows)), lengths)
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return entry_rows, np.asarray(self.classes[entries]), np.asarray(self.counts[entries])
+
+    def _class_mask(self, class_ids, nr_of_classes: int = None) -> np.array:
+        """
+        Converts classes of a scheme to a boolean mask over the stored classes.
+        """
+        mask = np.zeros(self.n_classes, dtype=bool)
+        if nr_of_classes is None:
+            mask[np.asarray(class_ids, dtype=np.int64)] = True
+        else:
+            mask = np.isin(self.label_mapper.class_lut(nr_of_classes)[: self.n_classes], class_ids)
+        return mask
+
+    def presence(self, slice_index=None) -> np.array:
+        """
+        Gets which classes are present in each slice.
+
+        Args:
+            slice_index (np.array | None): packed slice index values, or None for all rows
+
+        Returns:
+            np.array: bool array of shape [n, n_classes]
+        """
+        rows = self._rows(slice_index)
+        return np.unpackbits(np.asarray(self.presence_bits[rows]), axis=1, count=self.n_classes).astype(bool)
+
+    def contains(self, class_ids, slice_index=None, nr_of_classes: int = None) -> np.array:
+        """
+        Tests which slices contain any of class_ids.
+
+        Args:
+            class_ids (list): the classes to test for
+            slice_index (np.array | None): packed slice index values, or None for all rows
+            nr_of_classes (int | None): the scheme of class_ids; the stored classes if None
+
+        Returns:
+            np.array: bool array of shape [n]
+        """
+        return self.presence(slice_index)[:, self._class_mask(class_ids, nr_of_classes)].any(axis=1)
+
+    def has_both_hemispheres(self, slice_index=None) -> np.array:
+        """
+        Tests which slices contain labels of both hemispheres, i.e. the slices null_half would modify.
+
+        Args:
+            slice_index (np.array | None): packed slice index values, or None for all rows
+
+        Returns:
+            np.array: bool array of shape [n]
+        """
+        presence = self.presence(slice_index)
+        right = self.label_mapper.right_lut[: self.n_classes]
+        left = self.label_mapper.left_lut[: self.n_classes]
+        return presence[:, right].any(axis=1) & presence[:, left].any(axis=1)
+
+    def slice_counts(self, slice_index, nr_of_classes: int = N_CLASSES) -> np.array:
+        """
+        Gets the pixel count of each class in each slice.
+
+        Args:
+            slice_index (np.array): packed slice index values
+            nr_of_classes (int): the class scheme to count in
+
+        Returns:
+            np.array: int64 array of shape [n, nr_of_classes]
+        """
+        rows = self._rows(slice_index)
+        entry_rows, classes, counts = self._entries(rows)
+        classes = self.label_mapper.class_lut(nr_of_classes)[classes].astype(np.int64)
+        dense = np.zeros(len(rows) * nr_of_classes, dtype=np.int64)
+        np.add.at(dense, entry_rows * nr_of_classes + classes, counts)
+        return dense.reshape(len(rows), nr_of_classes)
+
+    def histogram(self, nr_of_classes: int = N_CLASSES, slice_index=None) -> np.array:
+        """
+        Gets the total pixel count of each class, e.g. over a split by passing HDF5Dataset.filtered_matrix.
+
+        Args:
+            nr_of_classes (int): the class scheme to count in
+            slice_index (np.array | None): packed slice index values, or None for all slices
+
+        Returns:
+            np.array: int64 array of shape [nr_of_classes]
+        """
+        if slice_index is None:
+            classes, counts = np.asarray(self.classes), np.asarray(self.counts)
+        else:
+            _, classes, counts = self._entries(self._rows(slice_index))
+        classes = self.label_mapper.class_lut(nr_of_classes)[classes]
+        return np.bincount(classes, weights=counts, minlength=nr_of_classes).astype(np.int64)
+
+    def frequencies(self, nr_of_classes: int = N_CLASSES, slice_index=None) -> np.array:
+        """
+        Gets the fraction of pixels of each class, see histogram.
+
+        Returns:
+            np.array: float64 array of shape [nr_of_classes] that sums to 1
+        """
+        histogram = self.histogram(nr_of_classes, slice_index)
+        return histogram / max(histogram.sum(), 1)
+
+
+def compute_split_presence(h5_file_paths, manifest, slice_index) -> np.array:
+    """
+    Computes the packed class presence of the slices of a split directly from the shards, for when the
+    class-count index has not been built. Reads each volume of the split once, in a single process; building
+    the index with scripts/build_class_counts.py is much faster for the full dataset.
+
+    Args:
+        h5_file_paths (list): paths of the shards
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+        slice_index (np.array): packed slice index values of the split
+
+    Returns:
+        np.array: uint8 array of shape [n, ceil(N_CLASSES / 8)], in the format of ClassCountIndex.presence_bits
+    """
+    lut = get_label_mapper("original").class_lut(N_CLASSES)
+    packed = np.asarray(slice_index, dtype=np.int64)
+    rows = slice_rows(packed) % (3 * MAX_SLICES) # row within the volume
+    vol_indices = packed >> 10
+    presence = np.zeros((len(packed), -(-N_CLASSES // 8)), dtype=np.uint8)
+    h5_pointers = {}
+    for vol_idx in np.unique(vol_indices):
+        shard_idx, shard_vol_idx = manifest.locate(vol_idx)
+        if shard_idx not in h5_pointers:
+            h5_pointers[shard_idx] = open_shard(h5_file_paths[shard_idx])
+        lengths, classes, _ = count_volume_classes(get_shard_dataset(h5_pointers[shard_idx], "labels")[shard_vol_idx], lut)
+        present = np.zeros((3 * MAX_SLICES, N_CLASSES), dtype=bool)
+        present[np.repeat(np.arange(3 * MAX_SLICES), lengths), classes] = True
+        positions = np.nonzero(vol_indices == vol_idx)[0]
+        presence[positions] = np.packbits(present[rows[positions]], axis=1)
+    for f in h5_pointers.values():
+        f.close()
+    return presence
+
+
+def load_split_presence(class_counts_dir: str, slice_index, manifest) -> np.array:
+    """
+    Gets the packed class presence of the slices of a split from the class-count index in class_counts_dir.
+    If the index has not been built, the presence is computed from the shards with compute_split_presence
+    and cached in class_counts_dir for the next run.
+
+    Args:
+        class_counts_dir (str): directory of the class-count index
+        slice_index (np.array): packed slice index values of the split
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the (unprocessed) shards
+
+    Returns:
+        np.array: uint8 array of shape [n, ceil(N_CLASSES / 8)], see ClassCountIndex.presence_bits
+    """
+    if os.path.exists(os.path.join(class_counts_dir, META_FILE)):
+        index = ClassCountIndex(class_counts_dir)
+        if index.n_vols == manifest.n_vols:
+            return np.asarray(index.presence_bits[slice_rows(slice_index)])
+        print(f"class-count index in {class_counts_dir} does not match the shards")
+
+    slice_index = np.asarray(slice_index)
+    # the file is specific to the shards (path, size, mtime of each) and to the slices of the split
+    shards_crc = zlib.crc32("_".join(get_file_namespace(path) for path in manifest.shard_paths).encode())
+    cache_path = os.path.join(
+        class_counts_dir,
+        f"split_presence_{shards_crc:08x}_{len(slice_index)}_{zlib.crc32(slice_index.tobytes()):08x}.npy",
+    )
+    if not os.path.exists(cache_path):
+        os.makedirs(class_counts_dir, exist_ok=True)
+        # the first rank to get the lock computes the presence, the others wait for it and load the file
+        with open(f"{cache_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(cache_path):
+                    print(f"computing the class presence of {len(slice_index)} slices into {cache_path}")
+                    atomic_save(cache_path, compute_split_presence(manifest.shard_paths, manifest, slice_index))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return np.load(cache_path)
+
+
+def write_class_count_meta(index_dir: str, n_vols: int, label_column: str = "index", n_classes: int = N_CLASSES) -> dict:
+    """
+    Writes the metadata of the index.
+
+    Args:
+        index_dir (str): the directory of the index
+        n_vols (int): the number of volumes
+        label_column (str): the column of class_mapping.csv the classes correspond to
+        n_classes (int): the number of classes
+
+    Returns:
+        meta (dict): the metadata of the index
+    """
+    meta = {"n_vols": int(n_vols), "label_column": label_column, "n_classes": int(n_classes), "max_slices": MAX_SLICES}
+    with open(os.path.join(index_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=4)
+    return meta
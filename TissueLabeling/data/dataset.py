@@ -4,14 +4,13 @@
 File: dataset.py
 Author: Sabeen Lohawala
 Date: 2024-05-11
-Description: This file contains classes for two methods of reading in the KWYK dataset slices and a function
+Description: This file contains classes for the methods of reading in the KWYK dataset slices and a function
 to return the specified PyTorch Dataloaders for the train, validation, and test split.
 """
 import glob
 import os
 import sys
 
-import h5py as h5
 import random
 import json
 import numpy as np
@@ -20,10 +19,21 @@ from torch.utils.data import Dataset
 from scipy.ndimage import affine_transform
 from torchvision import transforms
 import albumentations as A
-from sklearn.model_selection import train_test_split
 import nibabel as nib
 
 from TissueLabeling.data.cutout import Cutout
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.class_counts import load_split_presence
+from TissueLabeling.data.label_mapping import get_label_mapper
+from TissueLabeling.data.hdf5_io import ReadAheadBuffer, ShardHandles, get_shard_dataset, read_slice_roi, read_slices, read_slices_roi
+from TissueLabeling.data.memmap_store import get_row, get_slice, open_store, read_meta
+from TissueLabeling.data.packed_slices import MANIFEST_FILE, PackedSlices
+from TissueLabeling.data.shared_slices import attach_segment, get_segment_key, materialize_segment
+from TissueLabeling.data.samplers import BlockShuffleSampler, ClassBalancedSampler, ShardAffineSampler, get_class_balanced_weights
+from TissueLabeling.data.slice_cache import SliceCache, get_file_namespace
+from TissueLabeling.data.slice_index import load_slice_index, unpack_slice_rows
+from TissueLabeling.data.slice_stats import load_tissue_bboxes
+from TissueLabeling.data.volume_cache import VolumeCache
 from TissueLabeling.data.mask import Mask
 from TissueLabeling.utils import center_pad_tensor
 from TissueLabeling.brain_utils import (
@@ -59,73 +69,50 @@ class HDF5Dataset(Dataset):
 
         random.seed(42)
 
-        h5_dir = '/om/scratch/tmp/sabeen/kwyk_chunk/' # where the hdf5 files are stored
-        h5_file_paths = sorted(glob.glob(os.path.join(h5_dir, '*.h5')))
-        self.h5_pointers = [h5.File(h5_path,'r') for h5_path in h5_file_paths]
-
-        if config.background_percent_cutoff > 0:
-            slice_nonbrain_dir = '/om/scratch/Fri/sabeen/kwyk_h5_nonbrains'
-            slice_nonbrain_file_paths = sorted(glob.glob(os.path.join(slice_nonbrain_dir, '*nonbrain*.npy')))
-            all_slice_nonbrain = [np.load(slice_nonbrain_path) for slice_nonbrain_path in slice_nonbrain_file_paths]
-            all_slice_nonbrain[-1] = np.pad(all_slice_nonbrain[-1], ((0,0),(0,all_slice_nonbrain[0].shape[1] - all_slice_nonbrain[-1].shape[1]),(0,0),(0,0)),mode='constant', constant_values=65535)
-            self.slice_nonbrain = np.vstack(all_slice_nonbrain) # shape = [10,1150,3,256]
-
-            # keep track of which slices have fewer percentage of background pixels than config.background_percent_cutoff
-            filter_value = config.background_percent_cutoff * 256*256 
-            keep_indices = torch.nonzero(torch.from_numpy(self.slice_nonbrain.astype(np.int32)) < filter_value) # [num_slices, 4] - (shard_idx, shard_vol_idx, axis, slice_idx)
-        else: # only filters out slices that have no tissue
-            slice_nonbrain_dir = '/om/scratch/Fri/sabeen/kwyk_h5_matthias'
-            slice_nonbrain_file_paths = sorted(glob.glob(os.path.join(slice_nonbrain_dir, '*matthias*.npy')))
-            all_slice_nonbrain = [np.load(slice_nonbrain_path) for slice_nonbrain_path in slice_nonbrain_file_paths]
-            all_slice_nonbrain[-1] = np.pad(all_slice_nonbrain[-1], ((0,0),(0,all_slice_nonbrain[0].shape[1] - all_slice_nonbrain[-1].shape[1]),(0,0),(0,0)),mode='constant', constant_values=0)
-            self.slice_nonbrain = np.vstack(all_slice_nonbrain) # shape = [10,1150,3,256]
-            keep_indices = torch.nonzero(torch.from_numpy(self.slice_nonbrain.astype(np.uint8)) != 0) # [num_slices, 4] - (shard_idx, shard_vol_idx, axis, slice_idx)
-
-        # train-val-test-split
-        if 'shard' in config.data_size:
-            # train-val-test split a single shard of data
-            if config.data_size != 'shard': # config.data_size = 'shard-#' where # in [0,10)
-                _, shard_num = config.data_size.split('-')
-                shard_num = int(shard_num)
-                train_shard = shard_num % 10
-                val_shard = (train_shard + 1) % 10
-                test_shard = (val_shard + 1) % 10
-                train_indices = list(range(train_shard * 1150,min((train_shard+1) * 1150,11480)))
-                val_indices = list(range(val_shard*1150, min((val_shard + 1)*1150,11480)))
-                test_indices = list(range(test_shard * 1150, min((test_shard+1) * 1150,11480)))
-                random.shuffle(train_indices)
-                random.shuffle(val_indices)
-                random.shuffle(test_indices)
-                train_indices = train_indices[:80]
-                val_indices = val_indices[:10]
-                test_indices = test_indices[:10]
-            else: # train, val, and test split come from a different shard of data each
-                train_indices = list(range(1150))
-                val_indices = list(range(1150,1150*2))
-                test_indices = list(range(1150*2,1150*3))
-        else:
-            train_indices, rem_indices = train_test_split(np.arange(0,11479),test_size = 0.2, random_state = 42)
-            val_indices, test_indices = train_test_split(rem_indices,test_size = 0.5, random_state = 42)
-
-            # keep only a subset of indices if not using the full dataset
-            if config.data_size in ['small', 'med','medium']:
-                end_idx = 10 if config.data_size == 'small' else 1150
-                train_indices = train_indices[:int(end_idx * 0.8)]
-                val_indices = val_indices[:int(end_idx * 0.1)]
-                test_indices = test_indices[:int(end_idx * 0.1)]
-
-        mode_indices = train_indices if mode == 'train' else val_indices if mode == 'validation' else test_indices
-
-        keep_vol_indices = keep_indices[:,0] * 1150 + keep_indices[:,1] # convert to flattened indices
-        self.filtered_matrix = keep_indices[np.isin(keep_vol_indices,mode_indices)]
+        # shard geometry (paths, number of volumes per shard, ...) comes from the manifest of the shard directory
+        self.manifest = ShardManifest.load(config.h5_dir)
+        self.h5_file_paths = self.manifest.shard_paths
+        # shard handles are opened lazily in each process (see _get_h5_pointers) so that
+        # HDF5 file state is never shared across forked DataLoader workers
+        self.h5_pointers = None
+        self.h5_pointers_pid = None
+        # HDF5 chunk cache / page buffer settings used when opening the shards
+        self.h5_open_kwargs = {
+            'rdcc_nbytes': config.h5_rdcc_nbytes,
+            'rdcc_nslots': config.h5_rdcc_nslots,
+            'rdcc_w0': config.h5_rdcc_w0,
+            'page_buf_size': config.h5_page_buf_size,
+        }
+        self.read_ahead = config.h5_read_ahead
+        self.read_ahead_buffer = None
+        if config.slice_cache_dir and (config.volume_cache_bytes or config.h5_read_ahead):
+            # slices are served from the volume cache or the read-ahead buffer first, so the slice cache would never be used
+            raise Exception("slice_cache_dir cannot be combined with volume_cache_bytes or h5_read_ahead")
+        # decoded whole volumes, shared by all slices (and axes) of a volume; in /dev/shm if volume_cache_dir is set
+        self.volume_cache = VolumeCache(config.volume_cache_bytes, config.volume_cache_dir) if config.volume_cache_bytes else None
+        # decoded slices on node-local disk, shared by all jobs on the node (see slice_cache.py)
+        self.slice_cache = SliceCache(config.slice_cache_dir, config.slice_cache_bytes) if config.slice_cache_dir else None
+        # identity of each shard (path, size, mtime) that keeps the entries of different shard sets apart in
+        # the caches shared through a directory, set when the shards are opened
+        self.shard_namespaces = None
+
+        # packed uint32 index of the filtered slices in this split, memory-mapped from the cache (see slice_index.py)
+        self.filtered_matrix = load_slice_index(config.slice_index_dir, mode, config.background_percent_cutoff, config.data_size, self.manifest, config.slice_stats_file)
 
         if config.debug:
             print("debug mode")
             self.filtered_matrix = self.filtered_matrix[:100]
+
+        # read only the tissue bounding box (plus a margin) of each slice, see hdf5_io.read_slice_roi
+        self.roi_margin = config.roi_margin
+        self.tissue_bboxes = load_tissue_bboxes(self.manifest, config.slice_stats_file, config.slice_index_dir) if config.roi_reads else None
+        if config.use_vds:
+            self._set_virtual_dataset()
         
         # store relevant config parameters
         self.nr_of_classes = config.nr_of_classes
         self.pretrained = config.pretrained
+        self.compact_samples = config.compact_samples # return uint8 images and labels, see Trainer._prepare_batch
         if self.mode == "train": # only apply augmentations to training data
             self.augment = config.augment
             self.intensity_scale = config.intensity_scale
@@ -159,10 +146,9 @@ class HDF5Dataset(Dataset):
             self.aug_noise_background = 0
             self.possible_backgrounds = set()
 
-        self.class_mapping = None # stores the mapping from original freesurfer labels to ids to labels for nr_of_classes
-        self.right_classes = None # stores the mapping for regions prefixed with 'right' or 'rh'
-        self.left_classes = None # stores the mapping for regions prefixed with 'left' or 'lh'
-        self.null_classes = None # stores the mapping for regions belonging in cerebellum or brain stem
+        self.preprocessed = False # whether the stored features are skull stripped and labels mapped to nr_of_classes
+        self.label_reference_col = 'original' # the column of class_mapping.csv corresponding to the stored labels
+        self._set_label_mapper()
 
         # list of albumentations augmentations that will be applied based on config
         transform_list = [
@@ -198,6 +184,65 @@ class HDF5Dataset(Dataset):
                                                   always_apply=True))
         self.transform = A.Compose(transform_list)
 
+    def _set_label_mapper(self):
+        """
+        Compiles the lookup tables for the labels in self.label_reference_col (once per process, before the
+        DataLoader workers fork) and keeps the membership tables used by the null augmentations.
+        """
+        self.label_mapper = get_label_mapper(self.label_reference_col)
+        self.label_mapper.class_lut(self.nr_of_classes)
+        self.right_classes = self.label_mapper.right_lut # labels of regions prefixed with 'right' or 'rh'
+        self.left_classes = self.label_mapper.left_lut # labels of regions prefixed with 'left' or 'lh'
+        self.null_classes = self.label_mapper.cerebellum_brain_stem_lut # labels of regions in the cerebellum or brain stem
+
+    def __getstate__(self):
+        """
+        Drops the open shard handles when the dataset is pickled (e.g. for spawned DataLoader workers).
+
+        Returns:
+            state (dict): the picklable state of the dataset
+        """
+        state = self.__dict__.copy()
+        state['h5_pointers'] = None
+        state['h5_pointers_pid'] = None
+        state['read_ahead_buffer'] = None
+        return state
+
+    def _set_virtual_dataset(self):
+        """
+        Reads the shards through their virtual dataset (see scripts/build_kwyk_vds.py): the manifest is
+        replaced by that of a single shard containing all volumes, so each process opens one file and
+        batched reads across shard boundaries are single calls. Global volume indices are unchanged.
+        """
+        self.manifest = self.manifest.virtual()
+        self.h5_file_paths = self.manifest.shard_paths
+
+    def _get_h5_pointers(self):
+        """
+        Returns the shard handles of the current process, each shard being opened on first use. Handles
+        inherited from a parent process through fork are discarded (not closed) and reopened.
+
+        Returns:
+            ShardHandles: the read-only h5py.File handles of all shards, indexed by shard
+        """
+        if self.h5_pointers is None or self.h5_pointers_pid != os.getpid():
+            self.h5_pointers = ShardHandles(self.h5_file_paths, **self.h5_open_kwargs)
+            self.h5_pointers_pid = os.getpid()
+            self.read_ahead_buffer = ReadAheadBuffer(self.read_ahead) if self.read_ahead else None
+            if self.slice_cache is not None or (self.volume_cache is not None and self.volume_cache.shared_dir):
+                self.shard_namespaces = [get_file_namespace(h5_path) for h5_path in self.h5_file_paths]
+        return self.h5_pointers
+
+    def close(self):
+        """
+        Closes the shard handles opened by the current process.
+        """
+        if self.h5_pointers is not None and self.h5_pointers_pid == os.getpid():
+            self.h5_pointers.close()
+        self.h5_pointers = None
+        self.h5_pointers_pid = None
+        self.read_ahead_buffer = None
+
     def __getitem__(self, index):
         """
         Gets the slice at the corresponding index.
@@ -210,16 +255,146 @@ class HDF5Dataset(Dataset):
             label_slice (torch.tensor): the corresponding label slice of size [1,h,w] where freesurfer labels 
                                         have been mapped to the config.nr_of_classes
         """
-        shard_idx, shard_vol_idx, axis, slice_idx = self.filtered_matrix[index]
+        h5_pointers = self._get_h5_pointers()
+        shard_idx, shard_vol_idx, axis, slice_idx = unpack_slice_rows(self.filtered_matrix[index], self.manifest)[0]
+        if self.volume_cache is not None:
+            feature_slice, label_slice = self._get_cached_slice(h5_pointers[shard_idx], shard_idx, shard_vol_idx, axis, slice_idx)
+            return self._prepare_sample(feature_slice, label_slice)
+        if self.read_ahead_buffer is not None:
+            feature_slice, label_slice = self.read_ahead_buffer.get(h5_pointers[shard_idx], shard_idx, shard_vol_idx, axis, slice_idx)
+            return self._prepare_sample(feature_slice, label_slice)
+        if self.slice_cache is not None:
+            # node-local copy of the slice, read from the shards only by the first process on the node to need it
+            read_kind = f"roi{self.roi_margin}" if self.tissue_bboxes is not None else "full"
+            feature_slice, label_slice = self.slice_cache.get(
+                (self.shard_namespaces[shard_idx], read_kind, shard_vol_idx, axis, slice_idx),
+                lambda: self._read_slice(h5_pointers[shard_idx], index, shard_vol_idx, axis, slice_idx),
+            )
+            return self._prepare_sample(feature_slice, label_slice)
+        feature_slice, label_slice = self._read_slice(h5_pointers[shard_idx], index, shard_vol_idx, axis, slice_idx)
+        return self._prepare_sample(feature_slice, label_slice)
+
+    def _read_slice(self, h5_file, index, shard_vol_idx, axis, slice_idx):
+        """
+        Reads a slice and its label slice from a shard, only the tissue bounding box if config.roi_reads is set.
+
+        Args:
+            h5_file (h5py.File): the open shard containing the slice
+            index (int): index of the slice in this split
+            shard_vol_idx (int): the index of the volume within the shard
+            axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+            slice_idx (int): the index of the slice along axis
+
+        Returns:
+            feature_slice (np.array): the uint8 MRI slice of size [h,w]
+            label_slice (np.array): the uint16 label slice of size [h,w]
+        """
+        if self.tissue_bboxes is not None:
+            # everything outside of the tissue bounding box is background, which the skull stripping zeroes anyway
+            bbox = self.tissue_bboxes[int(self.filtered_matrix[index]) >> 10, axis, slice_idx]
+            feature_slice = read_slice_roi(get_shard_dataset(h5_file, 'features', axis), shard_vol_idx, axis, slice_idx, bbox, self.roi_margin)
+            label_slice = read_slice_roi(get_shard_dataset(h5_file, 'labels', axis), shard_vol_idx, axis, slice_idx, bbox, self.roi_margin)
+            return feature_slice, label_slice
         indices = [shard_vol_idx,slice(None),slice(None)]
         indices.insert(axis+1,slice_idx)
-        feature_slice = (self.h5_pointers[shard_idx][f'features_axis{axis}'][tuple(indices)]).astype(np.float32) # (256, 256)
-        label_slice = (self.h5_pointers[shard_idx][f'labels_axis{axis}'][tuple(indices)]).astype(np.int16) # (256, 256)
-        feature_slice[label_slice == 0] = 0 # skull stripping
+        feature_slice = get_shard_dataset(h5_file, 'features', axis)[tuple(indices)] # (256, 256)
+        label_slice = get_shard_dataset(h5_file, 'labels', axis)[tuple(indices)] # (256, 256)
+        return feature_slice, label_slice
+
+    def __getitems__(self, indices):
+        """
+        Gets the slices at the corresponding indices. Used by the DataLoader to fetch a whole batch at once:
+        the requested slices are grouped by shard and axis and each group is read with one call per dataset
+        instead of two reads per slice.
+
+        Args:
+            indices (list): indices of the slices to get
+        
+        Returns:
+            list: a (feature_slice, label_slice) tuple for each index, as returned by __getitem__
+        """
+        h5_pointers = self._get_h5_pointers()
+        if self.volume_cache is not None or self.read_ahead_buffer is not None or self.slice_cache is not None:
+            # neighbouring slices are served from the cached volumes or read-ahead blocks, and the
+            # slice cache is looked up slice by slice
+            return [self[index] for index in indices]
+        packed = np.asarray(self.filtered_matrix[indices])
+        rows = unpack_slice_rows(packed, self.manifest) # (shard_idx, shard_vol_idx, axis, slice_idx)
+        feature_slices = [None] * len(rows)
+        label_slices = [None] * len(rows)
+        for shard_idx, axis in np.unique(rows[:, [0, 2]], axis=0):
+            positions = np.nonzero((rows[:, 0] == shard_idx) & (rows[:, 2] == axis))[0]
+            f = h5_pointers[shard_idx]
+            if self.tissue_bboxes is not None:
+                # one read of the rectangle around the tissue of all slices of the group
+                bboxes = self.tissue_bboxes[packed[positions].astype(np.int64) >> 10, axis, rows[positions, 3]]
+                group_features = read_slices_roi(get_shard_dataset(f, 'features', axis), rows[positions, 1], rows[positions, 3], axis, bboxes, self.roi_margin)
+                group_labels = read_slices_roi(get_shard_dataset(f, 'labels', axis), rows[positions, 1], rows[positions, 3], axis, bboxes, self.roi_margin)
+            else:
+                group_features = read_slices(get_shard_dataset(f, 'features', axis), rows[positions, 1], rows[positions, 3], axis)
+                group_labels = read_slices(get_shard_dataset(f, 'labels', axis), rows[positions, 1], rows[positions, 3], axis)
+            for i, position in enumerate(positions):
+                feature_slices[position] = group_features[i]
+                label_slices[position] = group_labels[i]
+
+        return [self._prepare_sample(feature_slice, label_slice) for feature_slice, label_slice in zip(feature_slices, label_slices)]
+
+    def _get_cached_slice(self, h5_file, shard_idx, shard_vol_idx, axis, slice_idx):
+        """
+        Gets a slice and its label slice from the volume cache, decoding the whole volume on a miss. The volume
+        is read from the axis 0 datasets (in chunk order) and serves all three axes.
+
+        Args:
+            h5_file (h5py.File): the open shard containing the slice
+            shard_idx (int): which shard index
+            shard_vol_idx (int): the index of the volume within the shard
+            axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+            slice_idx (int): the index of the slice along axis
+
+        Returns:
+            feature_slice (np.array): the uint8 MRI slice of size [h,w]
+            label_slice (np.array): the uint16 label slice of size [h,w]
+        """
+        feature_vol, label_vol = self.volume_cache.get(
+            (self.shard_namespaces[shard_idx] if self.volume_cache.shared_dir else shard_idx, shard_vol_idx),
+            lambda: (get_shard_dataset(h5_file, 'features')[shard_vol_idx], get_shard_dataset(h5_file, 'labels')[shard_vol_idx]),
+        )
+        indices = [slice(None),slice(None)]
+        indices.insert(axis,slice_idx)
+        return feature_vol[tuple(indices)], label_vol[tuple(indices)]
+
+    def _prepare_sample(self, feature_slice, label_slice):
+        """
+        Skull strips, normalizes, augments, and maps the labels of a slice read from the shards. Skull stripping
+        and label mapping are skipped for pre-processed shards.
+
+        Args:
+            feature_slice (np.array): the uint8 MRI slice of size [h,w]
+            label_slice (np.array): the uint16 label slice of size [h,w] containing the freesurfer labels
+                                    (uint8 labels already mapped to nr_of_classes for pre-processed shards)
+        
+        Returns:
+            feature_slice (torch.tensor): the MRI slices of size [1,h,w] (uint8 0 to 255 with config.compact_samples)
+            label_slice (torch.tensor): the corresponding label slice of size [1,h,w] where freesurfer labels 
+                                        have been mapped to the config.nr_of_classes
+        """
+        augment_coin_toss = 1 if random.random() < self.aug_percent else 0
+        if self.compact_samples and not (self.augment and augment_coin_toss == 1):
+            # uint8 transport: the Trainer normalizes and expands the channels once per batch
+            if not self.preprocessed:
+                feature_slice = np.where(label_slice == 0, 0, feature_slice).astype(np.uint8) # skull stripping
+                label_slice = self.label_mapper.map(label_slice, self.nr_of_classes) # uint8
+            feature_slice = torch.from_numpy(np.array(feature_slice, dtype=np.uint8)).unsqueeze(dim=0)
+            label_slice = torch.from_numpy(np.array(label_slice, dtype=np.uint8)).unsqueeze(dim=0)
+            return (feature_slice, label_slice)
+
+        feature_slice = feature_slice.astype(np.float32)
+        if not self.preprocessed:
+            label_slice = label_slice.astype(np.int16)
+            feature_slice[label_slice == 0] = 0 # skull stripping
         feature_slice = feature_slice / 255.0 # make intensities 0 to 1 instead of 0 to 255
 
         # add augmentations
-        augment_coin_toss = 1 if random.random() < self.aug_percent else 0
         if self.augment and augment_coin_toss == 1:
             transformed = self.transform(image = feature_slice, mask = label_slice)
             feature_slice = transformed['image']
@@ -229,14 +404,11 @@ class HDF5Dataset(Dataset):
             # null half of the brain and possibly cerebellum and brain stem
             null_coin_toss = 1 if random.random() < 0.5 else 0
             if self.aug_null_half and null_coin_toss:
-                feature_slice, label_slice, right_classes, left_classes = null_half(image=feature_slice, mask=label_slice, keep_left=random.randint(0, 1) == 1,right_classes=self.right_classes,left_classes=self.left_classes)
-                self.right_classes = right_classes
-                self.left_classes = left_classes
+                feature_slice, label_slice, _, _ = null_half(image=feature_slice, mask=label_slice, keep_left=random.randint(0, 1) == 1,right_classes=self.right_classes,left_classes=self.left_classes)
 
                 null_cerebellum_brain_stem_coin_toss = 1 if self.aug_null_cerebellum_brain_stem and random.random() < 0.5 else 0
                 if null_cerebellum_brain_stem_coin_toss:
-                    feature_slice, label_slice, null_classes = null_cerebellum_brain_stem(image=feature_slice, mask=label_slice, null_classes=self.null_classes)
-                    self.null_classes = null_classes
+                    feature_slice, label_slice, _ = null_cerebellum_brain_stem(image=feature_slice, mask=label_slice, null_classes=self.null_classes)
             
             # background manipulation augmentations
             if self.aug_background_manipulation:
@@ -252,8 +424,12 @@ class HDF5Dataset(Dataset):
                         
                     feature_slice = apply_background(feature_slice,label_slice,background)
 
-        label_slice, class_mapping = mapping(np.array(label_slice), nr_of_classes=self.nr_of_classes, reference_col='original', class_mapping=self.class_mapping)
-        self.class_mapping = class_mapping
+        if not self.preprocessed:
+            label_slice = self.label_mapper.map(label_slice, self.nr_of_classes) # uint8
+        if self.compact_samples:
+            # quantize augmented slices back to uint8 so that every sample of a batch has the same dtype
+            feature_slice = np.clip(np.rint(feature_slice * 255.0), 0, 255).astype(np.uint8)
+            label_slice = label_slice.astype(np.uint8)
 
         feature_slice = torch.from_numpy(feature_slice)
         label_slice = torch.from_numpy(label_slice)
@@ -262,7 +438,7 @@ class HDF5Dataset(Dataset):
         feature_slice = feature_slice.unsqueeze(dim=0)
         label_slice = label_slice.unsqueeze(dim=0)
 
-        if self.pretrained:
+        if self.pretrained and not self.compact_samples:
             feature_slice = feature_slice.repeat((3, 1, 1)) # pretrained segformer takes 3-channel images as input
 
         return (feature_slice, label_slice)
@@ -276,6 +452,195 @@ class HDF5Dataset(Dataset):
         """
         return self.filtered_matrix.shape[0]
 
+class PreprocessedHDF5Dataset(HDF5Dataset):
+    """
+    A class representing the KWYK dataset read from the pre-processed shards written by
+    scripts/preprocess_kwyk_shards.py, in which the features are already skull stripped and the labels are
+    already mapped to nr_of_classes and stored as uint8. Uses the same slice filtering and splits as HDF5Dataset.
+    """
+
+    def __init__(self, mode:str, config):
+        """
+        Initializes a new PreprocessedHDF5Dataset for the specified mode and config.
+
+        Args:
+            mode (str): Either 'train', 'validation', or 'test' to specify which dataset.
+            config (TissueLabeling.config.Configuration): contains the parameters specified at the start of this run.
+        """
+        super().__init__(mode, config)
+        manifest = ShardManifest.load(config.preprocessed_h5_dir)
+        if manifest.n_vols != self.manifest.n_vols:
+            raise Exception(f"{config.preprocessed_h5_dir} does not contain the same volumes as {config.h5_dir}")
+        shard_nr_of_classes = {shard.get('nr_of_classes') for shard in manifest.shards}
+        if shard_nr_of_classes != {self.nr_of_classes}:
+            raise Exception(f"{config.preprocessed_h5_dir} was pre-processed for {shard_nr_of_classes} classes, not {self.nr_of_classes}")
+        if self.aug_null_half:
+            raise Exception("null half augmentation requires the original freesurfer labels, use the unprocessed shards")
+
+        self.manifest = manifest
+        self.h5_file_paths = manifest.shard_paths
+        if config.use_vds:
+            self._set_virtual_dataset()
+        self.preprocessed = True
+
+class MemmapSliceDataset(HDF5Dataset):
+    """
+    A class representing the KWYK dataset read from the uncompressed, memory-mapped slice store written by
+    scripts/convert_kwyk_memmap.py. Uses the same slice filtering, splits and augmentations as HDF5Dataset,
+    but each slice is a page-aligned view into a memory-mapped file, so reading it needs no decompression.
+    """
+
+    def __init__(self, mode:str, config):
+        """
+        Initializes a new MemmapSliceDataset for the specified mode and config.
+
+        Args:
+            mode (str): Either 'train', 'validation', or 'test' to specify which dataset.
+            config (TissueLabeling.config.Configuration): contains the parameters specified at the start of this run.
+        """
+        super().__init__(mode, config)
+        self.memmap_dir = config.memmap_dir
+        self.memmap_meta, self.vol_offsets = read_meta(self.memmap_dir)
+        self.memmap_store = None # opened lazily in each process like the HDF5 handles
+
+        # labels in the store are already mapped to the 'index' column of class_mapping.csv (uint8)
+        self.label_reference_col = self.memmap_meta['label_column']
+        self._set_label_mapper()
+
+    def __getstate__(self):
+        """
+        Drops the memory maps when the dataset is pickled so they are not copied into spawned workers.
+
+        Returns:
+            state (dict): the picklable state of the dataset
+        """
+        state = super().__getstate__()
+        state['memmap_store'] = None
+        return state
+
+    def close(self):
+        """
+        Releases the memory maps opened by the current process.
+        """
+        super().close()
+        self.memmap_store = None
+
+    def __getitem__(self, index):
+        """
+        Gets the slice at the corresponding index.
+
+        Args:
+            index (int): index of slice to get
+        
+        Returns:
+            feature_slice (torch.tensor): the MRI slices of size [1,h,w]
+            label_slice (torch.tensor): the corresponding label slice of size [1,h,w] where freesurfer labels 
+                                        have been mapped to the config.nr_of_classes
+        """
+        if self.memmap_store is None:
+            self.memmap_store = open_store(self.memmap_dir, self.memmap_meta)
+        shard_idx, shard_vol_idx, axis, slice_idx = unpack_slice_rows(self.filtered_matrix[index], self.manifest)[0]
+        row = get_row(self.memmap_meta, self.vol_offsets, shard_idx, shard_vol_idx, axis, slice_idx)
+        feature_slice = get_slice(self.memmap_store, self.memmap_meta, 'features', axis, row)
+        label_slice = get_slice(self.memmap_store, self.memmap_meta, 'labels', axis, row)
+        return self._prepare_sample(feature_slice, label_slice)
+
+    def __getitems__(self, indices):
+        """
+        Gets the slices at the corresponding indices. Reads from the memory maps are cheap, so this
+        simply gets each slice in turn.
+
+        Args:
+            indices (list): indices of the slices to get
+        
+        Returns:
+            list: a (feature_slice, label_slice) tuple for each index, as returned by __getitem__
+        """
+        return [self[index] for index in indices]
+
+class SharedMemoryDataset(HDF5Dataset):
+    """
+    A class representing the filtered KWYK slices of a split held in RAM. On first use, the slices are read
+    from the shards once per node into a shared-memory segment (see shared_slices.py), to which all
+    DataLoader workers and all ranks on the node attach read-only. Uses the same slice filtering, splits
+    and augmentations as HDF5Dataset.
+    """
+
+    def __init__(self, mode:str, config):
+        """
+        Initializes a new SharedMemoryDataset for the specified mode and config.
+
+        Args:
+            mode (str): Either 'train', 'validation', or 'test' to specify which dataset.
+            config (TissueLabeling.config.Configuration): contains the parameters specified at the start of this run.
+        """
+        super().__init__(mode, config)
+        self.shm_dir = config.shm_dir
+        # named after the shards themselves, also when they are read through their virtual dataset
+        self.shm_key = get_segment_key(self.mode, ShardManifest.load(config.h5_dir), self.filtered_matrix)
+        self.shm_meta = materialize_segment(self.shm_dir, self.shm_key, self.filtered_matrix, self.manifest)
+        self.shm_features = None # attached lazily in each process like the HDF5 handles
+        self.shm_labels = None
+
+        # labels in the segment are already mapped to the 'index' column of class_mapping.csv (uint8)
+        self.label_reference_col = self.shm_meta['label_column']
+        self._set_label_mapper()
+
+    def __getstate__(self):
+        """
+        Detaches from the shared-memory segment when the dataset is pickled. The segment stays in shm_dir
+        and every spawned worker attaches to it again on first access.
+
+        Returns:
+            state (dict): the picklable state of the dataset
+        """
+        state = super().__getstate__()
+        state['shm_features'] = None
+        state['shm_labels'] = None
+        return state
+
+    def close(self):
+        """
+        Releases the memory maps opened by the current process.
+        """
+        super().close()
+        self.shm_features = None
+        self.shm_labels = None
+
+    def __getitem__(self, index):
+        """
+        Gets the slice at the corresponding index.
+
+        Args:
+            index (int): index of slice to get
+        
+        Returns:
+            feature_slice (torch.tensor): the MRI slices of size [1,h,w]
+            label_slice (torch.tensor): the corresponding label slice of size [1,h,w] where freesurfer labels 
+                                        have been mapped to the config.nr_of_classes
+        """
+        if self.shm_features is None:
+            self.shm_features, self.shm_labels = attach_segment(self.shm_dir, self.shm_key, self.shm_meta)
+        return self._prepare_sample(self.shm_features[index], self.shm_labels[index])
+
+    def __getitems__(self, indices):
+        """
+        Gets the slices at the corresponding indices. The slices of the segment are stored in the order of
+        the split, so the whole batch is gathered from the segment with one fancy-indexing copy.
+
+        Args:
+            indices (list): indices of the slices to get
+        
+        Returns:
+            list: a (feature_slice, label_slice) tuple for each index, as returned by __getitem__
+        """
+        if self.shm_features is None:
+            self.shm_features, self.shm_labels = attach_segment(self.shm_dir, self.shm_key, self.shm_meta)
+        indices = np.asarray(indices)
+        feature_slices = self.shm_features[indices]
+        label_slices = self.shm_labels[indices]
+        return [self._prepare_sample(feature_slice, label_slice) for feature_slice, label_slice in zip(feature_slices, label_slices)]
+
 class NoBrainerDataset(Dataset):
     """
     A class reprsenting KWYK dataset slices stored as .npy files.
@@ -301,6 +666,9 @@ class NoBrainerDataset(Dataset):
         self.mode = mode
 
         # store relevant config parameters
+        if config.compact_samples:
+            raise Exception("compact_samples is only supported for the HDF5 and memory-mapped datasets")
+
         self.model_name = config.model_name
         self.nr_of_classes = config.nr_of_classes
         self.data_size = config.data_size
@@ -308,6 +676,16 @@ class NoBrainerDataset(Dataset):
         self.pad_old_data = config.pad_old_data
         self.use_norm_consts = config.use_norm_consts
 
+        # read the slices from the files packed by scripts/pack_nobrainer_slices.py instead of the .npy files
+        self.packed = bool(config.packed_data_dir)
+
+        # decoded slices on node-local disk, shared by all jobs on the node (see slice_cache.py)
+        self.slice_cache = SliceCache(config.slice_cache_dir, config.slice_cache_bytes) if config.slice_cache_dir else None
+        # packed slices are keyed by their position, namespaced by the manifest of the packed files
+        self.slice_cache_namespace = (
+            get_file_namespace(os.path.join(config.packed_data_dir, mode, MANIFEST_FILE)) if self.packed and self.slice_cache is not None else None
+        )
+
         self.new_kwyk_data = config.new_kwyk_data
         if self.new_kwyk_data:
         #     background_percent_cutoff = config.background_percent_cutoff # 0.99
@@ -366,8 +744,11 @@ class NoBrainerDataset(Dataset):
         #     self.images = shuffled_images[:num_files]
         #     self.masks = shuffled_masks[:num_files]
 
-            self.images = sorted(glob.glob(f"{config.data_dir}/{mode}/features/*orig*"))
-            self.masks = sorted(glob.glob(f"{config.data_dir}/{mode}/labels/*aseg*"))
+            if self.packed:
+                self.images, self.masks = self._get_packed_slices(config.packed_data_dir, mode)
+            else:
+                self.images = sorted(glob.glob(f"{config.data_dir}/{mode}/features/*orig*"))
+                self.masks = sorted(glob.glob(f"{config.data_dir}/{mode}/labels/*aseg*"))
 
             # correspond to exact same dataset size as Matthias's
             if config.data_size == "small":
@@ -378,6 +759,8 @@ class NoBrainerDataset(Dataset):
                 num_files = len(self.images)
             self.images = self.images[:num_files]
             self.masks = self.masks[:num_files]
+        elif self.packed:
+            self.images, self.masks = self._get_packed_slices(config.packed_data_dir, mode)
         else:
             # Get a list of all the brain image files in the specified directory
             self.images = sorted(glob.glob(f"{config.data_dir}/{mode}/brain*.npy"))
@@ -473,6 +856,54 @@ class NoBrainerDataset(Dataset):
             print('will NOT pad')
 
 
+    def _get_packed_slices(self, packed_data_dir: str, mode: str):
+        """
+        Opens the packed images and masks of a mode.
+
+        Args:
+            packed_data_dir (str): the directory the packed files were written to
+            mode (str): 'train', 'validation', or 'test'
+
+        Returns:
+            images (PackedSlices): the MRI slices, in the sorted order of the original files
+            masks (PackedSlices): the corresponding label slices
+        """
+        images = PackedSlices(os.path.join(packed_data_dir, mode), "images")
+        masks = PackedSlices(os.path.join(packed_data_dir, mode), "masks")
+        if len(images) != len(masks):
+            raise Exception(f"{packed_data_dir}/{mode} has {len(images)} images but {len(masks)} masks")
+        return images, masks
+
+    def _load_slice(self, idx):
+        """
+        Loads the slice at the corresponding index from the .npy files or the packed files.
+
+        Args:
+            idx (int): index of slice to get
+
+        Returns:
+            image (np.array): the MRI slice at index
+            mask (np.array): the corresponding label slice
+        """
+        if self.packed:
+            return self.images[idx], self.masks[idx]
+        return np.load(self.images[idx]), np.load(self.masks[idx])
+
+    def _get_slice_cache_key(self, idx):
+        """
+        Gets the key of the slice at the corresponding index in the slice cache, made from the identities (path, size,
+        mtime) of its files so that rewritten files are not served from stale entries.
+
+        Args:
+            idx (int): index of slice to get
+
+        Returns:
+            tuple: the key of the slice
+        """
+        if self.packed:
+            return ("packed", self.slice_cache_namespace, idx)
+        return ("npy", get_file_namespace(self.images[idx]), get_file_namespace(self.masks[idx]))
+
     def __getitem__(self, idx):
         """
         Gets the slice at the corresponding index.
@@ -485,8 +916,13 @@ class NoBrainerDataset(Dataset):
             mask (torch.tensor): the corresponding label slice of size [1,h,w] where freesurfer labels 
                                         have been mapped to the config.nr_of_classes
         """
-        image = torch.from_numpy(np.load(self.images[idx]).astype(np.float32))
-        mask = torch.from_numpy(np.load(self.masks[idx]).astype(np.int16))
+        if self.slice_cache is not None:
+            # node-local copy of the slice, read from the network filesystem only by the first process on the node to need it
+            image, mask = self.slice_cache.get(self._get_slice_cache_key(idx), lambda: self._load_slice(idx))
+        else:
+            image, mask = self._load_slice(idx)
+        image = torch.from_numpy(image.astype(np.float32))
+        mask = torch.from_numpy(mask.astype(np.int16))
 
         if not self.new_kwyk_data:
             if not self.use_norm_consts:
@@ -572,18 +1008,46 @@ class NoBrainerDataset(Dataset):
             int: the number of slices in the dataset
         """
         return len(self.images)
-    
+
+
+def worker_init_fn(worker_id):
+    """
+    Initializes a DataLoader worker process: gives it its own seeded python/numpy random streams
+    and makes sure it opens its own HDF5 shard handles instead of reusing the parent's.
+
+    torch already seeds python's random and torch in each worker with base_seed + worker_id, but numpy
+    (used by albumentations and the background augmentations) would otherwise produce the same stream
+    in every forked worker.
+
+    Args:
+        worker_id (int): the id of the worker within its DataLoader
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    worker_seed = worker_info.seed % 2**32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+
+    dataset = worker_info.dataset
+    if isinstance(dataset, HDF5Dataset):
+        # drop any handles inherited through fork; they are reopened on the first __getitem__
+        dataset.h5_pointers = None
+        dataset.h5_pointers_pid = None
+        dataset.read_ahead_buffer = None
+    if isinstance(dataset, MemmapSliceDataset):
+        dataset.memmap_store = None
+
 
 def get_data_loader(
     # data_dir: str,
     config,
-    num_workers: int = 4 * torch.cuda.device_count(),
+    num_workers: int = None,
 ):
     """
     Returns the PyTorch dataloaders for the datasets created based on the parameters specified in config.
 
     Args:
         config (TissueLabeling.config.Configuration): contains the parameters specified at the start of this run.
+        num_workers (int | None): (optional) the number of DataLoader worker processes; defaults to config.num_workers.
     
     Returns:
         train_loader (torch.utils.data.DataLoader): the PyTorch Dataloader for the training split of data
@@ -594,19 +1058,58 @@ def get_data_loader(
 
     # whether to use the new dataset (256x256 slices) or old dataset created by Matthias (162x194 slices)
     if config.new_kwyk_data != 0:
-        train_dataset = HDF5Dataset(mode='train',config=config)
-        val_dataset = HDF5Dataset(mode='validation',config=config)
-        test_dataset = HDF5Dataset(mode='test',config=config)
+        # read the uncompressed memory-mapped store instead of the gzip HDF5 shards if one is specified,
+        # the node-wide shared-memory copy of the filtered slices if requested,
+        # or the shards pre-processed for config.nr_of_classes if specified
+        dataset_class = (
+            MemmapSliceDataset if config.memmap_dir
+            else SharedMemoryDataset if config.shm_dir
+            else PreprocessedHDF5Dataset if config.preprocessed_h5_dir
+            else HDF5Dataset
+        )
+        train_dataset = dataset_class(mode='train',config=config)
+        val_dataset = dataset_class(mode='validation',config=config)
+        test_dataset = dataset_class(mode='test',config=config)
     else:
         train_dataset = NoBrainerDataset("train", config)
         val_dataset = NoBrainerDataset("validation", config)
         test_dataset = NoBrainerDataset("test", config)
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=config.batch_size, shuffle=True
-    )
-    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=config.batch_size)
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset, batch_size=config.batch_size
-    )
-
-    return train_loader, val_loader, test_loader, tuple(train_dataset[0][0].shape[1:])
+    image_dims = tuple(train_dataset[0][0].shape[1:])
+    if isinstance(train_dataset, HDF5Dataset):
+        train_dataset.close() # don't leave handles open in the main process before the workers fork
+
+    num_workers = config.num_workers if num_workers is None else num_workers
+    loader_kwargs = {
+        'batch_size': config.batch_size,
+        'num_workers': num_workers,
+        'worker_init_fn': worker_init_fn,
+    }
+    if num_workers > 0:
+        # only valid with worker processes
+        loader_kwargs['prefetch_factor'] = config.prefetch_factor
+        loader_kwargs['persistent_workers'] = bool(config.persistent_workers)
+
+    if config.sampler == 'block' and isinstance(train_dataset, HDF5Dataset):
+        # locality-aware shuffling that also splits the data across DDP ranks
+        train_sampler = BlockShuffleSampler(train_dataset.filtered_matrix, buffer_size=config.shuffle_buffer_size, seed=config.seed)
+        train_loader = torch.utils.data.DataLoader(train_dataset, sampler=train_sampler, **loader_kwargs)
+    elif config.sampler == 'shard' and isinstance(train_dataset, HDF5Dataset):
+        # disjoint, rotating runs of volumes per DDP rank and per worker, so each process reads only a few shards
+        train_sampler = ShardAffineSampler(
+            train_dataset.filtered_matrix, config.batch_size, num_workers=num_workers, buffer_size=config.shuffle_buffer_size, seed=config.seed
+        )
+        train_loader = torch.utils.data.DataLoader(train_dataset, sampler=train_sampler, **loader_kwargs)
+    elif config.sampler == 'balanced' and isinstance(train_dataset, HDF5Dataset):
+        # oversample slices with rare classes, a fixed number of draws per epoch split across DDP ranks
+        presence_bits = load_split_presence(config.class_counts_dir, train_dataset.filtered_matrix, ShardManifest.load(config.h5_dir))
+        weights = get_class_balanced_weights(presence_bits, config.nr_of_classes, temperature=config.sampler_temperature)
+        train_sampler = ClassBalancedSampler(weights, num_samples=config.epoch_num_samples, seed=config.seed)
+        train_loader = torch.utils.data.DataLoader(train_dataset, sampler=train_sampler, **loader_kwargs)
+    else:
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, shuffle=True, generator=torch.Generator().manual_seed(config.seed), **loader_kwargs
+        )
+    val_loader = torch.utils.data.DataLoader(val_dataset, **loader_kwargs)
+    test_loader = torch.utils.data.DataLoader(test_dataset, **loader_kwargs)
+
+    return train_loader, val_loader, test_loader, image_dims
@@ -0,0 +1,418 @@
+"""
+File: hdf5_io.py
+Author: Sabeen Lohawala
+Date: 2024-05-20
+Description: This file contains helper functions for reading slices from the KWYK HDF5 shards.
+"""
+
+import math
+from collections import OrderedDict
+
+import h5py as h5
+import numpy as np
+from h5py import h5s
+
+try:
+    # registers the blosc/lz4/zstd filters with HDF5 so shards written with them can be read
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+CODECS = ["none", "lzf", "gzip", "blosc-lz4", "blosc-zstd", "lz4", "zstd"]
+# 'axis': each volume is stored three times, in features_axis{0,1,2}/labels_axis{0,1,2} chunked for one slicing direction each
+# 'cubic': each volume is stored once, in features/labels with cubic chunks
+LAYOUTS = ["axis", "cubic"]
+
+
+def get_layout_kwargs(layout: str = "axis", chunk_size: int = 64) -> dict:
+    """
+    Gets the names and chunk shapes of the datasets of a [N_vols, 256, 256, 256] shard layout.
+
+    Args:
+        layout (str): one of LAYOUTS
+        chunk_size (int): edge length of the chunks of the 'cubic' layout (e.g. 32 or 64)
+
+    Returns:
+        dict: maps each dataset suffix ('_axis0', '_axis1', '_axis2' or '') to its chunk shape
+
+    Throws:
+        ValueError if the layout is unknown
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"{layout} is not a valid layout. Choose from {LAYOUTS}.")
+    if layout == "cubic":
+        return {"": (1, chunk_size, chunk_size, chunk_size)}
+    return {"_axis0": (1, 1, 256, 256), "_axis1": (1, 256, 1, 256), "_axis2": (1, 256, 256, 1)}
+
+
+def get_shard_dataset(h5_file, kind: str, axis: int = 0):
+    """
+    Gets the dataset of a shard to read slices along axis from, for either layout.
+
+    Args:
+        h5_file (h5py.File): the open shard
+        kind (str): 'features' or 'labels'
+        axis (int): the axis (0, 1, or 2) along which slices will be taken
+
+    Returns:
+        h5py.Dataset: the [N_vols, H, W, D] dataset
+    """
+    if kind in h5_file: # cubic layout, one dataset serves all axes
+        return h5_file[kind]
+    return h5_file[f"{kind}_axis{axis}"]
+
+
+def get_compression_kwargs(codec: str = "gzip", level: int = None) -> dict:
+    """
+    Gets the h5py create_dataset keyword arguments for a compression codec.
+
+    Args:
+        codec (str): one of CODECS; the blosc, lz4, and zstd codecs require hdf5plugin
+        level (int | None): (optional) compression level for gzip (0-9), blosc (0-9), and zstd (1-22);
+                            uses the codec default if None
+
+    Returns:
+        dict: keyword arguments to pass to h5py.Group.create_dataset
+
+    Throws:
+        ValueError if the codec is unknown
+        ImportError if the codec requires hdf5plugin and it is not installed
+    """
+    if codec not in CODECS:
+        raise ValueError(f"{codec} is not a valid codec. Choose from {CODECS}.")
+    if codec == "none":
+        return {}
+    if codec == "lzf":
+        return {"compression": "lzf"}
+    if codec == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if level is None else level}
+
+    if hdf5plugin is None:
+        raise ImportError(f"codec {codec} requires hdf5plugin (pip install hdf5plugin)")
+    if codec.startswith("blosc"):
+        return dict(
+            hdf5plugin.Blosc(
+                cname=codec.split("-")[1],
+                clevel=5 if level is None else level,
+                shuffle=hdf5plugin.Blosc.SHUFFLE,
+            )
+        )
+    if codec == "lz4":
+        return dict(hdf5plugin.LZ4())
+    return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+
+
+def read_slices(dataset, vol_indices, slice_indices, axis: int, region=None) -> np.array:
+    """
+    Reads several slices taken along the same axis from a [N_vols, H, W, D] HDF5 dataset with a single
+    read call over the union of their hyperslabs, so HDF5 visits each chunk in file order only once.
+
+    Args:
+        dataset (h5py.Dataset): a features or labels dataset of a shard, see get_shard_dataset
+        vol_indices (array-like): the index of the volume within the shard for each slice
+        slice_indices (array-like): the index of the slice along axis for each slice
+        axis (int): the axis (0, 1, or 2) of the volume along which the slices are taken
+        region (tuple | None): (optional) (row_min, row_max, col_min, col_max), inclusive, to read only that
+                               rectangle of every slice
+
+    Returns:
+        slices (np.array): array of shape [n, ...] containing the slices (or their region) in the same order
+                           as the inputs
+    """
+    keys = np.stack([np.asarray(vol_indices), np.asarray(slice_indices)], axis=1).astype(np.int64)
+    # sorted by (volume, slice) and deduplicated, which is the order HDF5 returns the selection in
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    # start and size of the selection of a slice along the three volume dimensions
+    vol_shape = list(dataset.shape[1:])
+    slice_start, slice_count = [0, 0, 0], list(vol_shape)
+    if region is not None:
+        row_min, row_max, col_min, col_max = (int(x) for x in region)
+        other_dims = [dim for dim in range(3) if dim != axis]
+        slice_start[other_dims[0]], slice_count[other_dims[0]] = row_min, row_max - row_min + 1
+        slice_start[other_dims[1]], slice_count[other_dims[1]] = col_min, col_max - col_min + 1
+    slice_count[axis] = 1
+    slice_shape = tuple(dim for i, dim in enumerate(slice_count) if i != axis)
+    slice_size = math.prod(slice_shape)
+
+    file_space = dataset.id.get_space()
+    for i, (vol_idx, slice_idx) in enumerate(unique_keys):
+        start = [int(vol_idx), *slice_start]
+        start[axis + 1] = int(slice_idx)
+        file_space.select_hyperslab(
+            tuple(start), (1, *slice_count), op=h5s.SELECT_SET if i == 0 else h5s.SELECT_OR
+        )
+
+    buffer = np.empty(len(unique_keys) * slice_size, dtype=dataset.dtype)
+    mem_space = h5s.create_simple(buffer.shape)
+    dataset.id.read(mem_space, file_space, buffer)
+
+    # the selection comes back in row-major file order, i.e. one block per volume in which
+    # the selected slices are interleaved along axis
+    slices = np.empty((len(unique_keys), *slice_shape), dtype=dataset.dtype)
+    _, vol_counts = np.unique(unique_keys[:, 0], return_counts=True)
+    offset, row = 0, 0
+    for count in vol_counts:
+        block_shape = list(slice_count)
+        block_shape[axis] = count
+        block = buffer[offset : offset + count * slice_size].reshape(block_shape)
+        slices[row : row + count] = np.moveaxis(block, axis, 0)
+        offset += count * slice_size
+        row += count
+
+    return slices[inverse]
+
+
+def read_slices_roi(dataset, vol_indices, slice_indices, axis: int, bboxes, margin: int = 0) -> np.array:
+    """
+    Reads several slices like read_slice_roi, with one read call (see read_slices) over the rectangle that
+    contains the bounding boxes of all of them.
+
+    Args:
+        dataset (h5py.Dataset): a features or labels dataset of a shard, see get_shard_dataset
+        vol_indices (array-like): the index of the volume within the shard for each slice
+        slice_indices (array-like): the index of the slice along axis for each slice
+        axis (int): the axis (0, 1, or 2) of the volume along which the slices are taken
+        bboxes (np.array): array of shape [n, 4] with the bounding box of each slice, see read_slice_roi
+        margin (int): number of pixels added on every side of the bounding boxes
+
+    Returns:
+        np.array: array of shape [n, ...] containing the slices, each 0 outside of its bounding box and margin
+    """
+    slice_shape = [dim for i, dim in enumerate(dataset.shape[1:]) if i != axis]
+    canvas = np.zeros((len(bboxes), *slice_shape), dtype=dataset.dtype)
+    bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+    tissue = (bboxes[:, 1] >= bboxes[:, 0]) & (bboxes[:, 3] >= bboxes[:, 2])
+    if not tissue.any():
+        return canvas # no tissue in any of the slices
+    lows = np.maximum(bboxes[:, [0, 2]] - margin, 0)
+    highs = np.minimum(bboxes[:, [1, 3]] + margin, np.array(slice_shape) - 1)
+    region = (lows[tissue, 0].min(), highs[tissue, 0].max(), lows[tissue, 1].min(), highs[tissue, 1].max())
+
+    slices = read_slices(dataset, np.asarray(vol_indices)[tissue], np.asarray(slice_indices)[tissue], axis, region)
+    for slice_, i in zip(slices, np.flatnonzero(tissue)):
+        # keep only the bounding box (and margin) of the slice itself, as read_slice_roi does
+        rows = slice(lows[i, 0] - region[0], highs[i, 0] - region[0] + 1)
+        cols = slice(lows[i, 1] - region[2], highs[i, 1] - region[2] + 1)
+        canvas[i, lows[i, 0] : highs[i, 0] + 1, lows[i, 1] : highs[i, 1] + 1] = slice_[rows, cols]
+    return canvas
+
+
+def open_shard(
+    h5_path: str,
+    rdcc_nbytes: int = None,
+    rdcc_nslots: int = None,
+    rdcc_w0: float = None,
+    page_buf_size: int = None,
+):
+    """
+    Opens a KWYK shard read-only with the specified HDF5 chunk cache and page buffer settings.
+    Settings that are None (or 0 for page_buf_size) keep the h5py defaults.
+
+    Args:
+        h5_path (str): path to the shard
+        rdcc_nbytes (int | None): size in bytes of the raw data chunk cache of each dataset (h5py default is 1 MB)
+        rdcc_nslots (int | None): number of hash table slots of the chunk cache, ideally a prime ~100x the
+                                  number of chunks that fit in rdcc_nbytes
+        rdcc_w0 (float | None): eviction preference (0 to 1) for chunks that have been fully read
+        page_buf_size (int | None): size in bytes of the page buffer; requires that the shard was written with
+                                    the "page" file space strategy
+
+    Returns:
+        h5py.File: the open shard
+    """
+    kwargs = {}
+    if rdcc_nbytes is not None:
+        kwargs["rdcc_nbytes"] = rdcc_nbytes
+    if rdcc_nslots is not None:
+        kwargs["rdcc_nslots"] = rdcc_nslots
+    if rdcc_w0 is not None:
+        kwargs["rdcc_w0"] = rdcc_w0
+    if page_buf_size:
+        kwargs["page_buf_size"] = page_buf_size
+    return h5.File(h5_path, "r", **kwargs)
+
+
+class ShardHandles:
+    """
+    The read-only handles of a list of shards, each opened on first access, so that a process only holds
+    handles (and chunk caches) for the shards it actually reads, e.g. with a ShardAffineSampler.
+    """
+
+    def __init__(self, h5_paths: list, **open_kwargs):
+        """
+        Constructor.
+
+        Args:
+            h5_paths (list): paths to the shards
+            open_kwargs: chunk cache and page buffer settings passed to open_shard
+        """
+        self.h5_paths = h5_paths
+        self.open_kwargs = open_kwargs
+        self.handles = [None] * len(h5_paths)
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __getitem__(self, shard_idx: int):
+        shard_idx = int(shard_idx)
+        if self.handles[shard_idx] is None:
+            self.handles[shard_idx] = open_shard(self.h5_paths[shard_idx], **self.open_kwargs)
+        return self.handles[shard_idx]
+
+    def close(self):
+        """
+        Closes the shards that have been opened.
+        """
+        for f in self.handles:
+            if f is not None:
+                f.close()
+        self.handles = [None] * len(self.h5_paths)
+
+
+def read_slice_block(dataset, vol_idx: int, start: int, stop: int, axis: int) -> np.array:
+    """
+    Reads the consecutive slices start, ..., stop - 1 along axis of one volume.
+
+    Args:
+        dataset (h5py.Dataset): a features or labels dataset of a shard, see get_shard_dataset
+        vol_idx (int): the index of the volume within the shard
+        start (int): index of the first slice to read
+        stop (int): index after the last slice to read
+        axis (int): the axis (0, 1, or 2) of the volume along which the slices are taken
+
+    Returns:
+        np.array: array of shape [stop - start, ...] containing the slices
+    """
+    indices = [int(vol_idx), slice(None), slice(None)]
+    indices.insert(axis + 1, slice(int(start), int(stop)))
+    return np.moveaxis(dataset[tuple(indices)], axis, 0)
+
+
+def read_slice_roi(dataset, vol_idx: int, axis: int, slice_idx: int, bbox, margin: int = 0) -> np.array:
+    """
+    Reads only the region of a slice inside a bounding box (plus a margin) and pads it with 0s to the full
+    slice. Only the chunks that intersect the region are read and decompressed, which for the 'cubic' layout
+    is a fraction of the chunks of the slice.
+
+    Args:
+        dataset (h5py.Dataset): a features or labels dataset of a shard, see get_shard_dataset
+        vol_idx (int): the index of the volume within the shard
+        axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+        slice_idx (int): the index of the slice along axis
+        bbox (array-like): (row_min, row_max, col_min, col_max) in the coordinates of the slice, with
+                           row_max < row_min for an empty slice (see TissueLabeling.data.slice_stats)
+        margin (int): number of pixels added on every side of the bounding box
+
+    Returns:
+        np.array: the slice, 0 outside of the bounding box and margin
+    """
+    slice_shape = [dim for i, dim in enumerate(dataset.shape[1:]) if i != axis]
+    canvas = np.zeros(slice_shape, dtype=dataset.dtype)
+    row_min, row_max, col_min, col_max = (int(x) for x in bbox)
+    if row_max < row_min or col_max < col_min:
+        return canvas # no tissue in the slice
+    row_min, col_min = max(row_min - margin, 0), max(col_min - margin, 0)
+    row_max, col_max = min(row_max + margin, slice_shape[0] - 1), min(col_max + margin, slice_shape[1] - 1)
+
+    indices = [int(vol_idx), slice(row_min, row_max + 1), slice(col_min, col_max + 1)]
+    indices.insert(axis + 1, int(slice_idx))
+    canvas[row_min : row_max + 1, col_min : col_max + 1] = dataset[tuple(indices)]
+    return canvas
+
+
+def read_chunk_row(dataset, vol_idx: int, axis: int, slice_idx: int):
+    """
+    Reads the row of chunks that a slice crosses, i.e. the chunk-aligned block of consecutive slices along
+    axis that contains it. Every chunk of the row is decompressed exactly once, so for the 'cubic' layout
+    the block serves all chunk_size slices of the row (one slice of the 'axis' layout is its own row).
+
+    Args:
+        dataset (h5py.Dataset): a features or labels dataset of a shard, see get_shard_dataset
+        vol_idx (int): the index of the volume within the shard
+        axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+        slice_idx (int): the index of the slice along axis
+
+    Returns:
+        block (np.array): array of shape [chunk thickness along axis, ...] containing the slices of the row
+        offset (int): the index of the slice within block
+    """
+    thickness = dataset.chunks[axis + 1] if dataset.chunks else 1
+    start = int(slice_idx) // thickness * thickness
+    stop = min(start + thickness, dataset.shape[axis + 1])
+    return read_slice_block(dataset, vol_idx, start, stop, axis), int(slice_idx) - start
+
+
+class ReadAheadBuffer:
+    """
+    Keeps recently read blocks of neighbouring slices of the same volume and axis in memory, so that
+    consecutive requests for nearby slices (e.g. from a locality-aware sampler) are served without
+    another HDF5 read. For shards with the 'cubic' layout, a block_size that is a multiple of the chunk size
+    makes every block a whole number of chunk rows.
+    """
+
+    def __init__(self, block_size: int, max_blocks: int = 8):
+        """
+        Constructor.
+
+        Args:
+            block_size (int): number of slices read at once; blocks are aligned to multiples of block_size.
+                              -1 reads the chunk row of each slice (see read_chunk_row), so every chunk of
+                              a 'cubic' shard is decoded once for all the slices it holds
+            max_blocks (int): number of blocks kept in memory, least recently used blocks are dropped first
+        """
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict() # (shard_idx, vol_idx, axis, block_idx) -> (features, labels)
+        self.chunk_thickness = {} # (shard_idx, axis) -> chunk size along axis, for block_size -1
+
+    def _get_chunk_thickness(self, h5_file, shard_idx: int, axis: int) -> int:
+        key = (int(shard_idx), int(axis))
+        if key not in self.chunk_thickness:
+            dataset = get_shard_dataset(h5_file, "features", axis)
+            self.chunk_thickness[key] = dataset.chunks[axis + 1] if dataset.chunks else 1
+        return self.chunk_thickness[key]
+
+    def get(self, h5_file, shard_idx: int, vol_idx: int, axis: int, slice_idx: int):
+        """
+        Gets a slice and its label slice, reading the aligned block around it on a miss.
+
+        Args:
+            h5_file (h5py.File): the open shard containing the slice
+            shard_idx (int): the index of the shard, used as part of the cache key
+            vol_idx (int): the index of the volume within the shard
+            axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+            slice_idx (int): the index of the slice along axis
+
+        Returns:
+            feature_slice (np.array): the feature slice
+            label_slice (np.array): the corresponding label slice
+        """
+        block_size = self.block_size if self.block_size > 0 else self._get_chunk_thickness(h5_file, shard_idx, axis)
+        block_idx = int(slice_idx) // block_size
+        key = (int(shard_idx), int(vol_idx), int(axis), block_idx)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+        else:
+            feature_ds = get_shard_dataset(h5_file, "features", axis)
+            label_ds = get_shard_dataset(h5_file, "labels", axis)
+            if self.block_size > 0:
+                n_slices = feature_ds.shape[axis + 1]
+                start = block_idx * block_size
+                stop = min(start + block_size, n_slices)
+                self.blocks[key] = (
+                    read_slice_block(feature_ds, vol_idx, start, stop, axis),
+                    read_slice_block(label_ds, vol_idx, start, stop, axis),
+                )
+            else:
+                self.blocks[key] = (
+                    read_chunk_row(feature_ds, vol_idx, axis, slice_idx)[0],
+                    read_chunk_row(label_ds, vol_idx, axis, slice_idx)[0],
+                )
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+        features, labels = self.blocks[key]
+        offset = int(slice_idx) - block_idx * block_size
+        return features[offset], labels[offset]
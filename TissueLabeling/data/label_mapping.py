@@ -0,0 +1,122 @@
+"""
+File: label_mapping.py
+Author: Sabeen Lohawala
+Date: 2024-05-27
+Description: This file contains the LabelMapper class, which compiles class_mapping.csv into dense lookup tables
+once per process: a uint8 table for each class scheme (2, 6, 16, 50, or 106 classes) and boolean tables for
+the right hemisphere, left hemisphere, and cerebellum/brain stem labels. Mapping a slice or a whole batch is
+then a single indexing operation instead of a loop over the classes.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import torch
+
+CLASS_MAPPING_FILE = "/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv"
+N_LABELS = 2**16 # size of the tables, enough for any uint16 label
+
+
+def apply_lut(lut, mask):
+    """
+    Looks up every label of mask in a table.
+
+    Args:
+        lut (np.array | torch.tensor): the table, indexed by label
+        mask (np.array | torch.tensor): labels of any shape; a torch mask requires a torch table on the same device
+
+    Returns:
+        np.array | torch.tensor: the table values, with the shape of mask and the dtype of lut
+    """
+    if isinstance(mask, torch.Tensor):
+        return lut[mask.long()]
+    mask = np.asarray(mask)
+    if not np.issubdtype(mask.dtype, np.integer): # e.g. masks returned as float by an augmentation
+        mask = mask.astype(np.int64)
+    return lut[mask]
+
+
+class LabelMapper:
+    """
+    A class holding the lookup tables of class_mapping.csv for labels stored in one of its columns.
+    """
+
+    def __init__(self, reference_col: str = "original", class_mapping_file: str = CLASS_MAPPING_FILE):
+        """
+        Constructor.
+
+        Args:
+            reference_col (str): the column of class_mapping.csv corresponding to the labels to map,
+                                 e.g. 'original' for the freesurfer labels or 'index' for the memmap store
+            class_mapping_file (str): path to class_mapping.csv
+        """
+        self.reference_col = reference_col
+        self.df = pd.read_csv(class_mapping_file)
+        labels = self.df[reference_col].to_numpy()
+        names = self.df["label"]
+
+        self.right_lut = np.zeros(N_LABELS, dtype=bool)
+        self.right_lut[labels[names.str.contains("Right", na=False) | names.str.contains("-rh-", na=False)]] = True
+        self.left_lut = np.zeros(N_LABELS, dtype=bool)
+        self.left_lut[labels[names.str.contains("Left", na=False) | names.str.contains("-lh-", na=False)]] = True
+        self.cerebellum_brain_stem_lut = np.zeros(N_LABELS, dtype=bool)
+        self.cerebellum_brain_stem_lut[
+            labels[names.str.lower().str.contains("cerebellum", na=False) | names.str.lower().str.contains("brain-stem", na=False)]
+        ] = True
+
+        self.class_luts = {} # nr_of_classes -> uint8 table, compiled on first use
+        self.torch_luts = {} # (nr_of_classes, device) -> the table as a tensor
+
+    def class_lut(self, nr_of_classes: int) -> np.array:
+        """
+        Gets the table that maps the labels to the nr_of_classes scheme. Labels that are not in
+        class_mapping.csv are mapped to 0.
+
+        Args:
+            nr_of_classes (int): the class scheme
+
+        Returns:
+            np.array: uint8 array of size N_LABELS
+        """
+        if nr_of_classes not in self.class_luts:
+            new_col = "index" if nr_of_classes == 106 else f"{nr_of_classes}-class"
+            assert self.df.groupby(self.reference_col)[new_col].nunique().max() <= 1, "unique mapping does not exist"
+            lut = np.zeros(N_LABELS, dtype=np.uint8)
+            lut[self.df[self.reference_col].to_numpy()] = self.df[new_col].to_numpy()
+            self.class_luts[nr_of_classes] = lut
+        return self.class_luts[nr_of_classes]
+
+    def map(self, mask, nr_of_classes: int):
+        """
+        Maps the labels of a slice or a whole batch to the nr_of_classes scheme.
+
+        Args:
+            mask (np.array | torch.tensor): labels of any shape, e.g. [h,w] or [batch,1,h,w]
+            nr_of_classes (int): the class scheme
+
+        Returns:
+            np.array | torch.tensor: the uint8 mapped labels, on the device of mask for a tensor
+        """
+        if isinstance(mask, torch.Tensor):
+            key = (nr_of_classes, mask.device)
+            if key not in self.torch_luts:
+                self.torch_luts[key] = torch.from_numpy(self.class_lut(nr_of_classes)).to(mask.device)
+            return apply_lut(self.torch_luts[key], mask)
+        return apply_lut(self.class_lut(nr_of_classes), mask)
+
+
+@lru_cache(maxsize=None)
+def get_label_mapper(reference_col: str = "original", class_mapping_file: str = CLASS_MAPPING_FILE) -> LabelMapper:
+    """
+    Gets the LabelMapper for a column of class_mapping.csv, reading the file only once per process.
+    Calling this before the DataLoader workers fork lets all workers share the tables.
+
+    Args:
+        reference_col (str): the column of class_mapping.csv corresponding to the labels to map
+        class_mapping_file (str): path to class_mapping.csv
+
+    Returns:
+        LabelMapper: the shared mapper
+    """
+    return LabelMapper(reference_col, class_mapping_file)
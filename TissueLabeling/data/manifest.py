@@ -0,0 +1,195 @@
+"""
+File: manifest.py
+Author: Sabeen Lohawala
+Date: 2024-05-23
+Description: This file contains the ShardManifest class, which describes the geometry of the KWYK HDF5 shards
+(path, number of volumes, shapes, dtypes, and codec of each shard) and maps between global volume indices
+and (shard_idx, shard_vol_idx) pairs.
+"""
+
+import glob
+import json
+import os
+
+import h5py as h5
+import numpy as np
+
+from TissueLabeling.data.hdf5_io import get_shard_dataset
+
+MANIFEST_FILE = "manifest.json"
+VDS_FILE = "kwyk_shards.vds" # not *.h5, so that it is never mistaken for a shard
+
+
+class ShardManifest:
+    """
+    A class representing the manifest of a directory of KWYK HDF5 shards. Volumes are numbered globally
+    in shard order, i.e. the volumes of shard 0 come first, then those of shard 1, and so on.
+    """
+
+    def __init__(self, h5_dir: str, shards: list):
+        """
+        Constructor.
+
+        Args:
+            h5_dir (str): the directory containing the shards
+            shards (list): a dict for each shard with the keys 'path' (relative to h5_dir), 'n_vols',
+                           'vol_shape', 'feature_dtype', 'label_dtype', 'codec', 'level', and 'layout'
+        """
+        self.h5_dir = h5_dir
+        self.shards = shards
+
+        n_vols = [shard["n_vols"] for shard in shards]
+        # global index of the first volume of each shard, with the total number of volumes at the end
+        self.vol_offsets = np.concatenate([[0], np.cumsum(n_vols)]).astype(np.int64)
+        # shard index of each global volume, for O(1) lookup
+        self.vol_shards = np.repeat(np.arange(len(shards)), n_vols)
+
+    @property
+    def n_shards(self) -> int:
+        return len(self.shards)
+
+    @property
+    def n_vols(self) -> int:
+        return int(self.vol_offsets[-1])
+
+    @property
+    def shard_paths(self) -> list:
+        return [os.path.join(self.h5_dir, shard["path"]) for shard in self.shards]
+
+    @property
+    def vol_shape(self) -> tuple:
+        return tuple(self.shards[0]["vol_shape"])
+
+    def global_vol_indices(self, shard_idx, shard_vol_idx):
+        """
+        Converts (shard_idx, shard_vol_idx) pairs to global volume indices.
+
+        Args:
+            shard_idx (int | np.array): which shard index
+            shard_vol_idx (int | np.array): the index of the volume within the shard
+
+        Returns:
+            int | np.array: the global volume index
+        """
+        return self.vol_offsets[shard_idx] + shard_vol_idx
+
+    def locate(self, vol_idx):
+        """
+        Converts global volume indices to (shard_idx, shard_vol_idx) pairs.
+
+        Args:
+            vol_idx (int | np.array): the global volume index
+
+        Returns:
+            shard_idx (int | np.array): which shard index
+            shard_vol_idx (int | np.array): the index of the volume within the shard
+        """
+        shard_idx = self.vol_shards[vol_idx]
+        return shard_idx, vol_idx - self.vol_offsets[shard_idx]
+
+    @property
+    def vds_path(self) -> str:
+        return os.path.join(self.h5_dir, VDS_FILE)
+
+    def write_virtual_dataset(self) -> str:
+        """
+        Writes an HDF5 file with one virtual dataset for each features/labels dataset of the shards (one per
+        axis for the 'axis' layout), which maps the datasets of all shards into a single [n_vols, H, W, D]
+        array in global volume order. The shards are referenced by absolute path, so the file has to be
+        rebuilt if the shard directory moves.
+
+        Returns:
+            str: the path of the virtual dataset file
+        """
+        with h5.File(self.shard_paths[0], "r") as f:
+            dtypes = {name: f[name].dtype for name in f if name.startswith(("features", "labels"))}
+
+        with h5.File(f"{self.vds_path}.tmp", "w", libver="latest") as f:
+            for name, dtype in dtypes.items():
+                layout = h5.VirtualLayout(shape=(self.n_vols, *self.vol_shape), dtype=dtype)
+                for shard_idx, (shard, shard_path) in enumerate(zip(self.shards, self.shard_paths)):
+                    layout[self.vol_offsets[shard_idx] : self.vol_offsets[shard_idx + 1]] = h5.VirtualSource(
+                        os.path.abspath(shard_path), name, shape=(shard["n_vols"], *shard["vol_shape"])
+                    )
+                f.create_virtual_dataset(name, layout, fillvalue=0)
+            f.attrs["vol_offsets"] = self.vol_offsets
+        os.replace(f"{self.vds_path}.tmp", self.vds_path)
+        return self.vds_path
+
+    def virtual(self):
+        """
+        Gets the manifest of the virtual dataset of the shards, i.e. a single shard containing all volumes, so
+        that (shard_idx, shard_vol_idx) pairs are (0, global volume index).
+
+        Returns:
+            ShardManifest: the manifest of the virtual dataset
+
+        Throws:
+            Exception if the virtual dataset has not been written
+        """
+        if not os.path.exists(self.vds_path):
+            raise Exception(f"{self.vds_path} does not exist, run scripts/build_kwyk_vds.py first")
+        shard = dict(self.shards[0], path=VDS_FILE, n_vols=self.n_vols)
+        return ShardManifest(self.h5_dir, [shard])
+
+    def write(self) -> str:
+        """
+        Writes the manifest to manifest.json in the shard directory.
+
+        Returns:
+            str: the path of the manifest
+        """
+        manifest_path = os.path.join(self.h5_dir, MANIFEST_FILE)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump({"shards": self.shards}, f, indent=4)
+        return manifest_path
+
+    @classmethod
+    def from_shards(cls, shard_paths: list, codec: str = None, level: int = None):
+        """
+        Creates the manifest of existing shards by reading their dataset shapes and dtypes.
+        Requires that all shards are in the same directory.
+
+        Args:
+            shard_paths (list): paths of the shards, in the order of the global volume indices
+            codec (str | None): (optional) the codec the shards were written with
+            level (int | None): (optional) the compression level of the codec
+
+        Returns:
+            ShardManifest: the manifest
+        """
+        shards = []
+        for shard_path in shard_paths:
+            with h5.File(shard_path, "r") as f:
+                features = get_shard_dataset(f, "features")
+                shards.append(
+                    {
+                        "path": os.path.basename(shard_path),
+                        "n_vols": int(features.shape[0]),
+                        "vol_shape": [int(dim) for dim in features.shape[1:]],
+                        "feature_dtype": str(features.dtype),
+                        "label_dtype": str(get_shard_dataset(f, "labels").dtype),
+                        "codec": codec if codec is not None else features.compression,
+                        "level": level if level is not None else features.compression_opts,
+                        "layout": "cubic" if "features" in f else "axis",
+                    }
+                )
+        return cls(os.path.dirname(shard_paths[0]), shards)
+
+    @classmethod
+    def load(cls, h5_dir: str):
+        """
+        Loads the manifest of a shard directory. If the directory has no manifest.json (shards written
+        before manifests existed), the manifest is created from the sorted *.h5 files in the directory.
+
+        Args:
+            h5_dir (str): the directory containing the shards
+
+        Returns:
+            ShardManifest: the manifest
+        """
+        manifest_path = os.path.join(h5_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return cls.from_shards(sorted(glob.glob(os.path.join(h5_dir, "*.h5"))))
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return cls(h5_dir, json.load(f)["shards"])
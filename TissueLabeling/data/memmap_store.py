@@ -0,0 +1,144 @@
+"""
+File: memmap_store.py
+Author: Sabeen Lohawala
+Date: 2024-05-21
+Description: This file contains the layout of the uncompressed, memory-mapped KWYK slice store that
+scripts/convert_kwyk_memmap.py writes and TissueLabeling.data.dataset.MemmapSliceDataset reads.
+
+For each axis there is one features_axis{axis}.bin (uint8 intensities) and one labels_axis{axis}.bin
+(uint8 labels from the 'index' column of class_mapping.csv) file. Each file is a flat array of rows,
+one row per slice, ordered by (global volume index, slice index). Rows are padded to a multiple of the
+page size, so every slice starts on a page boundary and reading it is a single memcpy.
+"""
+
+import json
+import os
+
+import numpy as np
+
+PAGE_SIZE = 4096
+META_FILE = "memmap_meta.json"
+INDEX_FILE = "vol_offsets.npy"
+
+
+def get_row_stride(slice_shape) -> int:
+    """
+    Computes the number of bytes of a row of the store, i.e. a uint8 slice padded to a multiple of PAGE_SIZE.
+
+    Args:
+        slice_shape (tuple): the shape of a slice
+
+    Returns:
+        int: the row stride in bytes
+    """
+    slice_bytes = int(np.prod(slice_shape))
+    return -(-slice_bytes // PAGE_SIZE) * PAGE_SIZE
+
+
+def write_meta(store_dir: str, vol_shape, shard_n_vols, label_column="index") -> dict:
+    """
+    Writes the metadata and the offset index of a store.
+
+    Args:
+        store_dir (str): the directory of the store
+        vol_shape (tuple): the shape (H, W, D) of every volume
+        shard_n_vols (list): the number of volumes in each shard
+        label_column (str): the column of class_mapping.csv that the stored labels correspond to
+
+    Returns:
+        meta (dict): the metadata of the store
+    """
+    vol_offsets = np.concatenate([[0], np.cumsum(shard_n_vols)]).astype(np.int64)
+    meta = {
+        "vol_shape": [int(dim) for dim in vol_shape],
+        "shard_n_vols": [int(n_vols) for n_vols in shard_n_vols],
+        "n_vols": int(vol_offsets[-1]),
+        "label_column": label_column,
+        "row_strides": [
+            get_row_stride([dim for i, dim in enumerate(vol_shape) if i != axis])
+            for axis in range(3)
+        ],
+    }
+    np.save(os.path.join(store_dir, INDEX_FILE), vol_offsets)
+    with open(os.path.join(store_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=4)
+    return meta
+
+
+def read_meta(store_dir: str):
+    """
+    Reads the metadata and the offset index of a store.
+
+    Args:
+        store_dir (str): the directory of the store
+
+    Returns:
+        meta (dict): the metadata of the store
+        vol_offsets (np.array): the global index of the first volume of each shard (plus the total at the end)
+    """
+    with open(os.path.join(store_dir, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    vol_offsets = np.load(os.path.join(store_dir, INDEX_FILE))
+    return meta, vol_offsets
+
+
+def open_store(store_dir: str, meta: dict, mode: str = "r") -> dict:
+    """
+    Memory-maps the feature and label files of a store.
+
+    Args:
+        store_dir (str): the directory of the store
+        meta (dict): the metadata of the store
+        mode (str): 'r' to read, 'r+' to write into files that already exist, 'w+' to create them
+
+    Returns:
+        dict: maps (kind, axis) with kind in 'features' or 'labels' to a np.memmap of shape
+              [n_vols * n_slices, row_stride]
+    """
+    store = {}
+    for axis in range(3):
+        n_rows = meta["n_vols"] * meta["vol_shape"][axis]
+        for kind in ["features", "labels"]:
+            store[(kind, axis)] = np.memmap(
+                os.path.join(store_dir, f"{kind}_axis{axis}.bin"),
+                dtype=np.uint8,
+                mode=mode,
+                shape=(n_rows, meta["row_strides"][axis]),
+            )
+    return store
+
+
+def get_row(meta: dict, vol_offsets, shard_idx: int, shard_vol_idx: int, axis: int, slice_idx: int) -> int:
+    """
+    Gets the row of the store that contains a slice.
+
+    Args:
+        meta (dict): the metadata of the store
+        vol_offsets (np.array): the offset index of the store
+        shard_idx (int): which shard index
+        shard_vol_idx (int): the index of the volume within the shard
+        axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+        slice_idx (int): the index of the slice along axis
+
+    Returns:
+        int: the row index
+    """
+    return (int(vol_offsets[shard_idx]) + int(shard_vol_idx)) * meta["vol_shape"][axis] + int(slice_idx)
+
+
+def get_slice(store: dict, meta: dict, kind: str, axis: int, row: int) -> np.array:
+    """
+    Gets a read-only view of a slice in the store.
+
+    Args:
+        store (dict): the memory-mapped store returned by open_store
+        meta (dict): the metadata of the store
+        kind (str): 'features' or 'labels'
+        axis (int): the axis (0, 1, or 2) of the volume along which the slice is taken
+        row (int): the row of the slice, see get_row
+
+    Returns:
+        np.array: a uint8 view of the slice
+    """
+    slice_shape = [dim for i, dim in enumerate(meta["vol_shape"]) if i != axis]
+    return store[(kind, axis)][row, : slice_shape[0] * slice_shape[1]].reshape(slice_shape)
@@ -0,0 +1,96 @@
+"""
+File: nifti_io.py
+Author: Sabeen Lohawala
+Date: 2024-06-04
+Description: This file contains the functions to load NIfTI volumes in their stored dtype (e.g. uint8 MRI and
+uint16/int32 aseg volumes instead of the float64 of get_fdata), memory-mapping uncompressed files. Gzipped
+volumes can be decompressed once into a cache directory (e.g. on node-local disk), optionally with pigz,
+after which every load memory-maps the decompressed copy.
+
+The cache directory can be passed explicitly or set for all loads (including those in Pool workers)
+through the NIFTI_CACHE_DIR environment variable.
+"""
+
+import gzip
+import os
+import shutil
+import subprocess
+
+import nibabel as nib
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+from TissueLabeling.data.slice_cache import get_file_namespace
+
+CACHE_DIR_ENV = "NIFTI_CACHE_DIR"
+
+
+def get_decompressed_path(path: str, cache_dir: str, n_threads: int = 1) -> str:
+    """
+    Gets the path of the decompressed copy of a gzipped volume in the cache, decompressing it on a miss.
+    The copy is written to a temporary file and renamed, so concurrent processes never read a partial copy.
+
+    Args:
+        path (str): path to the .nii.gz volume
+        cache_dir (str): the cache directory
+        n_threads (int): number of pigz threads to decompress with; uses gzip in this process if 1
+                         or if pigz is not installed
+
+    Returns:
+        str: path to the decompressed .nii copy
+    """
+    name = os.path.basename(path)[: -len(".gz")]
+    cached_path = os.path.join(cache_dir, f"{get_file_namespace(path)}_{name}")
+    if os.path.exists(cached_path):
+        return cached_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    pigz = shutil.which("pigz") if n_threads > 1 else None
+
+    def decompress(f_out):
+        if pigz:
+            subprocess.run([pigz, "-d", "-c", "-p", str(n_threads), path], stdout=f_out, check=True)
+        else:
+            with gzip.open(path, "rb") as f_in:
+                shutil.copyfileobj(f_in, f_out, 16 * 1024**2)
+
+    atomic_write(cached_path, decompress)
+    return cached_path
+
+
+def open_nifti(path: str, cache_dir: str = None, n_threads: int = 1, mmap=True):
+    """
+    Opens a NIfTI volume, from its decompressed copy in the cache if path is gzipped and a cache is set.
+
+    Args:
+        path (str): path to the .nii or .nii.gz volume
+        cache_dir (str | None): the cache directory of decompressed volumes; NIFTI_CACHE_DIR if None,
+                                no cache if empty
+        n_threads (int): number of threads to decompress with on a cache miss, see get_decompressed_path
+        mmap (bool | str): passed to nib.load, whether to memory-map uncompressed volumes
+
+    Returns:
+        nib.Nifti1Image: the image, whose data is read lazily through its dataobj
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV, "")
+    if cache_dir and path.endswith(".gz"):
+        path = get_decompressed_path(path, cache_dir, n_threads)
+    return nib.load(path, mmap=mmap)
+
+
+def load_nifti(path: str, cache_dir: str = None, n_threads: int = 1, mmap=True) -> np.array:
+    """
+    Loads the data of a NIfTI volume in its stored dtype. Uncompressed volumes (and cached copies of
+    gzipped volumes) are returned as read-only memory maps, so copy before modifying in place.
+
+    Args:
+        path (str): path to the .nii or .nii.gz volume
+        cache_dir (str | None): the cache directory of decompressed volumes, see open_nifti
+        n_threads (int): number of threads to decompress with on a cache miss, see get_decompressed_path
+        mmap (bool | str): passed to nib.load, whether to memory-map uncompressed volumes
+
+    Returns:
+        np.array: the volume, scaled (and then float) only if the header sets a scale factor
+    """
+    return np.asanyarray(open_nifti(path, cache_dir, n_threads, mmap).dataobj)
@@ -0,0 +1,167 @@
+"""
+File: packed_slices.py
+Author: Sabeen Lohawala
+Date: 2024-05-31
+Description: This file contains the layout of the packed slice files that scripts/pack_nobrainer_slices.py
+writes and TissueLabeling.data.dataset.NoBrainerDataset reads instead of the individual .npy slice files.
+
+For each mode (train, validation, test) there is a directory with:
+    {kind}_{pack:03d}.bin: the raw (C-order) bytes of the slices of kind 'images' or 'masks', concatenated
+    {kind}_index.npy: one entry per slice, in the sorted order of the original files, with the pack the
+                      slice is in, its byte offset within the pack, and its shape
+    manifest.json: the dtype and number of slices of each kind and the pack files, so that a dataset can
+                   be constructed without listing any directory
+"""
+
+import json
+import os
+
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+
+MANIFEST_FILE = "manifest.json"
+KINDS = ["images", "masks"]
+MAX_NDIM = 3
+INDEX_DTYPE = np.dtype(
+    [("pack", np.int32), ("offset", np.int64), ("ndim", np.int8), ("shape", np.int32, (MAX_NDIM,))]
+)
+
+
+def get_pack_path(pack_dir: str, kind: str, pack_idx: int) -> str:
+    return os.path.join(pack_dir, f"{kind}_{pack_idx:03d}.bin")
+
+
+def get_index_path(pack_dir: str, kind: str) -> str:
+    return os.path.join(pack_dir, f"{kind}_index.npy")
+
+
+def write_pack(file_paths, pack_dir: str, kind: str, pack_bytes: int = 2**32, arrays=None) -> dict:
+    """
+    Concatenates the slices saved in .npy files into pack files of at most pack_bytes each and
+    writes their offset index.
+
+    Args:
+        file_paths (list): paths to the .npy files, in the order the slices will be indexed
+        pack_dir (str): the directory of the packed files of one mode
+        kind (str): 'images' or 'masks'
+        pack_bytes (int): the maximum number of bytes per pack file
+        arrays (iterable | None): (optional) the loaded arrays of file_paths, in order, e.g. from a Pool.imap
+
+    Returns:
+        dict: the manifest entry of kind, with its dtype, number of slices, and pack files
+    """
+    if arrays is None:
+        arrays = (np.load(file_path) for file_path in file_paths)
+
+    index = np.zeros(len(file_paths), dtype=INDEX_DTYPE)
+    dtype = None
+    pack_idx, offset = 0, 0
+    pack_file = open(get_pack_path(pack_dir, kind, pack_idx), "wb")
+    for i, array in enumerate(arrays):
+        if dtype is None:
+            dtype = array.dtype
+        elif array.dtype != dtype:
+            raise Exception(f"{file_paths[i]} has dtype {array.dtype}, expected {dtype} like the other {kind}")
+        if array.ndim > MAX_NDIM:
+            raise Exception(f"{file_paths[i]} has {array.ndim} dimensions, at most {MAX_NDIM} are supported")
+        if offset > 0 and offset + array.nbytes > pack_bytes:
+            pack_file.close()
+            pack_idx, offset = pack_idx + 1, 0
+            pack_file = open(get_pack_path(pack_dir, kind, pack_idx), "wb")
+        pack_file.write(np.ascontiguousarray(array).tobytes())
+        index[i]["pack"] = pack_idx
+        index[i]["offset"] = offset
+        index[i]["ndim"] = array.ndim
+        index[i]["shape"][: array.ndim] = array.shape
+        offset += array.nbytes
+        if (i + 1) % 100000 == 0:
+            print(f"{kind}: packed {i + 1}/{len(file_paths)} slices")
+    pack_file.close()
+
+    np.save(get_index_path(pack_dir, kind), index)
+    return {
+        "dtype": str(dtype) if dtype is not None else "uint8",
+        "n_slices": len(file_paths),
+        "packs": [os.path.basename(get_pack_path(pack_dir, kind, i)) for i in range(pack_idx + 1)],
+    }
+
+
+def write_manifest(pack_dir: str, kinds: dict, source_dir: str) -> str:
+    """
+    Writes the manifest of the packed files of one mode.
+
+    Args:
+        pack_dir (str): the directory of the packed files of one mode
+        kinds (dict): maps 'images' and 'masks' to the entries returned by write_pack
+        source_dir (str): the directory the .npy files were packed from
+
+    Returns:
+        str: the path of the manifest
+    """
+    manifest_path = os.path.join(pack_dir, MANIFEST_FILE)
+    atomic_write(manifest_path, lambda f: json.dump({"source_dir": source_dir, **kinds}, f, indent=4), mode="w")
+    return manifest_path
+
+
+class PackedSlices:
+    """
+    A read-only sequence of the slices of one kind in packed files. Indexing with an int returns a
+    view of the memory-mapped pack, indexing with a slice returns a PackedSlices of the subset, so it
+    can be used in place of the sorted list of .npy file paths.
+    """
+
+    def __init__(self, pack_dir: str, kind: str, positions=None) -> None:
+        """
+        Args:
+            pack_dir (str): the directory of the packed files of one mode
+            kind (str): 'images' or 'masks'
+            positions (np.array | None): (optional) the entries of the index that belong to this sequence
+        """
+        if kind not in KINDS:
+            raise Exception(f"{kind} is not a valid kind. Choose from {KINDS}.")
+        manifest_path = os.path.join(pack_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            raise Exception(f"{manifest_path} does not exist, run scripts/pack_nobrainer_slices.py first")
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)[kind]
+
+        self.pack_dir = pack_dir
+        self.kind = kind
+        self.dtype = np.dtype(meta["dtype"])
+        self.pack_files = [os.path.join(pack_dir, pack) for pack in meta["packs"]]
+        self.index = np.load(get_index_path(pack_dir, kind), mmap_mode="r")
+        self.positions = positions if positions is not None else np.arange(meta["n_slices"])
+        self.packs = None # memory-mapped pack files, opened on first access in each worker
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, idx):
+        """
+        Gets a slice.
+
+        Args:
+            idx (int | slice): position of the slice, or a range of positions
+
+        Returns:
+            np.array | PackedSlices: a read-only view of the slice, or the sequence of the selected slices
+        """
+        if isinstance(idx, slice):
+            return PackedSlices(self.pack_dir, self.kind, self.positions[idx])
+        if self.packs is None:
+            self.packs = [
+                np.memmap(pack_file, dtype=np.uint8, mode="r") if os.path.getsize(pack_file) else np.zeros(0, dtype=np.uint8)
+                for pack_file in self.pack_files
+            ]
+        entry = self.index[self.positions[idx]]
+        shape = tuple(int(dim) for dim in entry["shape"][: entry["ndim"]])
+        n_bytes = int(np.prod(shape, dtype=np.int64)) * self.dtype.itemsize
+        offset = int(entry["offset"])
+        return self.packs[entry["pack"]][offset : offset + n_bytes].view(self.dtype).reshape(shape)
+
+    def __getstate__(self):
+        # the memory maps are reopened in each worker rather than pickled
+        state = self.__dict__.copy()
+        state["packs"] = None
+        return state
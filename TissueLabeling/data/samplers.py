@@ -0,0 +1,349 @@
+"""
+File: samplers.py
+Author: Sabeen Lohawala
+Date: 2024-05-24
+Description: This file contains PyTorch samplers for the HDF5-backed KWYK datasets. The samplers split the
+data across DDP ranks themselves, so the train loader must be set up with
+fabric.setup_dataloaders(..., use_distributed_sampler=False).
+"""
+
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from TissueLabeling.data.label_mapping import get_label_mapper
+
+
+class RankAwareSampler(Sampler):
+    """
+    Base class for samplers that draw a different, deterministic set of indices for each epoch and
+    DDP rank.
+    """
+
+    def __init__(self, num_replicas: int = None, rank: int = None, seed: int = 42):
+        """
+        Constructor.
+
+        Args:
+            num_replicas (int | None): number of DDP processes; read from torch.distributed if None
+            rank (int | None): rank of the current process; read from torch.distributed if None
+            seed (int): random seed, combined with the epoch
+        """
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch, which determines the order drawn by the next __iter__. Called by Fabric at the
+        start of each epoch.
+
+        Args:
+            epoch (int): the epoch
+        """
+        self.epoch = epoch
+
+    def _get_rng(self):
+        """
+        Returns:
+            np.random.Generator: the random generator of the current epoch, same on all ranks
+        """
+        return np.random.default_rng(self.seed + self.epoch)
+
+
+def get_blocks(slice_index):
+    """
+    Groups the slices of a packed slice index into blocks, where a block is all slices of one volume along
+    one axis.
+
+    Args:
+        slice_index (np.array): the packed slice index of the dataset (HDF5Dataset.filtered_matrix)
+
+    Returns:
+        order (np.array): the dataset indices sorted by (global volume index, axis)
+        block_starts (np.array): the position in order of the first slice of each block
+        block_ends (np.array): the position in order after the last slice of each block
+    """
+    keys = np.asarray(slice_index, dtype=np.int64) >> 8 # (global volume index, axis) of each slice
+    if np.all(keys[1:] >= keys[:-1]):
+        order = np.arange(len(keys))
+    else:
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+    block_starts = np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1])
+    block_ends = np.append(block_starts[1:], len(keys))
+    return order, block_starts, block_ends
+
+
+def buffer_shuffle(indices, buffer_size: int, rng):
+    """
+    Shuffles a stream of indices with a bounded buffer: each index is swapped in for a uniformly drawn
+    buffered one.
+
+    Args:
+        indices (np.array): the indices in streaming order
+        buffer_size (int): number of indices in the buffer
+        rng (np.random.Generator): the random generator
+
+    Yields:
+        int: the shuffled indices
+    """
+    positions = rng.integers(0, buffer_size, size=len(indices))
+    buffer = []
+    for index, position in zip(indices.tolist(), positions.tolist()):
+        if len(buffer) < buffer_size:
+            buffer.append(index)
+            continue
+        yield buffer[position]
+        buffer[position] = index
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class BlockShuffleSampler(RankAwareSampler):
+    """
+    Shuffles the slices of an HDF5Dataset at the granularity of blocks, where a block is all slices of one
+    volume along one axis (and therefore of one shard). Blocks are visited in random order and their slices in
+    slice order, so reads are mostly sequential within a few chunks at a time; a bounded shuffle buffer then
+    interleaves the slices of neighbouring blocks so that batches are close to fully shuffled.
+    """
+
+    def __init__(
+        self,
+        slice_index,
+        buffer_size: int = 4096,
+        num_replicas: int = None,
+        rank: int = None,
+        seed: int = 42,
+        drop_last: bool = False,
+    ):
+        """
+        Constructor.
+
+        Args:
+            slice_index (np.array): the packed slice index of the dataset (HDF5Dataset.filtered_matrix)
+            buffer_size (int): number of indices in the shuffle buffer; larger is closer to a full shuffle,
+                               smaller keeps reads more local
+            num_replicas (int | None): number of DDP processes; read from torch.distributed if None
+            rank (int | None): rank of the current process; read from torch.distributed if None
+            seed (int): random seed, combined with the epoch
+            drop_last (bool): drop the tail so all ranks get the same number of indices instead of padding
+        """
+        super().__init__(num_replicas=num_replicas, rank=rank, seed=seed)
+        self.buffer_size = buffer_size
+        self.drop_last = drop_last
+
+        self.order, self.block_starts, self.block_ends = get_blocks(slice_index)
+
+        if self.drop_last:
+            self.num_samples = len(self.order) // self.num_replicas
+        else:
+            self.num_samples = math.ceil(len(self.order) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        rng = self._get_rng()
+        block_order = rng.permutation(len(self.block_starts))
+        indices = np.concatenate(
+            [self.order[self.block_starts[block] : self.block_ends[block]] for block in block_order]
+        )
+
+        # every rank streams a contiguous run of blocks of the same (global) order
+        if self.drop_last:
+            indices = indices[: self.total_size]
+        else:
+            indices = np.concatenate([indices, indices[: self.total_size - len(indices)]])
+        indices = indices[self.rank * self.num_samples : (self.rank + 1) * self.num_samples]
+
+        yield from buffer_shuffle(indices, self.buffer_size, rng)
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ShardAffineSampler(RankAwareSampler):
+    """
+    Partitions the slices of an HDF5Dataset so that each DDP rank, and each DataLoader worker of a rank, reads
+    a disjoint, contiguous run of volumes (and therefore of only a few shards) in each epoch. The slices are
+    ordered by global volume index and the runs are cut at equal numbers of slices, so ranks and workers stay
+    balanced; each epoch the runs are rotated by one rank's share, so over num_replicas epochs every rank
+    visits all of the data. Batches are ordered for the round-robin dispatch of the DataLoader, which sends
+    batch b to worker b % num_workers. Within a run, blocks are visited in random order and a bounded shuffle
+    buffer interleaves their slices, as in BlockShuffleSampler.
+    """
+
+    def __init__(
+        self,
+        slice_index,
+        batch_size: int,
+        num_workers: int = 0,
+        buffer_size: int = 4096,
+        num_replicas: int = None,
+        rank: int = None,
+        seed: int = 42,
+        drop_last: bool = False,
+    ):
+        """
+        Constructor.
+
+        Args:
+            slice_index (np.array): the packed slice index of the dataset (HDF5Dataset.filtered_matrix)
+            batch_size (int): the batch size of the DataLoader
+            num_workers (int): the number of workers of the DataLoader
+            buffer_size (int): number of indices in the shuffle buffer of each worker
+            num_replicas (int | None): number of DDP processes; read from torch.distributed if None
+            rank (int | None): rank of the current process; read from torch.distributed if None
+            seed (int): random seed, combined with the epoch
+            drop_last (bool): drop the tail so all ranks get the same number of indices instead of padding
+        """
+        super().__init__(num_replicas=num_replicas, rank=rank, seed=seed)
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.buffer_size = buffer_size
+        self.drop_last = drop_last
+        self.slice_index = slice_index
+        self.order, _, _ = get_blocks(slice_index)
+
+        if self.drop_last:
+            self.num_samples = len(self.order) // self.num_replicas
+        else:
+            self.num_samples = math.ceil(len(self.order) / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+        # batch b is loaded by worker b % num_workers, which gets a run of as many slices as its batches hold
+        n_batches = math.ceil(self.num_samples / self.batch_size)
+        self.batch_sizes = np.full(n_batches, self.batch_size)
+        if n_batches:
+            self.batch_sizes[-1] = self.num_samples - (n_batches - 1) * self.batch_size
+        self.batch_workers = np.arange(n_batches) % self.num_workers
+        run_sizes = np.bincount(self.batch_workers, weights=self.batch_sizes, minlength=self.num_workers).astype(np.int64)
+        self.run_starts = np.concatenate([[0], np.cumsum(run_sizes)])
+
+    def __iter__(self):
+        rng = self._get_rng()
+
+        # rotate the volume order by one rank's share per epoch, then cut it into a contiguous run per rank
+        start = self.epoch * self.num_samples % max(len(self.order), 1)
+        indices = np.roll(self.order, -start)
+        if self.drop_last:
+            indices = indices[: self.total_size]
+        else:
+            indices = np.concatenate([indices, indices[: self.total_size - len(indices)]])
+        indices = indices[self.rank * self.num_samples : (self.rank + 1) * self.num_samples]
+
+        # cut the run of this rank into a run per worker and shuffle each at block granularity
+        worker_indices = []
+        for worker in range(self.num_workers):
+            run = indices[self.run_starts[worker] : self.run_starts[worker + 1]]
+            if len(run):
+                keys = np.asarray(self.slice_index[run], dtype=np.int64) >> 8 # (global volume index, axis)
+                blocks = np.split(run, np.flatnonzero(keys[1:] != keys[:-1]) + 1)
+                run = np.concatenate([blocks[block] for block in rng.permutation(len(blocks))])
+            worker_indices.append(buffer_shuffle(run, self.buffer_size, rng))
+
+        for batch_size, worker in zip(self.batch_sizes.tolist(), self.batch_workers.tolist()):
+            for _ in range(batch_size):
+                yield next(worker_indices[worker])
+
+    def __len__(self):
+        return self.num_samples
+
+
+def get_class_balanced_weights(
+    presence_bits,
+    nr_of_classes: int,
+    temperature: float = 0.5,
+    n_classes: int = 106,
+    label_column: str = "index",
+    chunk_size: int = 2**20,
+) -> np.array:
+    """
+    Computes a sampling weight for each slice from the classes present in it. Each class c of the
+    nr_of_classes scheme (except the background) gets the weight (1 / p_c) ** temperature, where p_c is the
+    fraction of slices that contain c, and each slice gets the weight of its rarest class. A temperature of 0
+    gives uniform sampling and 1 gives full inverse-frequency sampling.
+
+    Args:
+        presence_bits (np.array): packed class presence of each slice, shape [n, ceil(n_classes / 8)]
+                                  (see TissueLabeling.data.class_counts)
+        nr_of_classes (int): the class scheme to balance
+        temperature (float): how strongly rare classes are oversampled
+        n_classes (int): the number of classes of presence_bits
+        label_column (str): the column of class_mapping.csv of the classes of presence_bits
+        chunk_size (int): number of slices unpacked at once, to bound memory
+
+    Returns:
+        np.array: float64 array of shape [n] that sums to 1
+    """
+    lut = get_label_mapper(label_column).class_lut(nr_of_classes)[:n_classes]
+    # [n_classes, nr_of_classes] matrix that maps the stored classes to the scheme
+    to_scheme = np.zeros((n_classes, nr_of_classes), dtype=np.float32)
+    to_scheme[np.arange(n_classes), lut] = 1
+
+    def scheme_presence(start):
+        presence = np.unpackbits(np.asarray(presence_bits[start : start + chunk_size]), axis=1, count=n_classes)
+        return (presence.astype(np.float32) @ to_scheme) > 0
+
+    n_slices = len(presence_bits)
+    class_slice_counts = np.zeros(nr_of_classes, dtype=np.int64)
+    for start in range(0, n_slices, chunk_size):
+        class_slice_counts += scheme_presence(start).sum(axis=0)
+
+    class_weights = (n_slices / np.maximum(class_slice_counts, 1)) ** temperature
+    class_weights[0] = 0 # the background does not make a slice rarer
+    class_weights[class_slice_counts == 0] = 0
+
+    weights = np.empty(n_slices, dtype=np.float64)
+    for start in range(0, n_slices, chunk_size):
+        weights[start : start + chunk_size] = (scheme_presence(start) * class_weights).max(axis=1)
+    # slices with only background are drawn like the most common class
+    weights[weights == 0] = class_weights[class_weights > 0].min() if (class_weights > 0).any() else 1
+    return weights / weights.sum()
+
+
+class ClassBalancedSampler(RankAwareSampler):
+    """
+    Draws a fixed number of slices per epoch with replacement, with probabilities that oversample slices
+    containing rare classes (see get_class_balanced_weights). Each DDP rank gets a disjoint share of the draws.
+    """
+
+    def __init__(
+        self,
+        weights,
+        num_samples: int = None,
+        num_replicas: int = None,
+        rank: int = None,
+        seed: int = 42,
+    ):
+        """
+        Constructor.
+
+        Args:
+            weights (np.array): sampling probability of each slice of the dataset
+            num_samples (int | None): number of slices drawn per epoch over all ranks; len(weights) if None
+            num_replicas (int | None): number of DDP processes; read from torch.distributed if None
+            rank (int | None): rank of the current process; read from torch.distributed if None
+            seed (int): random seed, combined with the epoch
+        """
+        super().__init__(num_replicas=num_replicas, rank=rank, seed=seed)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.weights = self.weights / self.weights.sum()
+        self.total_size = num_samples if num_samples else len(self.weights)
+        self.num_samples = math.ceil(self.total_size / self.num_replicas)
+
+    def __iter__(self):
+        rng = self._get_rng()
+        # all ranks draw the same indices and each keeps every num_replicas-th one
+        indices = rng.choice(len(self.weights), size=self.num_samples * self.num_replicas, replace=True, p=self.weights)
+        yield from indices[self.rank :: self.num_replicas].tolist()
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,173 @@
+"""
+File: shared_slices.py
+Author: Sabeen Lohawala
+Date: 2024-06-02
+Description: This file contains the functions to materialise the filtered slices of a split once per node
+into a shared-memory segment (a directory on a tmpfs such as /dev/shm) and to attach to it read-only, which
+SharedMemoryDataset uses so that all DataLoader workers and all ranks on a node read one copy from RAM.
+
+A segment of a split consists of:
+    {key}.features.bin: the uint8 MRI slices, [n_slices, H, W] in the order of the split's slice index
+    {key}.labels.bin: the uint8 labels of the 'index' column of class_mapping.csv, same layout
+    {key}.index.npy: the packed slice index the segment was built from (see slice_index.py)
+    {key}.json: written last, marks the segment as complete
+The first process to get the lock file {key}.lock builds the segment, the others wait for it and attach.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+from TissueLabeling.data.hdf5_io import get_shard_dataset, open_shard
+from TissueLabeling.data.label_mapping import get_label_mapper
+from TissueLabeling.data.slice_cache import get_file_namespace
+from TissueLabeling.data.slice_index import unpack_slice_rows
+
+
+def get_segment_key(mode: str, manifest, slice_index) -> str:
+    """
+    Gets the name of the segment of a split, which changes whenever the shards (including shards rebuilt in
+    place, see get_file_namespace) or the filtered slices do.
+
+    Args:
+        mode (str): 'train', 'validation', or 'test'
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards the slices are read from
+        slice_index (np.array): the packed uint32 index of the filtered slices of the split
+
+    Returns:
+        str: the key of the segment
+    """
+    index_crc = zlib.crc32(np.ascontiguousarray(slice_index).tobytes())
+    shards_crc = zlib.crc32("_".join(get_file_namespace(path) for path in manifest.shard_paths).encode())
+    return f"{mode}_{shards_crc:08x}_{index_crc:08x}_{len(slice_index)}"
+
+
+def _get_segment_paths(shm_dir: str, key: str) -> dict:
+    return {
+        name: os.path.join(shm_dir, f"{key}.{suffix}")
+        for name, suffix in [("features", "features.bin"), ("labels", "labels.bin"), ("index", "index.npy"), ("meta", "json"), ("lock", "lock")]
+    }
+
+
+def build_segment(shm_dir: str, key: str, slice_index, manifest) -> dict:
+    """
+    Reads the filtered slices of a split from the shards into a new segment. Every volume that contains one of
+    the slices is read and decompressed exactly once.
+
+    Args:
+        shm_dir (str): the shared-memory directory
+        key (str): the key of the segment, see get_segment_key
+        slice_index (np.array): the packed uint32 index of the filtered slices of the split
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+
+    Returns:
+        dict: the metadata of the segment
+    """
+    paths = _get_segment_paths(shm_dir, key)
+    vol_shape = manifest.vol_shape
+    if len(set(vol_shape)) != 1:
+        raise Exception(f"the shared-memory segment requires cubic volumes, the shards have volumes of shape {vol_shape}")
+    slice_shape = tuple(vol_shape[1:])
+    n_slices = len(slice_index)
+    n_bytes = 2 * n_slices * int(np.prod(slice_shape))
+    free_bytes = shutil.disk_usage(shm_dir).free
+    if n_bytes > free_bytes:
+        raise Exception(f"the segment needs {n_bytes} bytes but {shm_dir} only has {free_bytes} bytes free")
+
+    # the 106-class scheme is the 'index' column of class_mapping.csv, which fits in uint8
+    lut = get_label_mapper("original").class_lut(106)
+    tmp_paths = {name: f"{paths[name]}.tmp" for name in ["features", "labels"]}
+    try:
+        features = np.memmap(tmp_paths["features"], dtype=np.uint8, mode="w+", shape=(n_slices, *slice_shape))
+        labels = np.memmap(tmp_paths["labels"], dtype=np.uint8, mode="w+", shape=(n_slices, *slice_shape))
+
+        rows = unpack_slice_rows(slice_index, manifest) # (shard_idx, shard_vol_idx, axis, slice_idx)
+        vols, positions_by_vol = np.unique(rows[:, :2], axis=0, return_inverse=True)
+        positions_by_vol = positions_by_vol.reshape(-1)
+        order = np.argsort(positions_by_vol, kind="stable")
+        bounds = np.searchsorted(positions_by_vol[order], np.arange(len(vols) + 1))
+        h5_pointers = {}
+        for i, (shard_idx, shard_vol_idx) in enumerate(vols):
+            if shard_idx not in h5_pointers:
+                h5_pointers[shard_idx] = open_shard(manifest.shard_paths[shard_idx])
+            f = h5_pointers[shard_idx]
+            feature_vol = get_shard_dataset(f, "features")[shard_vol_idx]
+            label_vol = lut[get_shard_dataset(f, "labels")[shard_vol_idx]]
+            for position in order[bounds[i] : bounds[i + 1]]:
+                _, _, axis, slice_idx = rows[position]
+                features[position] = np.take(feature_vol, slice_idx, axis=axis)
+                labels[position] = np.take(label_vol, slice_idx, axis=axis)
+            if (i + 1) % 50 == 0:
+                print(f"shared-memory segment {key}: read {i + 1}/{len(vols)} volumes")
+        for f in h5_pointers.values():
+            f.close()
+
+        features.flush()
+        labels.flush()
+        del features, labels
+    except BaseException:
+        # a failed build must not leave partial segments in RAM
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    for name, tmp_path in tmp_paths.items():
+        os.replace(tmp_path, paths[name])
+    np.save(paths["index"], np.asarray(slice_index))
+    meta = {"n_slices": n_slices, "slice_shape": list(slice_shape), "label_column": "index"}
+    # the metadata marks the segment as complete, so it is written last
+    atomic_write(paths["meta"], lambda f: json.dump(meta, f, indent=4), mode="w")
+    return meta
+
+
+def materialize_segment(shm_dir: str, key: str, slice_index, manifest) -> dict:
+    """
+    Makes sure that the segment of a split exists, building it if this is the first process on the node to
+    ask for it. Other processes block on the lock file until the segment is complete.
+
+    Args:
+        shm_dir (str): the shared-memory directory
+        key (str): the key of the segment, see get_segment_key
+        slice_index (np.array): the packed uint32 index of the filtered slices of the split
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+
+    Returns:
+        dict: the metadata of the segment
+    """
+    os.makedirs(shm_dir, exist_ok=True)
+    paths = _get_segment_paths(shm_dir, key)
+    with open(paths["lock"], "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(paths["meta"]):
+                with open(paths["meta"], "r", encoding="utf-8") as f:
+                    return json.load(f)
+            print(f"Building shared-memory segment {key} in {shm_dir}")
+            return build_segment(shm_dir, key, slice_index, manifest)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def attach_segment(shm_dir: str, key: str, meta: dict):
+    """
+    Memory-maps a complete segment read-only.
+
+    Args:
+        shm_dir (str): the shared-memory directory
+        key (str): the key of the segment
+        meta (dict): the metadata of the segment
+
+    Returns:
+        features (np.memmap): the uint8 MRI slices, [n_slices, H, W]
+        labels (np.memmap): the uint8 labels, [n_slices, H, W]
+    """
+    paths = _get_segment_paths(shm_dir, key)
+    shape = (meta["n_slices"], *meta["slice_shape"])
+    features = np.memmap(paths["features"], dtype=np.uint8, mode="r", shape=shape)
+    labels = np.memmap(paths["labels"], dtype=np.uint8, mode="r", shape=shape)
+    return features, labels
@@ -0,0 +1,138 @@
+"""
+File: slice_cache.py
+Author: Sabeen Lohawala
+Date: 2024-06-03
+Description: This file contains the SliceCache class, a persistent, size-bounded read-through cache of decoded
+slices in a node-local directory (e.g. on local SSD) that is shared by all processes and all jobs on a node,
+so that a sweep of jobs over the same shards reads each slice from the network filesystem roughly once per node.
+"""
+
+import os
+import random
+import zlib
+
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+
+N_SUBDIRS = 256
+
+
+def get_file_namespace(path: str) -> str:
+    """
+    Gets a short identifier of a file that changes when the file is rewritten, used to namespace cache keys
+    so that entries of different (versions of) shards never collide.
+
+    Args:
+        path (str): path to the file, e.g. a shard
+
+    Returns:
+        str: 8 hex digits
+    """
+    stat = os.stat(path)
+    identity = f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    return f"{zlib.crc32(identity.encode()):08x}"
+
+
+class SliceCache:
+    """
+    A least-recently-used cache of decoded arrays stored as files in a directory. Entries are written to a
+    temporary file and renamed, so readers never see a partially written entry; hits update the modification
+    time, which the eviction uses as recency. The entries are spread uniformly over N_SUBDIRS subdirectories,
+    each of which gets an equal share of the budget. Every process periodically measures one subdirectory, in
+    turn, and when it is over its share deletes its least recently used entries until it is at 90% of the share,
+    so no process ever has to scan the whole cache.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Constructor.
+
+        Args:
+            cache_dir (str): the node-local cache directory
+            max_bytes (int): the byte budget of the cache
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.subdir_max_bytes = max_bytes // N_SUBDIRS
+        # each process measures the next subdirectory after writing this many bytes, which bounds the overshoot
+        self.check_bytes = max(self.subdir_max_bytes // 16, 1)
+        self.bytes_since_check = 0
+        # start at a random subdirectory so that the processes on a node measure different ones
+        self.next_subdir = random.randrange(N_SUBDIRS)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, key: tuple) -> str:
+        name = "_".join(str(value) for value in key)
+        # spread the entries over the subdirectories so that no directory gets too large
+        subdir = os.path.join(self.cache_dir, f"{zlib.crc32(name.encode()) % N_SUBDIRS:02x}")
+        return os.path.join(subdir, f"{name}.npy")
+
+    def get(self, key: tuple, load_fn):
+        """
+        Gets the arrays of an entry, loading and caching them on a miss.
+
+        Args:
+            key (tuple): strings and ints identifying the entry, e.g. (shard namespace, vol, axis, slice)
+            load_fn (callable): function without arguments that returns a tuple of arrays for the entry,
+                                e.g. (features, labels)
+
+        Returns:
+            tuple: the arrays of the entry
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                n_arrays = int(np.load(f))
+                arrays = tuple(np.load(f) for _ in range(n_arrays))
+            os.utime(path) # mark as recently used
+            return arrays
+        except (FileNotFoundError, ValueError, EOFError): # missing, evicted in the meantime, or unreadable
+            pass
+
+        arrays = tuple(load_fn())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        def write_entry(f):
+            np.save(f, np.array(len(arrays)))
+            for array in arrays:
+                np.save(f, np.ascontiguousarray(array))
+
+        atomic_write(path, write_entry)
+
+        self.bytes_since_check += sum(array.nbytes for array in arrays)
+        if self.bytes_since_check >= self.check_bytes:
+            self.bytes_since_check = 0
+            self.evict(self.next_subdir)
+            self.next_subdir = (self.next_subdir + 1) % N_SUBDIRS
+        return arrays
+
+    def evict(self, subdir_idx: int) -> None:
+        """
+        Deletes the least recently used entries of a subdirectory if it is over its share of the byte budget.
+
+        Args:
+            subdir_idx (int): index of the subdirectory, in [0, N_SUBDIRS)
+        """
+        entries = []
+        try:
+            for entry in os.scandir(os.path.join(self.cache_dir, f"{subdir_idx:02x}")):
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError: # nothing cached in this subdirectory yet
+            return
+        n_bytes = sum(size for _, size, _ in entries)
+        if n_bytes <= self.subdir_max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            if n_bytes <= 0.9 * self.subdir_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError: # evicted by another process
+                pass
+            n_bytes -= size
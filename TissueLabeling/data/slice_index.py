@@ -0,0 +1,216 @@
+"""
+File: slice_index.py
+Author: Sabeen Lohawala
+Date: 2024-05-22
+Description: This file contains the functions to build, cache, and load the index of the filtered KWYK slices
+that belong to the train, validation, or test split.
+
+Each slice is packed into a single uint32 as (global volume index << 10) | (axis << 8) | slice index,
+where the global volume index is given by the ShardManifest of the shards. The index of each split is cached on
+disk as a .npy file and loaded as a read-only memory map, so building a dataset does not need to load the
+slice filtering files and DataLoader workers share the same pages instead of each holding a copy.
+"""
+
+import glob
+import os
+import random
+import zlib
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from TissueLabeling.data.atomic_io import atomic_save
+from TissueLabeling.data.slice_cache import get_file_namespace
+from TissueLabeling.data.slice_stats import load_slice_stats
+
+SPLIT_SEED = 42 # seed of the train-val-test split of the volumes
+MEDIUM_N_VOLS = 1150 # number of volumes in the 'med' dataset
+
+
+def pack_slice_rows(vol_indices, axes, slice_indices) -> np.array:
+    """
+    Packs (global volume index, axis, slice index) triples into uint32 values.
+
+    Args:
+        vol_indices (np.array): the global volume index of each slice
+        axes (np.array): the axis of each slice
+        slice_indices (np.array): the index of each slice along its axis
+
+    Returns:
+        np.array: uint32 array of shape [n]
+    """
+    vol_indices = np.asarray(vol_indices, dtype=np.uint32)
+    axes = np.asarray(axes, dtype=np.uint32)
+    slice_indices = np.asarray(slice_indices, dtype=np.uint32)
+    return (vol_indices << 10) | (axes << 8) | slice_indices
+
+
+def unpack_slice_rows(packed, manifest) -> np.array:
+    """
+    Unpacks uint32 values created by pack_slice_rows.
+
+    Args:
+        packed (np.array | int): packed value(s)
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+
+    Returns:
+        np.array: int64 array of shape [n, 4] with rows (shard_idx, shard_vol_idx, axis, slice_idx)
+    """
+    packed = np.atleast_1d(np.asarray(packed, dtype=np.int64))
+    shard_idx, shard_vol_idx = manifest.locate(packed >> 10)
+    return np.stack([shard_idx, shard_vol_idx, (packed >> 8) & 3, packed & 255], axis=1)
+
+
+def get_split_vol_indices(mode: str, data_size: str, manifest):
+    """
+    Gets the global indices of the volumes in a split.
+
+    Args:
+        mode (str): Either 'train', 'validation', or 'test'
+        data_size (str): 'small', 'med', 'medium', 'shard', 'shard-#', or anything else for the full dataset
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+
+    Returns:
+        list | np.array: the volume indices of the split
+    """
+    random.seed(SPLIT_SEED)
+    vol_offsets = manifest.vol_offsets
+    if 'shard' in data_size:
+        # train-val-test split a single shard of data
+        if data_size != 'shard': # data_size = 'shard-#' where # in [0,n_shards)
+            _, shard_num = data_size.split('-')
+            shard_num = int(shard_num)
+            train_shard = shard_num % manifest.n_shards
+            val_shard = (train_shard + 1) % manifest.n_shards
+            test_shard = (val_shard + 1) % manifest.n_shards
+            train_indices = list(range(vol_offsets[train_shard], vol_offsets[train_shard + 1]))
+            val_indices = list(range(vol_offsets[val_shard], vol_offsets[val_shard + 1]))
+            test_indices = list(range(vol_offsets[test_shard], vol_offsets[test_shard + 1]))
+            random.shuffle(train_indices)
+            random.shuffle(val_indices)
+            random.shuffle(test_indices)
+            train_indices = train_indices[:80]
+            val_indices = val_indices[:10]
+            test_indices = test_indices[:10]
+        else: # train, val, and test split come from a different shard of data each
+            train_indices = list(range(vol_offsets[0], vol_offsets[1]))
+            val_indices = list(range(vol_offsets[1], vol_offsets[2]))
+            test_indices = list(range(vol_offsets[2], vol_offsets[3]))
+    else:
+        # the last volume has always been left out of the split; kept so existing splits don't change
+        train_indices, rem_indices = train_test_split(np.arange(0,manifest.n_vols-1),test_size = 0.2, random_state = SPLIT_SEED)
+        val_indices, test_indices = train_test_split(rem_indices,test_size = 0.5, random_state = SPLIT_SEED)
+
+        # keep only a subset of indices if not using the full dataset
+        if data_size in ['small', 'med','medium']:
+            end_idx = 10 if data_size == 'small' else MEDIUM_N_VOLS
+            train_indices = train_indices[:int(end_idx * 0.8)]
+            val_indices = val_indices[:int(end_idx * 0.1)]
+            test_indices = test_indices[:int(end_idx * 0.1)]
+
+    return train_indices if mode == 'train' else val_indices if mode == 'validation' else test_indices
+
+
+def build_slice_index(mode: str, background_percent_cutoff: float, data_size: str, manifest, stats_file: str = None) -> np.array:
+    """
+    Filters the slices of all shards with the slice statistics file (written by build_slice_stats.py) if given,
+    or otherwise with the slice filtering files, and keeps the slices of the split. The filtering files
+    require one file per shard, named with the shard index as written by gen_dataset_nonbrain.py.
+
+    Args:
+        mode (str): Either 'train', 'validation', or 'test'
+        background_percent_cutoff (float): if > 0, keep slices with fewer background pixels than this fraction;
+                                           otherwise keep the slices that pass Matthias's filter
+        data_size (str): which subset of the volumes to use, see get_split_vol_indices
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+        stats_file (str | None): (optional) path to the slice statistics file
+
+    Returns:
+        np.array: the packed uint32 index of the slices, see pack_slice_rows
+    """
+    if stats_file:
+        slice_nonbrain = load_slice_stats(stats_file)['bg_count' if background_percent_cutoff > 0 else 'matthias']
+        assert slice_nonbrain.shape[0] == manifest.n_vols, "slice statistics file does not match the manifest"
+    else:
+        slice_nonbrain = load_slice_filtering_files(background_percent_cutoff, manifest)
+
+    if background_percent_cutoff > 0:
+        # keep track of which slices have fewer percentage of background pixels than background_percent_cutoff
+        filter_value = background_percent_cutoff * 256*256
+        keep_indices = np.argwhere(slice_nonbrain.astype(np.int32) < filter_value) # [num_slices, 3] - (vol_idx, axis, slice_idx)
+    else:
+        keep_indices = np.argwhere(slice_nonbrain.astype(np.uint8) != 0) # [num_slices, 3] - (vol_idx, axis, slice_idx)
+
+    mode_indices = get_split_vol_indices(mode, data_size, manifest)
+    keep_indices = keep_indices[np.isin(keep_indices[:,0],mode_indices)]
+    return pack_slice_rows(keep_indices[:,0], keep_indices[:,1], keep_indices[:,2])
+
+
+def get_slice_filtering_file_paths(background_percent_cutoff: float) -> list:
+    """
+    Gets the paths of the per-shard slice filtering files written by gen_dataset_nonbrain.py.
+
+    Args:
+        background_percent_cutoff (float): if > 0, the background pixel count files; otherwise Matthias's filter
+
+    Returns:
+        list: the sorted paths, one per shard
+    """
+    if background_percent_cutoff > 0:
+        slice_nonbrain_dir = '/om/scratch/Fri/sabeen/kwyk_h5_nonbrains'
+        return sorted(glob.glob(os.path.join(slice_nonbrain_dir, '*nonbrain*.npy')))
+    # only filters out slices that have no tissue
+    slice_nonbrain_dir = '/om/scratch/Fri/sabeen/kwyk_h5_matthias'
+    return sorted(glob.glob(os.path.join(slice_nonbrain_dir, '*matthias*.npy')))
+
+
+def load_slice_filtering_files(background_percent_cutoff: float, manifest) -> np.array:
+    """
+    Loads the per-shard slice filtering files written by gen_dataset_nonbrain.py.
+
+    Args:
+        background_percent_cutoff (float): if > 0, loads the background pixel counts; otherwise Matthias's filter
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+
+    Returns:
+        np.array: array of shape [n_vols, 3, 256] in global volume order
+    """
+    slice_nonbrain_file_paths = get_slice_filtering_file_paths(background_percent_cutoff)
+    assert len(slice_nonbrain_file_paths) == manifest.n_shards, "expected one slice filtering file per shard"
+
+    # each file has shape [1, n_vols_in_shard, 3, 256], so concatenating gives [n_vols, 3, 256] in global volume order
+    slice_nonbrain = np.concatenate([np.load(slice_nonbrain_path)[0] for slice_nonbrain_path in slice_nonbrain_file_paths])
+    assert slice_nonbrain.shape[0] == manifest.n_vols, "slice filtering files do not match the manifest"
+    return slice_nonbrain
+
+
+def load_slice_index(cache_dir: str, mode: str, background_percent_cutoff: float, data_size: str, manifest, stats_file: str = None) -> np.array:
+    """
+    Loads the packed slice index of a split from the cache as a read-only memory map, building and
+    caching it first if it does not exist yet. The cached index is named after the identity of the files
+    it is built from, so regenerated or different statistics or filtering files build a new index.
+
+    Args:
+        cache_dir (str): directory of the cached indices
+        mode (str): Either 'train', 'validation', or 'test'
+        background_percent_cutoff (float): see build_slice_index
+        data_size (str): see get_split_vol_indices
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+        stats_file (str | None): (optional) path to the slice statistics file, see build_slice_index
+
+    Returns:
+        np.array: the packed uint32 index of the slices, see pack_slice_rows
+    """
+    filter_type = 'nonbrain' if background_percent_cutoff > 0 else 'matthias'
+    cutoff = f'{background_percent_cutoff:g}' if background_percent_cutoff > 0 else '0'
+    sources = [stats_file] if stats_file else get_slice_filtering_file_paths(background_percent_cutoff)
+    sources_crc = zlib.crc32('_'.join(get_file_namespace(path) for path in sources).encode())
+    cache_path = os.path.join(
+        cache_dir, f'{mode}_{filter_type}_{cutoff}_{data_size}_seed{SPLIT_SEED}_nvols{manifest.n_vols}_{sources_crc:08x}.npy'
+    )
+    if not os.path.exists(cache_path):
+        print(f'building slice index {cache_path}')
+        slice_index = build_slice_index(mode, background_percent_cutoff, data_size, manifest, stats_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        atomic_save(cache_path, slice_index) # other ranks may be loading the same index
+    return np.load(cache_path, mmap_mode='r')
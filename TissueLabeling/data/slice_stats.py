@@ -0,0 +1,185 @@
+"""
+File: slice_stats.py
+Author: Sabeen Lohawala
+Date: 2024-05-29
+Description: This file contains the functions to compute, save, and load the per-slice statistics of the KWYK
+volumes that the slice filters and normalization constants are derived from. All statistics of a volume are
+computed along all three axes from a single read of the volume with vectorised reductions.
+
+The statistics file (written by scripts/build_slice_stats.py) is a .npz with one array per statistic, each
+of shape [n_vols, 3, MAX_SLICES] (plus a last dimension of 4 for tissue_bbox) in global volume order:
+    bg_count: number of background (label 0) pixels
+    feature_sum: sum of the skull-stripped intensities
+    feature_sumsq: sum of the squared skull-stripped intensities
+    matthias: 1 if the slice passes Matthias's filter (enough tissue intensity and a large enough brain), else 0
+    tissue_bbox: (row_min, row_max, col_min, col_max) of the non-background labels, (0, -1, 0, -1) if none
+
+The same arrays (for the volumes of one shard) can also be stored in the STATS_GROUP group of each shard,
+see scripts/ingest_kwyk.py and scripts/build_slice_stats.py --write_shards.
+"""
+
+import os
+import zlib
+
+import h5py as h5
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_save
+from TissueLabeling.data.slice_cache import get_file_namespace
+
+STATS_GROUP = "slice_stats"
+MAX_SLICES = 256
+MATTHIAS_MIN_SUM = 52428 # minimum sum of the skull-stripped intensities of a slice (20% of 256*256)
+MATTHIAS_MIN_SIZE = 50 # minimum height and width of the brain in a slice
+STATS = ["bg_count", "feature_sum", "feature_sumsq", "matthias", "tissue_bbox"]
+
+
+def get_slice_bboxes(mask) -> np.array:
+    """
+    Computes the bounding box of the True pixels of every slice of a volume along all three axes.
+
+    Args:
+        mask (np.array): bool volume of shape [H, W, D]
+
+    Returns:
+        np.array: int16 array of shape [3, MAX_SLICES, 4] with rows (row_min, row_max, col_min, col_max) in the
+                  coordinates of the slice, (0, -1, 0, -1) for empty slices
+    """
+    bboxes = np.tile(np.array([0, -1, 0, -1], dtype=np.int16), (3, MAX_SLICES, 1))
+    for axis in range(3):
+        other_axes = [i for i in range(3) if i != axis]
+        for i, other_axis in enumerate(other_axes):
+            # [n_slices, n] projection of the mask on one of the two axes of the slices
+            remaining_axis = [a for a in other_axes if a != other_axis][0]
+            projection = np.moveaxis(mask.any(axis=remaining_axis), 0 if axis < other_axis else 1, 0)
+            nonempty = projection.any(axis=1)
+            first = np.argmax(projection, axis=1)
+            last = projection.shape[1] - 1 - np.argmax(projection[:, ::-1], axis=1)
+            n_slices = projection.shape[0]
+            bboxes[axis, :n_slices, 2 * i] = np.where(nonempty, first, 0)
+            bboxes[axis, :n_slices, 2 * i + 1] = np.where(nonempty, last, -1)
+    return bboxes
+
+
+def compute_volume_stats(feature_vol, label_vol) -> dict:
+    """
+    Computes the per-slice statistics of a volume along all three axes.
+
+    Args:
+        feature_vol (np.array): the uint8 MRI volume of shape [H, W, D]
+        label_vol (np.array): the corresponding freesurfer label volume
+
+    Returns:
+        dict: maps each of STATS to an array of shape [3, MAX_SLICES] ([3, MAX_SLICES, 4] for tissue_bbox)
+    """
+    tissue = label_vol != 0
+    stripped = np.where(tissue, feature_vol, 0).astype(np.int64) # skull stripping
+    squared = stripped * stripped
+
+    stats = {
+        "bg_count": np.zeros((3, MAX_SLICES), dtype=np.int32),
+        "feature_sum": np.zeros((3, MAX_SLICES), dtype=np.int64),
+        "feature_sumsq": np.zeros((3, MAX_SLICES), dtype=np.int64),
+    }
+    for axis in range(3):
+        other_axes = tuple(i for i in range(3) if i != axis)
+        n_slices = label_vol.shape[axis]
+        stats["bg_count"][axis, :n_slices] = np.sum(~tissue, axis=other_axes)
+        stats["feature_sum"][axis, :n_slices] = np.sum(stripped, axis=other_axes)
+        stats["feature_sumsq"][axis, :n_slices] = np.sum(squared, axis=other_axes)
+
+    stats["tissue_bbox"] = get_slice_bboxes(tissue)
+    # Matthias's filter measures the size of the brain on the skull-stripped intensities
+    brain_bbox = get_slice_bboxes(stripped != 0)
+    heights = brain_bbox[..., 1] - brain_bbox[..., 0] + 1
+    widths = brain_bbox[..., 3] - brain_bbox[..., 2] + 1
+    stats["matthias"] = (
+        (stats["feature_sum"] >= MATTHIAS_MIN_SUM) & (heights >= MATTHIAS_MIN_SIZE) & (widths >= MATTHIAS_MIN_SIZE)
+    ).astype(np.uint8)
+    return stats
+
+
+def load_slice_stats(stats_file: str) -> dict:
+    """
+    Loads the statistics file.
+
+    Args:
+        stats_file (str): path to the .npz written by scripts/build_slice_stats.py
+
+    Returns:
+        dict: maps each of STATS to its array
+    """
+    with np.load(stats_file) as stats:
+        return {name: stats[name] for name in stats.files}
+
+
+def get_normalization_constants(stats: dict, vol_indices=None, keep=None):
+    """
+    Computes the mean and standard deviation of the skull-stripped intensities, scaled to 0 to 1.
+
+    Args:
+        stats (dict): the statistics returned by load_slice_stats
+        vol_indices (array-like | None): (optional) the volumes to use, e.g. those of the train split
+        keep (np.array | None): (optional) bool array of shape [n_vols, 3, MAX_SLICES] of the slices to use
+
+    Returns:
+        mean (float): the mean intensity of the tissue pixels
+        std (float): the standard deviation of the intensity of the tissue pixels
+    """
+    n_pixels = MAX_SLICES * MAX_SLICES - stats["bg_count"].astype(np.int64)
+    feature_sum = stats["feature_sum"]
+    feature_sumsq = stats["feature_sumsq"]
+    if keep is not None:
+        n_pixels, feature_sum, feature_sumsq = n_pixels * keep, feature_sum * keep, feature_sumsq * keep
+    if vol_indices is not None:
+        n_pixels, feature_sum, feature_sumsq = n_pixels[vol_indices], feature_sum[vol_indices], feature_sumsq[vol_indices]
+    # every voxel appears once per axis, so summing over all three axes counts it three times in each sum
+    total = max(n_pixels.sum(), 1)
+    mean = feature_sum.sum() / total
+    std = np.sqrt(max(feature_sumsq.sum() / total - mean**2, 0))
+    return mean / 255.0, std / 255.0
+
+
+def load_tissue_bboxes(manifest, stats_file: str = "", cache_dir: str = "") -> np.array:
+    """
+    Loads the tissue bounding boxes of every slice of the shards, from the statistics file if given and
+    otherwise from the STATS_GROUP group of the shards. With a cache_dir, the boxes are extracted once into
+    a .npy file there and memory-mapped, so all datasets and DataLoader workers share one copy in the
+    page cache.
+
+    Args:
+        manifest (TissueLabeling.data.manifest.ShardManifest): the manifest of the shards
+        stats_file (str): (optional) path to the .npz written by scripts/build_slice_stats.py
+        cache_dir (str): (optional) directory to cache the extracted boxes in (e.g. config.slice_index_dir)
+
+    Returns:
+        np.array: int16 array of shape [n_vols, 3, MAX_SLICES, 4] in global volume order, read-only
+                  memory-mapped if cache_dir is set
+    """
+    if cache_dir:
+        # named after the identity of the files the boxes are read from
+        sources = [stats_file] if stats_file else manifest.shard_paths
+        sources_crc = zlib.crc32("_".join(get_file_namespace(path) for path in sources).encode())
+        cache_path = os.path.join(cache_dir, f"tissue_bbox_{sources_crc:08x}_nvols{manifest.n_vols}.npy")
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            atomic_save(cache_path, load_tissue_bboxes(manifest, stats_file))
+        return np.load(cache_path, mmap_mode="r")
+
+    if stats_file:
+        with np.load(stats_file) as stats:
+            bboxes = stats["tissue_bbox"]
+    else:
+        bboxes = []
+        for shard_path in manifest.shard_paths:
+            with h5.File(shard_path, "r") as f:
+                if STATS_GROUP not in f:
+                    raise Exception(
+                        f"{shard_path} has no {STATS_GROUP} group, pass a statistics file or run "
+                        "scripts/build_slice_stats.py with --write_shards 1"
+                    )
+                bboxes.append(f[f"{STATS_GROUP}/tissue_bbox"][:])
+        bboxes = np.concatenate(bboxes)
+    if bboxes.shape[0] != manifest.n_vols:
+        raise Exception(f"The tissue bounding boxes are for {bboxes.shape[0]} volumes, but the shards have {manifest.n_vols}")
+    return bboxes
@@ -0,0 +1,131 @@
+"""
+File: volume_cache.py
+Author: Sabeen Lohawala
+Date: 2024-05-25
+Description: This file contains the VolumeCache class, a byte-bounded LRU cache of decoded volumes that lets
+slice datasets decode a volume once and serve many of its slices from memory.
+"""
+
+import glob
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+
+
+def _map_arrays(path: str) -> tuple:
+    """
+    Memory-maps the arrays stored one after the other in a file written by consecutive np.save calls.
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        tuple: the read-only arrays
+    """
+    arrays = []
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while f.tell() < file_size:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            offset = f.tell()
+            arrays.append(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C"))
+            f.seek(offset + arrays[-1].nbytes)
+    return tuple(arrays)
+
+
+class VolumeCache:
+    """
+    A least-recently-used cache of decoded volumes with a byte budget.
+
+    Without shared_dir, volumes are kept in the memory of the current process. With shared_dir (a directory on
+    a tmpfs such as /dev/shm), volumes are written there as .npy files and memory-mapped on read, so all
+    DataLoader workers (and all jobs) on a node share one copy of each volume; the least recently used files
+    are deleted when the directory grows beyond the budget.
+    """
+
+    def __init__(self, max_bytes: int, shared_dir: str = None):
+        """
+        Constructor.
+
+        Args:
+            max_bytes (int): the byte budget of the cache
+            shared_dir (str | None): (optional) directory for the node-wide shared cache
+        """
+        self.max_bytes = max_bytes
+        self.shared_dir = shared_dir
+        self.volumes = OrderedDict() # key -> tuple of arrays, only used without shared_dir
+        self.n_bytes = 0
+        if self.shared_dir:
+            os.makedirs(self.shared_dir, exist_ok=True)
+
+    def get(self, key: tuple, load_fn):
+        """
+        Gets the arrays of a volume, loading and caching them on a miss.
+
+        Args:
+            key (tuple): strings and ints identifying the volume, e.g. (shard namespace, shard_vol_idx), where the
+                         namespace (see slice_cache.get_file_namespace) keeps different shard sets apart in a
+                         shared directory
+            load_fn (callable): function without arguments that returns a tuple of arrays for the volume,
+                                e.g. (features, labels)
+
+        Returns:
+            tuple: the arrays of the volume; read-only if shared_dir is set
+        """
+        if self.shared_dir:
+            return self._get_shared(key, load_fn)
+
+        if key in self.volumes:
+            self.volumes.move_to_end(key)
+            return self.volumes[key]
+        arrays = tuple(load_fn())
+        self.volumes[key] = arrays
+        self.n_bytes += sum(array.nbytes for array in arrays)
+        while self.n_bytes > self.max_bytes and len(self.volumes) > 1:
+            _, evicted = self.volumes.popitem(last=False)
+            self.n_bytes -= sum(array.nbytes for array in evicted)
+        return arrays
+
+    def _get_shared(self, key: tuple, load_fn):
+        """
+        Gets the arrays of a volume from the shared directory, see get. All arrays of a volume are stored one
+        after the other in a single .npy file, so a volume is written, read, and evicted as a whole.
+        """
+        path = os.path.join(self.shared_dir, "_".join(str(value) for value in key) + ".npy")
+        try:
+            arrays = _map_arrays(path)
+            os.utime(path) # mark as recently used
+            return arrays
+        except FileNotFoundError: # not cached yet, or evicted by another process in the meantime
+            pass
+
+        arrays = tuple(load_fn())
+        atomic_write(path, lambda f: [np.save(f, array) for array in arrays])
+        self._evict_shared()
+        return arrays
+
+    def _evict_shared(self) -> None:
+        """
+        Deletes the least recently used files of the shared directory until it fits in the byte budget.
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.shared_dir, "*.npy")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        n_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if n_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path) # processes that memory-mapped the file keep their view
+            except FileNotFoundError:
+                pass
+            n_bytes -= size
@@ -85,9 +85,12 @@ def softmax_focal_loss(
     """
 
     # Reshape image tensor
-    targets = mask.view(
+    targets = mask.reshape(
         -1
     )  # Shape: (batch_size, 1, height, width) -> (batch_size * height * width,)
+    if targets.dtype != torch.long:
+        # compact (e.g. uint8) labels: NLLLoss and indexing need int64 class numbers
+        targets = targets.long()
 
     # Reshape softmax output
     p = probs.permute(0, 2, 3, 1).contiguous()  # Move the channel dimension to the end
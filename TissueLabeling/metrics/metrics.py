@@ -61,17 +61,18 @@ class Dice(Metric):
         as suggested here: https://arxiv.org/abs/2004.10664
 
         Args:
-            target (torch.tensor): Ground-truth mask. Tensor with shape [B, 1, H, W]
+            target (torch.tensor): Ground-truth mask of any integer dtype. Tensor with shape [B, 1, H, W]
             preds (torch.tensor): Predicted class probabilities. Tensor with shape [B, C, H, W]
         """
 
-        # convert mask to one-hot
-        y_true_oh = torch.nn.functional.one_hot(
-            target.long().squeeze(1), num_classes=self.nr_of_classes
-        ).permute(0, 3, 1, 2)
+        # convert mask to one-hot by comparing with the class ids, which works for any integer dtype of
+        # target (e.g. the uint8 labels of compact samples) without materializing an int64 copy
+        classes = torch.arange(self.nr_of_classes, device=target.device).view(1, -1, 1, 1)
+        y_true_oh = target.reshape(target.shape[0], 1, *target.shape[-2:]) == classes
 
         # weights = inverse of pixel counts for the batch
         weights = y_true_oh.sum(axis=(0,2,3))
+        y_true_oh = y_true_oh.to(preds.dtype)
         weights = 1 / (weights)
         # set inf weights (when count = 0) to max(weights)
         weights[weights == float('inf')] = -float('inf')
@@ -150,6 +150,202 @@ def get_args():
         required=False,
         default="small",
     )
+    train.add_argument(
+        "--num_workers",
+        help="Number of DataLoader worker processes per GPU process",
+        type=int,
+        required=False,
+        default=4,
+    )
+    train.add_argument(
+        "--prefetch_factor",
+        help="Number of batches loaded in advance by each DataLoader worker",
+        type=int,
+        required=False,
+        default=2,
+    )
+    train.add_argument(
+        "--persistent_workers",
+        help="Whether to keep DataLoader workers (and their open HDF5 handles) alive between epochs",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--h5_dir",
+        help="Directory of the KWYK HDF5 shards and their manifest.json",
+        type=str,
+        required=False,
+        default="/om/scratch/tmp/sabeen/kwyk_chunk/",
+    )
+    train.add_argument(
+        "--h5_rdcc_nbytes",
+        help="Size in bytes of the HDF5 chunk cache of each shard dataset",
+        type=int,
+        required=False,
+        default=1024**2,
+    )
+    train.add_argument(
+        "--h5_rdcc_nslots",
+        help="Number of hash table slots of the HDF5 chunk cache",
+        type=int,
+        required=False,
+        default=521,
+    )
+    train.add_argument(
+        "--h5_rdcc_w0",
+        help="HDF5 chunk cache preference (0 to 1) for evicting fully read chunks",
+        type=float,
+        required=False,
+        default=0.75,
+    )
+    train.add_argument(
+        "--h5_page_buf_size",
+        help="Size in bytes of the HDF5 page buffer (0 to disable, requires paged shards)",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--h5_read_ahead",
+        help="Number of neighbouring slices of the same volume and axis to read at once (0 to disable, -1 for the chunk row of each slice)",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--volume_cache_bytes",
+        help="Byte budget of the LRU cache of decoded volumes that serves HDF5 slices (0 to disable); use with --sampler block",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--volume_cache_dir",
+        help="Directory on a tmpfs (e.g. /dev/shm/kwyk_volumes) to share the volume cache across DataLoader workers; per-worker cache if empty",
+        type=str,
+        required=False,
+        default="",
+    )
+    train.add_argument(
+        "--slice_cache_dir",
+        help="Directory on node-local disk (e.g. /state/partition1/kwyk_slices) of the persistent slice cache shared by all jobs on the node; disabled if empty, cannot be combined with --volume_cache_bytes or --h5_read_ahead",
+        type=str,
+        required=False,
+        default="",
+    )
+    train.add_argument(
+        "--slice_cache_bytes",
+        help="Byte budget of the slice cache, least recently used slices are evicted beyond it",
+        type=int,
+        required=False,
+        default=100 * 1024**3,
+    )
+    train.add_argument(
+        "--memmap_dir",
+        help="Directory of the memory-mapped slice store to read instead of the HDF5 shards (see scripts/convert_kwyk_memmap.py)",
+        type=str,
+        required=False,
+        default="",
+    )
+    train.add_argument(
+        "--shm_dir",
+        help="Shared-memory directory (e.g. /dev/shm/kwyk) into which the filtered slices of each split are read once per node and shared by all workers and ranks; delete it after the job",
+        type=str,
+        required=False,
+        default="",
+    )
+    train.add_argument(
+        "--use_vds",
+        help="Flag for whether to read the shards through their virtual dataset file (see scripts/build_kwyk_vds.py)",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--roi_reads",
+        help="Flag for whether to read only the tissue bounding box of each slice from the shards, using the boxes in --slice_stats_file or in the shards (see hdf5_io.read_slice_roi)",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--roi_margin",
+        help="Number of pixels added around the tissue bounding box with --roi_reads",
+        type=int,
+        required=False,
+        default=4,
+    )
+    train.add_argument(
+        "--compact_samples",
+        help="Flag for whether the datasets return uint8 images and labels that are normalized and expanded to the model input once per batch",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--packed_data_dir",
+        help="Directory of the packed .npy slices to read instead of the files in --data_dir (see scripts/pack_nobrainer_slices.py)",
+        type=str,
+        required=False,
+        default="",
+    )
+    train.add_argument(
+        "--preprocessed_h5_dir",
+        help="Directory of the shards pre-processed for --nr_of_classes to read instead of --h5_dir (see scripts/preprocess_kwyk_shards.py)",
+        type=str,
+        required=False,
+        default="",
+    )
+    train.add_argument(
+        "--sampler",
+        help="How to shuffle the HDF5 training slices: random (full shuffle), block (locality-aware block shuffle), shard (disjoint, rotating runs of shards per rank and worker), or balanced (oversample rare classes)",
+        type=str,
+        required=False,
+        default="random",
+    )
+    train.add_argument(
+        "--shuffle_buffer_size",
+        help="Size of the shuffle buffer that interleaves blocks when --sampler block or shard",
+        type=int,
+        required=False,
+        default=4096,
+    )
+    train.add_argument(
+        "--sampler_temperature",
+        help="How strongly --sampler balanced oversamples rare classes (0 is uniform, 1 is inverse class frequency)",
+        type=float,
+        required=False,
+        default=0.5,
+    )
+    train.add_argument(
+        "--epoch_num_samples",
+        help="Number of slices drawn per epoch over all ranks when --sampler balanced (0 for the size of the train set)",
+        type=int,
+        required=False,
+        default=0,
+    )
+    train.add_argument(
+        "--class_counts_dir",
+        help="Directory of the class-count index (see scripts/build_class_counts.py); class presence is computed and cached here if it is missing",
+        type=str,
+        required=False,
+        default="/om/scratch/tmp/sabeen/kwyk_class_counts",
+    )
+    train.add_argument(
+        "--slice_index_dir",
+        help="Directory where the filtered slice index of each split is cached",
+        type=str,
+        required=False,
+        default="/om/scratch/tmp/sabeen/kwyk_slice_index",
+    )
+    train.add_argument(
+        "--slice_stats_file",
+        help="Slice statistics file used to filter the slices (see scripts/build_slice_stats.py) instead of the per-shard filtering files",
+        type=str,
+        required=False,
+        default="",
+    )
     train.add_argument(
         "--augment",
         help="Flag for whether to train on augmented data",
@@ -156,17 +156,19 @@ class Trainer:
 
             print(f"Process {self.fabric.global_rank}, batch {i}")
 
+            image, mask = self._prepare_batch(image, mask)
+
             self.optimizer.zero_grad()
-            probs = self.model(image.to(torch.float32))
-            loss = self.loss_fn(mask.long(), probs)
+            probs = self.model(image)
+            loss = self.loss_fn(mask, probs)
             self.fabric.backward(loss)
             self.optimizer.step()
 
             if self.config.class_specific_scores:
-                overall_dice, class_dice = self.metric(mask.long(), probs)
+                overall_dice, class_dice = self.metric(mask, probs)
             else:
                 class_dice = None
-                overall_dice = self.metric(mask.long(), probs)
+                overall_dice = self.metric(mask, probs)
             self.train_metrics.compute(
                 loss=loss.item(), metric=overall_dice.item(), class_dice=class_dice
             )
@@ -181,21 +183,46 @@ class Trainer:
         for i, (image, mask) in enumerate(self.val_loader):
             # mask[mask != 0] = 1 # uncomment for binary classification check
 
+            image, mask = self._prepare_batch(image, mask)
+
             # forward pass
             probs = self.model(image)
 
             # backward pass
             # loss, classDice = self.loss_fn(mask.long(), probs)
-            loss = self.loss_fn(mask.long(), probs)
+            loss = self.loss_fn(mask, probs)
             if self.config.class_specific_scores:
-                overall_dice, class_dice = self.metric(mask.long(), probs)
+                overall_dice, class_dice = self.metric(mask, probs)
             else:
                 class_dice = None
-                overall_dice = self.metric(mask.long(), probs)
+                overall_dice = self.metric(mask, probs)
             self.validation_metrics.compute(
                 loss=loss.item(), metric=overall_dice.item(), class_dice=class_dice
             )
 
+    def _prepare_batch(self, image, mask):
+        """
+        Converts a batch from the DataLoader to the dtypes expected by the model, loss, and metric.
+        With config.compact_samples, the datasets return uint8 images and labels, so the images are
+        scaled to 0 to 1 and expanded to the 3 channels of pretrained models (as a broadcast view) here,
+        once per batch on the device, and the labels are kept as uint8.
+
+        Args:
+            image (torch.tensor): batch of MRI slices of size [B,1,h,w] ([B,3,h,w] for pretrained models without compact_samples)
+            mask (torch.tensor): batch of label slices of size [B,1,h,w]
+
+        Returns:
+            image (torch.tensor): float32 batch of the model inputs
+            mask (torch.tensor): batch of labels (int64, or uint8 with compact_samples)
+        """
+        if not self.config.compact_samples:
+            return image.to(torch.float32), mask.long()
+
+        image = image.to(torch.float32) / 255.0
+        if self.config.pretrained and image.shape[1] == 1:
+            image = image.expand(-1, 3, -1, -1) # pretrained segformer takes 3-channel images as input
+        return image, mask
+
     def _log_metrics(self, epoch) -> None:
         """
         This function is used to log the train and validation loss and metrics for 
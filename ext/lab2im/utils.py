@@ -91,11 +91,20 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
     )
 
     if path_volume.endswith((".nii", ".nii.gz", ".mgz")):
-        x = nib.load(path_volume)
+        try:
+            # reads gzipped volumes from the decompressed cache of TissueLabeling if it is installed
+            from TissueLabeling.data.nifti_io import open_nifti
+        except ImportError:
+            open_nifti = nib.load
+
+        # read the stored dtype (memory-mapped if uncompressed) and only upcast to float64 like
+        # get_fdata if no dtype is requested, the astype below copies otherwise
+        x = open_nifti(path_volume)
+        volume = np.asanyarray(x.dataobj)
+        if dtype is None:
+            volume = volume.astype(np.float64)
         if squeeze:
-            volume = np.squeeze(x.get_fdata())
-        else:
-            volume = x.get_fdata()
+            volume = np.squeeze(volume)
         aff = x.affine
         header = x.header
     else:  # npz
@@ -5,13 +5,12 @@ import random
 import json
 import glob
 
-import numpy as np
 import torch
 # import webdataset as wds
 from scipy.ndimage import rotate
 from sklearn.model_selection import train_test_split
 
-from TissueLabeling.brain_utils import brain_coord, load_brains, mapping
+from TissueLabeling.brain_utils import extract_volume_slices, load_brains, mapping
 
 # import nobrainer
 
@@ -97,72 +96,18 @@ def matthias_files_to_volume_dir_slice():
             brain, brain_mask, image_nr = load_brains(image_file, mask_file, file_path)
             # brain_mask = mapping(brain_mask, nr_of_classes=NR_OF_CLASSES, original=True)
 
-            # slice the MRI volume in 3 directions
-            for d in range(3):
-                for i in range(brain.shape[d]):
-                    # get the slice
-                    if d == 0:
-                        brain_slice = brain[i, :, :]
-                        mask_slice = brain_mask[i, :, :]
-                    elif d == 1:
-                        brain_slice = brain[:, i, :]
-                        mask_slice = brain_mask[:, i, :]
-                    elif d == 2:
-                        brain_slice = brain[:, :, i]
-                        mask_slice = brain_mask[:, :, i]
-
-                    # skip slices with no or little brain (20% cutoff)
-                    if np.sum(brain_slice) < 52428:
-                        continue
-
-                    # find the crop
-                    for j in range(256):
-                        if (brain_slice[j] != 0).any():
-                            cut_top_temp = j
-                            break
-                    for j in range(256):
-                        if (brain_slice[255 - j] != 0).any():
-                            cut_bottom_temp = 255 - j
-                            break
-                    for j in range(256):
-                        if (brain_slice[:, j] != 0).any():
-                            cut_left_temp = j
-                            break
-                    for j in range(256):
-                        if (brain_slice[:, 255 - j] != 0).any():
-                            cut_right_temp = 255 - j
-                            break
-
-                    height_temp = cut_bottom_temp - cut_top_temp + 1
-                    width_temp = cut_right_temp - cut_left_temp + 1
-
-                    assert height_temp <= height, "Crop height is too big"
-                    assert width_temp <= width, "Crop width is too big"
-                    print("Patch height: ", height_temp)
-                    print("Patch width: ", width_temp)
-
-                    # crop image-optimal patch:
-                    brain_slice = brain_slice[
-                        cut_top_temp : cut_bottom_temp + 1,
-                        cut_left_temp : cut_right_temp + 1,
-                    ]
-                    mask_slice = mask_slice[
-                        cut_top_temp : cut_bottom_temp + 1,
-                        cut_left_temp : cut_right_temp + 1,
-                    ]
-
-                    if brain_slice.shape[0] < 50 or brain_slice.shape[1] < 50:
-                        too_small += 1
-                        continue
-
-                    assert (brain_slice > 0).any(), "Crop is empty"
-
-                    brain_filename = f"{save_path_mode}/brain_{idx}.npy"
-                    mask_filename = f"{save_path_mode}/mask_{idx}.npy"
-                    path_map[mode][f'{brain_filename}\n{mask_filename}'] = [image_file,mask_file,d,i]
-                    # path_map[mode][mask_filename] = [mask_file,d,i]
-
-                    idx += 1
+            # slice the MRI volume in 3 directions, skipping slices with no or little brain (20% cutoff)
+            # or a brain smaller than 50x50
+            extracted = extract_volume_slices(brain, brain_mask, height, width, crop_pad=False)
+            too_small += extracted["n_too_small"]
+
+            for d, i in zip(extracted["axes"], extracted["slice_indices"]):
+                brain_filename = f"{save_path_mode}/brain_{idx}.npy"
+                mask_filename = f"{save_path_mode}/mask_{idx}.npy"
+                path_map[mode][f'{brain_filename}\n{mask_filename}'] = [image_file,mask_file,int(d),int(i)]
+                # path_map[mode][mask_filename] = [mask_file,d,i]
+
+                idx += 1
 
     print("Number of patches too small: ", too_small)
 
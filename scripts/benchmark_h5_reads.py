@@ -0,0 +1,171 @@
+"""
+File: benchmark_h5_reads.py
+Author: Sabeen Lohawala
+Date: 2024-05-20
+Description: This script is used to benchmark slice reads from the HDF5 shards for different chunk cache,
+page buffer, and read-ahead settings.
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import time
+
+import numpy as np
+
+from TissueLabeling.data.hdf5_io import ReadAheadBuffer, open_shard
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "h5_dir",
+    help="Where the hdf5 chunks are saved",
+    type=str,
+)
+parser.add_argument(
+    "--n_slices",
+    help="Number of slices to read for each setting",
+    type=int,
+    required=False,
+    default=2000,
+)
+parser.add_argument(
+    "--access",
+    help="'random' reads uniformly random slices, 'local' reads runs of consecutive slices of the same volume and axis",
+    type=str,
+    required=False,
+    default="random",
+)
+parser.add_argument(
+    "--run_length",
+    help="Number of consecutive slices per run when --access local",
+    type=int,
+    required=False,
+    default=32,
+)
+parser.add_argument(
+    "--rdcc_nbytes",
+    help="Chunk cache sizes in bytes to benchmark",
+    type=int,
+    nargs="+",
+    default=[1024**2, 64 * 1024**2],
+)
+parser.add_argument(
+    "--rdcc_nslots",
+    help="Chunk cache hash table slots to benchmark",
+    type=int,
+    nargs="+",
+    default=[521, 10007],
+)
+parser.add_argument(
+    "--rdcc_w0",
+    help="Chunk cache eviction preferences to benchmark",
+    type=float,
+    nargs="+",
+    default=[0.75],
+)
+parser.add_argument(
+    "--page_buf_size",
+    help="Page buffer sizes in bytes to benchmark (0 disables the page buffer, non-zero requires paged shards)",
+    type=int,
+    nargs="+",
+    default=[0],
+)
+parser.add_argument(
+    "--read_ahead",
+    help="Read-ahead block sizes in slices to benchmark (0 disables read-ahead)",
+    type=int,
+    nargs="+",
+    default=[0, 16],
+)
+parser.add_argument(
+    "--seed", help="Random seed value", type=int, required=False, default=42
+)
+args = parser.parse_args()
+
+
+def get_access_pattern(h5_file_paths, n_slices, access, run_length, seed):
+    """
+    Draws the slices that are read for every setting, so all settings see the same requests.
+
+    Args:
+        h5_file_paths (list): paths of the shards
+        n_slices (int): number of slices to draw
+        access (str): 'random' or 'local'
+        run_length (int): number of consecutive slices per run for 'local' access
+        seed (int): random seed
+
+    Returns:
+        np.array: array of shape [n_slices, 4] with rows (shard_idx, shard_vol_idx, axis, slice_idx)
+    """
+    rng = np.random.default_rng(seed)
+    vol_shapes = []
+    for h5_path in h5_file_paths:
+        with open_shard(h5_path) as f:
+            vol_shapes.append(f["labels_axis0"].shape)
+
+    rows = []
+    while len(rows) < n_slices:
+        shard_idx = rng.integers(len(vol_shapes))
+        n_vols, *vol_shape = vol_shapes[shard_idx]
+        vol_idx = rng.integers(n_vols)
+        axis = rng.integers(3)
+        if access == "local":
+            start = rng.integers(vol_shape[axis] - run_length + 1)
+            rows.extend((shard_idx, vol_idx, axis, slice_idx) for slice_idx in range(start, start + run_length))
+        else:
+            rows.append((shard_idx, vol_idx, axis, rng.integers(vol_shape[axis])))
+    return np.array(rows[:n_slices])
+
+
+def time_setting(h5_file_paths, rows, rdcc_nbytes, rdcc_nslots, rdcc_w0, page_buf_size, read_ahead):
+    """
+    Reads the feature and label slices in rows with the given settings.
+
+    Returns:
+        float: the number of slices read per second
+    """
+    h5_pointers = [
+        open_shard(
+            h5_path,
+            rdcc_nbytes=rdcc_nbytes,
+            rdcc_nslots=rdcc_nslots,
+            rdcc_w0=rdcc_w0,
+            page_buf_size=page_buf_size,
+        )
+        for h5_path in h5_file_paths
+    ]
+    read_ahead_buffer = ReadAheadBuffer(read_ahead) if read_ahead else None
+
+    start_time = time.perf_counter()
+    for shard_idx, vol_idx, axis, slice_idx in rows:
+        f = h5_pointers[shard_idx]
+        if read_ahead_buffer is not None:
+            read_ahead_buffer.get(f, shard_idx, vol_idx, axis, slice_idx)
+        else:
+            indices = [vol_idx, slice(None), slice(None)]
+            indices.insert(axis + 1, slice_idx)
+            f[f"features_axis{axis}"][tuple(indices)]
+            f[f"labels_axis{axis}"][tuple(indices)]
+    elapsed = time.perf_counter() - start_time
+
+    for f in h5_pointers:
+        f.close()
+    return len(rows) / elapsed
+
+
+def main():
+    h5_file_paths = sorted(glob.glob(os.path.join(args.h5_dir, "*.h5")))
+    rows = get_access_pattern(h5_file_paths, args.n_slices, args.access, args.run_length, args.seed)
+
+    print(f"Reading {len(rows)} slices ({args.access} access) from {len(h5_file_paths)} shards")
+    print("rdcc_nbytes,rdcc_nslots,rdcc_w0,page_buf_size,read_ahead,slices_per_sec")
+    for setting in itertools.product(
+        args.rdcc_nbytes, args.rdcc_nslots, args.rdcc_w0, args.page_buf_size, args.read_ahead
+    ):
+        slices_per_sec = time_setting(h5_file_paths, rows, *setting)
+        print(",".join(str(value) for value in setting) + f",{slices_per_sec:.1f}")
+
+
+if __name__ == "__main__":
+    main()
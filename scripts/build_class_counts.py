@@ -0,0 +1,120 @@
+"""
+File: build_class_counts.py
+Author: Sabeen Lohawala
+Date: 2024-05-28
+Description: This script is used to build the per-slice class-count index of the KWYK HDF5 shards
+(see TissueLabeling/data/class_counts.py for the layout). Volumes are counted in parallel, one volume
+per task, and each volume is read once for all three axes.
+"""
+
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from TissueLabeling.data.class_counts import MAX_SLICES, N_CLASSES, count_volume_classes, write_class_count_meta
+from TissueLabeling.data.hdf5_io import get_shard_dataset, open_shard
+from TissueLabeling.data.label_mapping import get_label_mapper
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.utils import main_timer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "h5_dir",
+    help="Where the hdf5 chunks are saved",
+    type=str,
+)
+parser.add_argument(
+    "save_dir",
+    help="Where the class-count index will be written",
+    type=str,
+)
+parser.add_argument(
+    "--class_mapping",
+    help="Path to class_mapping.csv used to map the freesurfer labels to the 'index' column",
+    type=str,
+    required=False,
+    default="/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv",
+)
+args = parser.parse_args()
+
+H5_DIR = args.h5_dir
+SAVE_DIR = args.save_dir
+
+gettrace = getattr(sys, "gettrace", None)
+DEBUG = True if gettrace() else False
+
+h5_pointers = None # shard handles of each worker process, opened by init_worker
+lut = None
+
+
+def init_worker(h5_file_paths):
+    """
+    Opens the shards and compiles the label lookup table in a worker process.
+
+    Args:
+        h5_file_paths (list): paths of the shards
+    """
+    global h5_pointers, lut
+    h5_pointers = [open_shard(h5_path) for h5_path in h5_file_paths]
+    # the 106-class scheme is the 'index' column of class_mapping.csv
+    lut = get_label_mapper("original", args.class_mapping).class_lut(N_CLASSES)
+
+
+def count_volume(task):
+    """
+    Counts the classes of every slice of a volume within a shard.
+
+    Args:
+        task (tuple): (shard_idx, shard_vol_idx), which shard index and the index of the volume within the shard
+
+    Returns:
+        tuple: see TissueLabeling.data.class_counts.count_volume_classes
+    """
+    shard_idx, shard_vol_idx = task
+    print(f"Processing shard {shard_idx} volume {shard_vol_idx}")
+    label_vol = get_shard_dataset(h5_pointers[shard_idx], "labels")[shard_vol_idx]
+    return count_volume_classes(label_vol, lut)
+
+
+@main_timer
+def main():
+    manifest = ShardManifest.load(H5_DIR)
+    h5_file_paths = manifest.shard_paths
+
+    if not os.path.exists(SAVE_DIR):
+        os.makedirs(SAVE_DIR)
+
+    rows_per_vol = 3 * MAX_SLICES
+    offsets = np.zeros(manifest.n_vols * rows_per_vol + 1, dtype=np.int64)
+    presence = np.zeros((manifest.n_vols * rows_per_vol, -(-N_CLASSES // 8)), dtype=np.uint8)
+
+    n_procs = 1 if DEBUG else len(os.sched_getaffinity(0))
+    print(f"N PROC {n_procs}")
+    tasks = [
+        (shard_idx, shard_vol_idx)
+        for shard_idx, shard in enumerate(manifest.shards)
+        for shard_vol_idx in range(shard["n_vols"])
+    ]
+    # volumes come back in global volume order, so the entries are appended to the files as they arrive
+    with Pool(processes=n_procs, initializer=init_worker, initargs=(h5_file_paths,)) as pool, \
+            open(os.path.join(SAVE_DIR, "classes.bin"), "wb") as classes_file, \
+            open(os.path.join(SAVE_DIR, "counts.bin"), "wb") as counts_file:
+        for vol_idx, (lengths, classes, counts) in enumerate(pool.imap(count_volume, tasks, chunksize=4)):
+            start_row = vol_idx * rows_per_vol
+            offsets[start_row + 1 : start_row + rows_per_vol + 1] = offsets[start_row] + np.cumsum(lengths)
+            present = np.zeros((rows_per_vol, N_CLASSES), dtype=bool)
+            present[np.repeat(np.arange(rows_per_vol), lengths), classes] = True
+            presence[start_row : start_row + rows_per_vol] = np.packbits(present, axis=1)
+            classes_file.write(classes.tobytes())
+            counts_file.write(counts.tobytes())
+
+    np.save(os.path.join(SAVE_DIR, "offsets.npy"), offsets)
+    np.save(os.path.join(SAVE_DIR, "presence.npy"), presence)
+    write_class_count_meta(SAVE_DIR, manifest.n_vols)
+
+
+if __name__ == "__main__":
+    main()
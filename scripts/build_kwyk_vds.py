@@ -0,0 +1,31 @@
+"""
+File: build_kwyk_vds.py
+Author: Sabeen Lohawala
+Date: 2024-06-01
+Description: This script is used to write the HDF5 virtual dataset file that maps all KWYK shards of a
+directory into single [n_vols, 256, 256, 256] features and labels datasets (see
+ShardManifest.write_virtual_dataset). Only metadata is written, so this takes seconds; it has to be rerun
+whenever the shards are rewritten or moved.
+"""
+
+import argparse
+
+from TissueLabeling.data.manifest import ShardManifest
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "h5_dir",
+    help="Where the hdf5 chunks are saved",
+    type=str,
+)
+args = parser.parse_args()
+
+
+def main():
+    manifest = ShardManifest.load(args.h5_dir)
+    vds_path = manifest.write_virtual_dataset()
+    print(f"Wrote {vds_path} with {manifest.n_vols} volumes from {manifest.n_shards} shards")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+File: build_slice_stats.py
+Author: Sabeen Lohawala
+Date: 2024-05-29
+Description: This script is used to compute the per-slice statistics of all volumes of the KWYK HDF5 shards
+in one pass (see TissueLabeling/data/slice_stats.py) and save them to a single file, from which any of the
+slice filters can be applied at load time.
+"""
+
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+
+import h5py as h5
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+from TissueLabeling.data.hdf5_io import get_shard_dataset, open_shard
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.slice_stats import MAX_SLICES, STATS, STATS_GROUP, compute_volume_stats
+from TissueLabeling.utils import main_timer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "h5_dir",
+    help="Where the hdf5 chunks are saved",
+    type=str,
+)
+parser.add_argument(
+    "save_path",
+    help="Path of the .npz statistics file",
+    type=str,
+)
+parser.add_argument(
+    "--write_shards",
+    help="Flag for whether to also store the statistics of each shard in its slice_stats group",
+    type=int,
+    required=False,
+    default=0,
+)
+args = parser.parse_args()
+
+H5_DIR = args.h5_dir
+SAVE_PATH = args.save_path if args.save_path.endswith(".npz") else f"{args.save_path}.npz" # as np.savez names it
+
+gettrace = getattr(sys, "gettrace", None)
+DEBUG = True if gettrace() else False
+
+h5_pointers = None # shard handles of each worker process, opened by init_worker
+
+
+def init_worker(h5_file_paths):
+    """
+    Opens the shards in a worker process.
+
+    Args:
+        h5_file_paths (list): paths of the shards
+    """
+    global h5_pointers
+    h5_pointers = [open_shard(h5_path) for h5_path in h5_file_paths]
+
+
+def get_vol_stats(task):
+    """
+    Computes the statistics of a volume within a shard.
+
+    Args:
+        task (tuple): (shard_idx, shard_vol_idx), which shard index and the index of the volume within the shard
+
+    Returns:
+        dict: see TissueLabeling.data.slice_stats.compute_volume_stats
+    """
+    shard_idx, shard_vol_idx = task
+    print(f"Processing shard {shard_idx} volume {shard_vol_idx}")
+    f = h5_pointers[shard_idx]
+    feature_vol = get_shard_dataset(f, "features")[shard_vol_idx]
+    label_vol = get_shard_dataset(f, "labels")[shard_vol_idx]
+    return compute_volume_stats(feature_vol, label_vol)
+
+
+@main_timer
+def main():
+    manifest = ShardManifest.load(H5_DIR)
+    tasks = [
+        (shard_idx, shard_vol_idx)
+        for shard_idx, shard in enumerate(manifest.shards)
+        for shard_vol_idx in range(shard["n_vols"])
+    ]
+
+    stats = None
+    n_procs = 1 if DEBUG else len(os.sched_getaffinity(0))
+    print(f"N PROC {n_procs}")
+    with Pool(processes=n_procs, initializer=init_worker, initargs=(manifest.shard_paths,)) as pool:
+        for vol_idx, vol_stats in enumerate(pool.imap(get_vol_stats, tasks, chunksize=4)):
+            if stats is None:
+                stats = {
+                    name: np.zeros((manifest.n_vols, *vol_stats[name].shape), dtype=vol_stats[name].dtype)
+                    for name in STATS
+                }
+            for name in STATS:
+                stats[name][vol_idx] = vol_stats[name]
+
+    save_dir = os.path.dirname(SAVE_PATH)
+    if save_dir and not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    # the slice index and the tissue bounding boxes may be loading the file of a previous run
+    atomic_write(SAVE_PATH, lambda f: np.savez(f, n_vols=manifest.n_vols, max_slices=MAX_SLICES, **stats))
+    print(f"Wrote {SAVE_PATH}")
+
+    if args.write_shards:
+        for shard_idx, shard_path in enumerate(manifest.shard_paths):
+            start, end = manifest.vol_offsets[shard_idx], manifest.vol_offsets[shard_idx + 1]
+            with h5.File(shard_path, "a") as f:
+                if STATS_GROUP in f:
+                    del f[STATS_GROUP]
+                for name in STATS:
+                    f.create_dataset(f"{STATS_GROUP}/{name}", data=stats[name][start:end])
+            print(f"Wrote the statistics of {shard_path}")
+
+
+if __name__ == "__main__":
+    main()
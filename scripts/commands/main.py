@@ -17,6 +17,7 @@ import wandb
 
 from TissueLabeling.config import Configuration
 from TissueLabeling.data.dataset import get_data_loader
+from TissueLabeling.data.samplers import RankAwareSampler
 from TissueLabeling.metrics.metrics import Dice
 from TissueLabeling.metrics.losses import SoftmaxFocalLoss
 from TissueLabeling.models.segformer import Segformer
@@ -149,7 +150,12 @@ def main():
     optimizer = torch.optim.AdamW(model.parameters(), lr=config.lr)
 
     # fabric setup
-    train_loader, val_loader = fabric.setup_dataloaders(train_loader, val_loader)
+    # samplers from TissueLabeling.data.samplers already split the data across ranks
+    train_loader = fabric.setup_dataloaders(
+        train_loader,
+        use_distributed_sampler=not isinstance(train_loader.sampler, RankAwareSampler),
+    )
+    val_loader = fabric.setup_dataloaders(val_loader)
     model, optimizer = fabric.setup(model, optimizer)
 
     # init WandB
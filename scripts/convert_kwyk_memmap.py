@@ -0,0 +1,110 @@
+"""
+File: convert_kwyk_memmap.py
+Author: Sabeen Lohawala
+Date: 2024-05-21
+Description: This script is used to convert the KWYK HDF5 shards into the uncompressed, memory-mapped
+slice store read by MemmapSliceDataset (see TissueLabeling/data/memmap_store.py for the layout).
+"""
+
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+
+import h5py as h5
+import numpy as np
+
+from TissueLabeling.data.hdf5_io import get_shard_dataset
+from TissueLabeling.data.label_mapping import get_label_mapper
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.memmap_store import open_store, read_meta, write_meta
+from TissueLabeling.utils import main_timer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "h5_dir",
+    help="Where the hdf5 chunks are saved",
+    type=str,
+)
+parser.add_argument(
+    "save_dir",
+    help="Where the memory-mapped store will be written (preferably node-local NVMe or scratch)",
+    type=str,
+)
+parser.add_argument(
+    "--class_mapping",
+    help="Path to class_mapping.csv used to map the freesurfer labels to uint8",
+    type=str,
+    required=False,
+    default="/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv",
+)
+args = parser.parse_args()
+
+H5_DIR = args.h5_dir
+SAVE_DIR = args.save_dir
+
+gettrace = getattr(sys, "gettrace", None)
+DEBUG = True if gettrace() else False
+
+
+def convert_shard(shard_idx, h5_path, vol_offset, lut):
+    """
+    Writes all volumes of a shard into their rows of the store. Each volume is read once from
+    the axis 0 (or cubic) datasets and written in the slice order of all three axes.
+
+    Args:
+        shard_idx (int): which shard index
+        h5_path (str): path to the shard
+        vol_offset (int): the global index of the first volume of the shard
+        lut (np.array): the uint8 lookup table from the freesurfer labels to the 'index' column
+    """
+    meta, _ = read_meta(SAVE_DIR)
+    store = open_store(SAVE_DIR, meta, mode="r+")
+    vol_shape = meta["vol_shape"]
+    with h5.File(h5_path, "r") as f:
+        features, labels = get_shard_dataset(f, "features"), get_shard_dataset(f, "labels")
+        for shard_vol_idx in range(features.shape[0]):
+            print(f"Processing shard {shard_idx} volume {shard_vol_idx}")
+            feature = features[shard_vol_idx]
+            label = lut[labels[shard_vol_idx]]
+            for axis in range(3):
+                n_slices = vol_shape[axis]
+                start = (vol_offset + shard_vol_idx) * n_slices
+                slice_size = feature.size // n_slices
+                store[("features", axis)][start : start + n_slices, :slice_size] = np.moveaxis(feature, axis, 0).reshape(n_slices, -1)
+                store[("labels", axis)][start : start + n_slices, :slice_size] = np.moveaxis(label, axis, 0).reshape(n_slices, -1)
+    for memmap in store.values():
+        memmap.flush()
+
+
+@main_timer
+def main():
+    manifest = ShardManifest.load(H5_DIR)
+    h5_file_paths = manifest.shard_paths
+    shard_n_vols = [shard["n_vols"] for shard in manifest.shards]
+    vol_shape = manifest.vol_shape
+
+    if not os.path.exists(SAVE_DIR):
+        os.makedirs(SAVE_DIR)
+
+    # write the index and preallocate the files, then fill them in parallel (one process per shard)
+    meta = write_meta(SAVE_DIR, vol_shape, shard_n_vols)
+    open_store(SAVE_DIR, meta, mode="w+")
+    vol_offsets = manifest.vol_offsets
+    # the 106-class scheme is the 'index' column of class_mapping.csv
+    lut = get_label_mapper("original", args.class_mapping).class_lut(106)
+
+    n_procs = 1 if DEBUG else min(len(h5_file_paths), len(os.sched_getaffinity(0)))
+    print(f"N PROC {n_procs}")
+    with Pool(processes=n_procs) as pool:
+        pool.starmap(
+            convert_shard,
+            [
+                (shard_idx, h5_path, int(vol_offsets[shard_idx]), lut)
+                for shard_idx, h5_path in enumerate(h5_file_paths)
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
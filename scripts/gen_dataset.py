@@ -5,42 +5,62 @@ Date: 2024-04-29
 Description: This script is used to generate the HDF5 shards for the KWYK dataset.
 """
 
+import argparse
 import glob
 import os
+import sys
+import time
 from pathlib import Path
 
 import h5py as h5
-import nibabel as nib
 import numpy as np
 import pydra
 from pydra import mark
 from pydra.engine.specs import File
 
+from TissueLabeling.data.hdf5_io import (
+    CODECS,
+    LAYOUTS,
+    ReadAheadBuffer,
+    get_compression_kwargs,
+    get_layout_kwargs,
+    get_shard_dataset,
+)
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.nifti_io import load_nifti
+
 
 def write_kwyk_data(feature_files: list[File],
                     label_files: list[File],
                     save_path: str,
-                    comp: int=2) -> File:
-    """Write an HDF5 dataset with slices chunked for read efficiency"""
+                    comp: int=2,
+                    codec: str='gzip',
+                    layout: str='axis',
+                    chunk_size: int=64) -> File:
+    """Write an HDF5 dataset with slices chunked for read efficiency
+
+    comp is the compression level of codec (see TissueLabeling.data.hdf5_io.get_compression_kwargs)
+    layout 'axis' stores each volume once per slicing direction, 'cubic' stores it once
+    with chunk_size^3 chunks (see TissueLabeling.data.hdf5_io.get_layout_kwargs)
+    """
 
     N_VOLS = len(feature_files)
     feature_opts = {'dtype': np.uint8,
                     'shape': (N_VOLS, 256, 256, 256),
-                    'compression': comp}
+                    **get_compression_kwargs(codec, comp)}
     label_opts = feature_opts.copy()
     label_opts.update({'dtype': np.uint16})
 
     f = h5.File(save_path, "w")
     feature_ds = []
     label_ds = []
-    for idx, chunks in enumerate([(1, 1, 256, 256),
-                                  (1, 256, 1, 256),
-                                  (1, 256, 256, 1)]):
-        feature_ds.append(f.create_dataset(f"features_axis{idx}", chunks=chunks, **feature_opts))
-        label_ds.append(f.create_dataset(f"labels_axis{idx}", chunks=chunks, **label_opts))
+    for suffix, chunks in get_layout_kwargs(layout, chunk_size).items():
+        feature_ds.append(f.create_dataset(f"features{suffix}", chunks=chunks, **feature_opts))
+        label_ds.append(f.create_dataset(f"labels{suffix}", chunks=chunks, **label_opts))
     for idx, fname in enumerate(feature_files):
-        feature = nib.load(fname).dataobj
-        label = nib.load(label_files[idx]).dataobj
+        # decompress each volume once for all layouts, in its stored dtype
+        feature = load_nifti(fname)
+        label = load_nifti(label_files[idx])
         # add vol rotation here
         for ds_idx in range(len(feature_ds)):
             feature_ds[ds_idx][idx] = feature
@@ -49,7 +69,178 @@ def write_kwyk_data(feature_files: list[File],
     f.close()
     return save_path
 
+
+def benchmark_codecs(feature_files: list[File],
+                     label_files: list[File],
+                     out_dir: str,
+                     codec_specs: list[str],
+                     n_reads: int=500,
+                     seed: int=42) -> None:
+    """Write the same volumes with each codec and report on-disk size, write time and
+    random-slice decode throughput per axis
+
+    codec_specs are strings of the form codec[:level], e.g. gzip:2, lzf, blosc-zstd:5
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_vols = len(feature_files)
+    reads = [(rng.integers(n_vols), rng.integers(256)) for _ in range(n_reads)]
+
+    print("codec,level,size_mb,write_s,axis0_slices_per_s,axis1_slices_per_s,axis2_slices_per_s")
+    for codec_spec in codec_specs:
+        codec, _, level = codec_spec.partition(':')
+        level = int(level) if level else None
+        save_path = os.path.join(out_dir, f"benchmark_{codec_spec.replace(':', '_')}.h5")
+
+        start_time = time.perf_counter()
+        write_kwyk_data(feature_files, label_files, save_path, comp=level, codec=codec)
+        write_time = time.perf_counter() - start_time
+        size_mb = os.path.getsize(save_path) / 1024**2
+
+        throughput = []
+        with h5.File(save_path, 'r') as f:
+            for axis in range(3):
+                start_time = time.perf_counter()
+                for vol_idx, slice_idx in reads:
+                    indices = [vol_idx, slice(None), slice(None)]
+                    indices.insert(axis + 1, slice_idx)
+                    f[f"features_axis{axis}"][tuple(indices)]
+                    f[f"labels_axis{axis}"][tuple(indices)]
+                throughput.append(n_reads / (time.perf_counter() - start_time))
+        os.remove(save_path)
+
+        print(f"{codec},{level},{size_mb:.1f},{write_time:.1f}," + ",".join(f"{value:.1f}" for value in throughput))
+
+
+def benchmark_layouts(feature_files: list[File],
+                      label_files: list[File],
+                      out_dir: str,
+                      chunk_sizes: list[int],
+                      comp: int=2,
+                      codec: str='gzip',
+                      n_reads: int=500,
+                      seed: int=42) -> None:
+    """Write the same volumes with the per-axis layout and the cubic layout for each of
+    chunk_sizes, and report on-disk size, write time, random-slice throughput per axis
+    and sequential-slice throughput per axis (slices of one volume in order, served from
+    one read of each chunk row)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_vols = len(feature_files)
+    reads = [(rng.integers(n_vols), rng.integers(256)) for _ in range(n_reads)]
+    seq_vol = rng.integers(n_vols)
+
+    print("layout,chunk_size,size_mb,write_s,"
+          + ",".join(f"axis{axis}_random_slices_per_s" for axis in range(3)) + ","
+          + ",".join(f"axis{axis}_sequential_slices_per_s" for axis in range(3)))
+    for layout, chunk_size in [('axis', None)] + [('cubic', chunk_size) for chunk_size in chunk_sizes]:
+        save_path = os.path.join(out_dir, f"benchmark_{layout}_{chunk_size}.h5")
+
+        start_time = time.perf_counter()
+        write_kwyk_data(feature_files, label_files, save_path, comp=comp, codec=codec, layout=layout, chunk_size=chunk_size)
+        write_time = time.perf_counter() - start_time
+        size_mb = os.path.getsize(save_path) / 1024**2
+
+        random_throughput = []
+        sequential_throughput = []
+        with h5.File(save_path, 'r') as f:
+            for axis in range(3):
+                feature_ds = get_shard_dataset(f, 'features', axis)
+                label_ds = get_shard_dataset(f, 'labels', axis)
+                start_time = time.perf_counter()
+                for vol_idx, slice_idx in reads:
+                    indices = [vol_idx, slice(None), slice(None)]
+                    indices.insert(axis + 1, slice_idx)
+                    feature_ds[tuple(indices)]
+                    label_ds[tuple(indices)]
+                random_throughput.append(n_reads / (time.perf_counter() - start_time))
+
+                read_ahead_buffer = ReadAheadBuffer(chunk_size or 1, max_blocks=1)
+                start_time = time.perf_counter()
+                for slice_idx in range(256):
+                    read_ahead_buffer.get(f, 0, seq_vol, axis, slice_idx)
+                sequential_throughput.append(256 / (time.perf_counter() - start_time))
+        os.remove(save_path)
+
+        print(f"{layout},{chunk_size},{size_mb:.1f},{write_time:.1f},"
+              + ",".join(f"{value:.1f}" for value in random_throughput + sequential_throughput))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--codec",
+        help=f"Compression codec for the shard datasets, one of {CODECS}",
+        type=str,
+        required=False,
+        default="gzip",
+    )
+    parser.add_argument(
+        "--level",
+        help="Compression level of the codec",
+        type=int,
+        required=False,
+        default=2,
+    )
+    parser.add_argument(
+        "--layout",
+        help=f"Layout of the volumes in the shards, one of {LAYOUTS}",
+        type=str,
+        required=False,
+        default="axis",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        help="Edge length of the cubic chunks when --layout cubic",
+        type=int,
+        required=False,
+        default=64,
+    )
+    parser.add_argument(
+        "--vols_per_shard",
+        help="Number of volumes written to each shard",
+        type=int,
+        required=False,
+        default=1150,
+    )
+    parser.add_argument(
+        "--benchmark",
+        help="Instead of writing the shards, benchmark the codecs in --benchmark_codecs on --benchmark_n_vols volumes",
+        type=int,
+        required=False,
+        default=0,
+    )
+    parser.add_argument(
+        "--benchmark_codecs",
+        help="Codecs to benchmark as codec[:level]",
+        type=str,
+        nargs="+",
+        default=["none", "lzf", "gzip:1", "gzip:2", "gzip:6", "blosc-lz4:5", "blosc-zstd:3", "zstd:3"],
+    )
+    parser.add_argument(
+        "--benchmark_layouts",
+        help="Instead of writing the shards, benchmark the axis layout against the cubic layout with each of --benchmark_chunk_sizes",
+        type=int,
+        required=False,
+        default=0,
+    )
+    parser.add_argument(
+        "--benchmark_chunk_sizes",
+        help="Cubic chunk sizes to benchmark",
+        type=int,
+        nargs="+",
+        default=[32, 64],
+    )
+    parser.add_argument(
+        "--benchmark_n_vols",
+        help="Number of volumes to write for each benchmarked codec or layout",
+        type=int,
+        required=False,
+        default=10,
+    )
+    args = parser.parse_args()
+
     OUT_DIR = f"/om2/scratch/Sat/{os.environ['USER']}"  # CHECK THIS
     os.makedirs(OUT_DIR, exist_ok=True)
 
@@ -59,13 +250,28 @@ if __name__ == "__main__":
     feature_files = sorted(glob.glob(os.path.join(NIFTI_DIR, "*orig*")))
     label_files = sorted(glob.glob(os.path.join(NIFTI_DIR, "*aseg*")))
 
+    if args.benchmark:
+        benchmark_codecs(feature_files[:args.benchmark_n_vols],
+                         label_files[:args.benchmark_n_vols],
+                         os.path.join(OUT_DIR, "codec_benchmark"),
+                         args.benchmark_codecs)
+        sys.exit()
+    if args.benchmark_layouts:
+        benchmark_layouts(feature_files[:args.benchmark_n_vols],
+                          label_files[:args.benchmark_n_vols],
+                          os.path.join(OUT_DIR, "layout_benchmark"),
+                          args.benchmark_chunk_sizes,
+                          comp=args.level,
+                          codec=args.codec)
+        sys.exit()
+
     N = len(feature_files)
     DEBUG = False
     if DEBUG:
         N_VOLS_PER_SHARD = 10
         N_SHARDS = 5
     else:
-        N_VOLS_PER_SHARD = 1150
+        N_VOLS_PER_SHARD = args.vols_per_shard
         N_SHARDS = int(np.ceil(N / N_VOLS_PER_SHARD))
     features = []
     labels = []
@@ -82,10 +288,14 @@ if __name__ == "__main__":
         
     write_task_pdt = mark.task(write_kwyk_data)
     cache_dir = (Path(os.getcwd()) / 'wf_cache').absolute()
-    write_task = write_task_pdt() # not using cache for the moment
+    write_task = write_task_pdt(comp=args.level, codec=args.codec, layout=args.layout, chunk_size=args.chunk_size) # not using cache for the moment
     write_task.split(splitter=('feature_files', 'label_files', 'save_path'),
                      feature_files=features,
                      label_files=labels,
                      save_path=paths)
     with pydra.Submitter(plugin='cf', n_procs=N_SHARDS) as sub:
         sub(runnable=write_task)
+
+    # record the geometry of the shards so readers don't depend on the number of volumes per shard
+    manifest_path = ShardManifest.from_shards(paths, codec=args.codec, level=args.level).write()
+    print(f"Wrote manifest {manifest_path}")
@@ -6,14 +6,15 @@ Description: This script is used to obtain the slice filtering files for the HDF
 """
 
 import os
-import glob
-import h5py as h5
 import sys
 import argparse
 
 import numpy as np
 from multiprocessing import Pool
 
+from TissueLabeling.data.hdf5_io import get_shard_dataset, open_shard
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.slice_stats import compute_volume_stats
 from TissueLabeling.utils import main_timer
 
 parser = argparse.ArgumentParser()
@@ -39,6 +40,41 @@ parser.add_argument(
     required=False,
     default=0
 )
+parser.add_argument(
+    "--rdcc_nbytes",
+    help="Size in bytes of the HDF5 chunk cache of each shard dataset",
+    type=int,
+    required=False,
+    default=1024**2,
+)
+parser.add_argument(
+    "--rdcc_nslots",
+    help="Number of hash table slots of the HDF5 chunk cache",
+    type=int,
+    required=False,
+    default=521,
+)
+parser.add_argument(
+    "--rdcc_w0",
+    help="HDF5 chunk cache preference (0 to 1) for evicting fully read chunks",
+    type=float,
+    required=False,
+    default=0.75,
+)
+parser.add_argument(
+    "--page_buf_size",
+    help="Size in bytes of the HDF5 page buffer (0 to disable, requires paged shards)",
+    type=int,
+    required=False,
+    default=0,
+)
+parser.add_argument(
+    "--use_vds",
+    help="Flag for whether to read the volumes through the virtual dataset of the shards (see scripts/build_kwyk_vds.py)",
+    type=int,
+    required=False,
+    default=0,
+)
 args = parser.parse_args()
 
 # H5_PATHS = '/om/scratch/tmp/sabeen/kwyk_chunk/'
@@ -50,8 +86,36 @@ FIND_MATTHIAS_FILTER = args.find_matthias_filter
 gettrace = getattr(sys, "gettrace", None)
 DEBUG = True if gettrace() else False
 
-h5_file_paths = glob.glob(os.path.join(H5_DIR, '*.h5'))
-h5_pointers = [h5.File(h5_path,'r') for h5_path in h5_file_paths]
+H5_OPEN_KWARGS = {
+    'rdcc_nbytes': args.rdcc_nbytes,
+    'rdcc_nslots': args.rdcc_nslots,
+    'rdcc_w0': args.rdcc_w0,
+    'page_buf_size': args.page_buf_size,
+}
+
+MANIFEST = ShardManifest.load(H5_DIR)
+# with the virtual dataset, a single handle serves every shard and volumes are addressed by global index
+READ_MANIFEST = MANIFEST.virtual() if args.use_vds else MANIFEST
+h5_pointers = [open_shard(h5_path, **H5_OPEN_KWARGS) for h5_path in READ_MANIFEST.shard_paths]
+
+def get_vol_stats(shard_idx,shard_vol_idx):
+    """
+    Computes all per-slice statistics of a volume within a shard from a single read of the volume
+    (see TissueLabeling.data.slice_stats.compute_volume_stats).
+
+    Args:
+        shard_idx (int): which shard index
+        shard_vol_index: the index of the volume within the shard
+    
+    Returns:
+        dict: the statistics of the slices of the volume along all three axes
+    """
+    print(f'Processing shard {shard_idx} volume {shard_vol_idx}')
+    read_shard_idx, read_vol_idx = READ_MANIFEST.locate(MANIFEST.global_vol_indices(shard_idx, shard_vol_idx))
+    f = h5_pointers[read_shard_idx]
+    feature_vol = get_shard_dataset(f, 'features')[read_vol_idx]
+    label_vol = get_shard_dataset(f, 'labels')[read_vol_idx]
+    return compute_volume_stats(feature_vol, label_vol)
 
 def get_vol_feature_sum(shard_idx,vol_shape,shard_vol_idx):
     """
@@ -65,19 +129,7 @@ def get_vol_feature_sum(shard_idx,vol_shape,shard_vol_idx):
     Returns:
         slice_nonbrain (np.array): the sum of the slices in the volume
     """
-    print(f'Processing shard {shard_idx} volume {shard_vol_idx}')
-    f = h5_pointers[shard_idx]
-    vol_shape = f['features_axis0'].shape
-    slices_nonbrain = np.ones((3,256), dtype=np.int32)
-    for axis in range(3):
-        for slice_idx in range(vol_shape[axis+1]):
-            indices = [shard_vol_idx, slice(None), slice(None)]
-            indices.insert(axis + 1, slice_idx)
-            img = f[f'features_axis{axis}'][tuple(indices)]
-            mask = f[f'labels_axis{axis}'][tuple(indices)]
-            img[mask == 0] = 0
-            slices_nonbrain[axis, slice_idx] = np.sum(img)
-    return slices_nonbrain
+    return get_vol_stats(shard_idx, shard_vol_idx)['feature_sum'].astype(np.int32)
 
 def get_vol_matthias(shard_idx,vol_shape,shard_vol_idx):
     """
@@ -91,26 +143,7 @@ def get_vol_matthias(shard_idx,vol_shape,shard_vol_idx):
     Returns:
         slice_nonbrain (np.array): the sum of the slices in the volume
     """
-    print(f'Processing shard {shard_idx} volume {shard_vol_idx}')
-    f = h5_pointers[shard_idx]
-    vol_shape = f['features_axis0'].shape
-    slices_nonbrain = np.ones((3,256), dtype=np.uint16)
-    for axis in range(3):
-        for slice_idx in range(vol_shape[axis+1]):
-            indices = [shard_vol_idx, slice(None), slice(None)]
-            indices.insert(axis + 1, slice_idx)
-            img = f[f'features_axis{axis}'][tuple(indices)]
-            mask = f[f'labels_axis{axis}'][tuple(indices)]
-            img[mask == 0] = 0
-            # if sum(img) < xxxxx, slices_nonbrain[axis, slice_idx] = 0 (exclude slice)
-            if np.sum(img) < 52428:
-                slices_nonbrain[axis, slice_idx] = 0
-            else:
-                # if dim < 50, slice_nonbrain[axis,slice_idx] = 0 (exclude slice)
-                nonzero_indices = np.nonzero(img)
-                if (np.max(nonzero_indices[0]) - np.min(nonzero_indices[0]) + 1 < 50) or (np.max(nonzero_indices[1]) - np.min(nonzero_indices[1]) + 1 < 50):
-                    slices_nonbrain[axis, slice_idx] = 0
-    return slices_nonbrain
+    return get_vol_stats(shard_idx, shard_vol_idx)['matthias'].astype(np.uint16)
 
 def get_vol_nonzero(shard_idx,vol_shape,shard_vol_idx):
     """
@@ -124,17 +157,7 @@ def get_vol_nonzero(shard_idx,vol_shape,shard_vol_idx):
     Returns:
         slice_nonbrain (np.array): the sum of the slices in the volume
     """
-    print(f'Processing shard {shard_idx} volume {shard_vol_idx}')
-    f = h5_pointers[shard_idx]
-    vol_shape = f['labels_axis0'].shape
-    slices_nonbrain = np.ones((3,256), dtype=np.uint16)
-    for axis in range(3):
-        for slice_idx in range(vol_shape[axis+1]):
-            indices = [shard_vol_idx, slice(None), slice(None)]
-            indices.insert(axis + 1, slice_idx)
-            img = f[f'labels_axis{axis}'][tuple(indices)]
-            slices_nonbrain[axis,slice_idx] = min(np.sum(img==0), 65535)
-    return slices_nonbrain
+    return np.minimum(get_vol_stats(shard_idx, shard_vol_idx)['bg_count'], 65535).astype(np.uint16)
 
 @main_timer
 def get_shard_nonzero(shard_idx):
@@ -148,7 +171,7 @@ def get_shard_nonzero(shard_idx):
         np.array: the output of the volume filtering function for all volumes within a shard
     """
     # slices_nonbrain = np.ones((1150,3,256), dtype=np.uint16)
-    vol_shape = h5_pointers[shard_idx]['labels_axis0'].shape
+    vol_shape = (MANIFEST.shards[shard_idx]['n_vols'], *MANIFEST.vol_shape)
     # for shard_vol_idx in range(vol_shape[0]):
 
     get_vol_filter = get_vol_feature_sum if FIND_MATTHIAS_FILTER == 2 else get_vol_matthias if FIND_MATTHIAS_FILTER == 1 else get_vol_nonzero
@@ -170,11 +193,6 @@ def get_shard_nonzero(shard_idx):
     return np.stack(slices_nonbrain)
 
 def main():
-    h5_file_paths = glob.glob(os.path.join(H5_DIR, '*.h5'))
-    h5_pointers = []
-    for h5_path in h5_file_paths:
-        h5_pointers.append(h5.File(h5_path,'r'))
-    
     if not os.path.exists(SAVE_DIR):
         os.makedirs(SAVE_DIR)
 
@@ -0,0 +1,276 @@
+"""
+File: ingest_kwyk.py
+Author: Sabeen Lohawala
+Date: 2024-05-30
+Description: This script is used to write the KWYK HDF5 shards from the NIfTI volumes with a pipelined ingest:
+each shard has a single writer process, fed in volume order through a bounded queue by a pool of decode threads
+(gzip inflation releases the GIL, so the threads decode in parallel while the writer compresses). Writers of
+different shards run in parallel. After every volume the writer flushes the shard and records the number of
+completed volumes in a checkpoint file, so an interrupted ingest resumes from the last completed volume.
+Optionally, the per-slice statistics of TissueLabeling/data/slice_stats.py are computed by the decode threads
+and stored in the slice_stats group of each shard.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+import h5py as h5
+import numpy as np
+
+from TissueLabeling.data.atomic_io import atomic_write
+from TissueLabeling.data.hdf5_io import CODECS, LAYOUTS, get_compression_kwargs, get_layout_kwargs
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.nifti_io import load_nifti
+from TissueLabeling.data.slice_stats import MAX_SLICES, STATS, STATS_GROUP, compute_volume_stats
+from TissueLabeling.utils import main_timer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "nifti_dir",
+    help="Directory of the *orig* and *aseg* NIfTI volumes",
+    type=str,
+)
+parser.add_argument(
+    "out_dir",
+    help="Where the hdf5 chunks will be written",
+    type=str,
+)
+parser.add_argument(
+    "--codec",
+    help=f"Compression codec for the shard datasets, one of {CODECS}",
+    type=str,
+    required=False,
+    default="gzip",
+)
+parser.add_argument(
+    "--level",
+    help="Compression level of the codec",
+    type=int,
+    required=False,
+    default=2,
+)
+parser.add_argument(
+    "--layout",
+    help=f"Layout of the volumes in the shards, one of {LAYOUTS}",
+    type=str,
+    required=False,
+    default="axis",
+)
+parser.add_argument(
+    "--chunk_size",
+    help="Edge length of the cubic chunks when --layout cubic",
+    type=int,
+    required=False,
+    default=64,
+)
+parser.add_argument(
+    "--vols_per_shard",
+    help="Number of volumes written to each shard",
+    type=int,
+    required=False,
+    default=1150,
+)
+parser.add_argument(
+    "--n_writers",
+    help="Number of shards written in parallel (one writer process each); defaults to the number of shards",
+    type=int,
+    required=False,
+    default=0,
+)
+parser.add_argument(
+    "--n_decoders",
+    help="Number of decode threads of each writer",
+    type=int,
+    required=False,
+    default=4,
+)
+parser.add_argument(
+    "--queue_size",
+    help="Maximum number of decoded volumes waiting for each writer",
+    type=int,
+    required=False,
+    default=8,
+)
+parser.add_argument(
+    "--stats",
+    help="Flag for whether to compute the per-slice statistics during the ingest",
+    type=int,
+    required=False,
+    default=0,
+)
+parser.add_argument(
+    "--stats_file",
+    help="(optional) path of a single .npz with the statistics of all shards, written at the end when --stats 1",
+    type=str,
+    required=False,
+    default="",
+)
+args = parser.parse_args()
+
+
+def decode_volume(feature_file, label_file, with_stats):
+    """
+    Loads a feature and label volume and optionally computes their per-slice statistics.
+
+    Args:
+        feature_file (str): path to the *orig* volume
+        label_file (str): path to the corresponding *aseg* volume
+        with_stats (bool): whether to compute the statistics
+
+    Returns:
+        feature (np.array): the uint8 MRI volume
+        label (np.array): the uint16 label volume
+        stats (dict | None): see TissueLabeling.data.slice_stats.compute_volume_stats
+    """
+    feature = load_nifti(feature_file).astype(np.uint8)
+    label = load_nifti(label_file).astype(np.uint16)
+    stats = compute_volume_stats(feature, label) if with_stats else None
+    return feature, label, stats
+
+
+def get_checkpoint_path(save_path):
+    return f"{save_path}.checkpoint.json"
+
+
+def read_checkpoint(save_path):
+    """
+    Gets the number of volumes of a shard that were completely written by a previous run.
+
+    Args:
+        save_path (str): path to the shard
+
+    Returns:
+        int: the number of completed volumes, 0 if the shard has not been started
+    """
+    checkpoint_path = get_checkpoint_path(save_path)
+    if not os.path.exists(save_path) or not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return json.load(f)["n_done"]
+
+
+def write_checkpoint(save_path, n_done, n_vols):
+    """
+    Records the number of completed volumes of a shard, replacing the checkpoint atomically.
+    """
+    checkpoint_path = get_checkpoint_path(save_path)
+    atomic_write(checkpoint_path, lambda f: json.dump({"n_done": n_done, "n_vols": n_vols}, f), mode="w")
+
+
+def write_shard(shard_idx, feature_files, label_files, save_path):
+    """
+    Writes (or resumes writing) one shard.
+
+    Args:
+        shard_idx (int): which shard index
+        feature_files (list): paths to the *orig* volumes of the shard, in order
+        label_files (list): paths to the corresponding *aseg* volumes
+        save_path (str): path to the shard
+
+    Returns:
+        str: the path of the shard
+    """
+    n_vols = len(feature_files)
+    n_done = read_checkpoint(save_path)
+    if n_done == n_vols:
+        print(f"shard {shard_idx}: already complete")
+        return save_path
+
+    f = h5.File(save_path, "a" if n_done > 0 else "w")
+    if n_done == 0:
+        compression_kwargs = get_compression_kwargs(args.codec, args.level)
+        for suffix, chunks in get_layout_kwargs(args.layout, args.chunk_size).items():
+            f.create_dataset(f"features{suffix}", shape=(n_vols, 256, 256, 256), dtype=np.uint8, chunks=chunks, **compression_kwargs)
+            f.create_dataset(f"labels{suffix}", shape=(n_vols, 256, 256, 256), dtype=np.uint16, chunks=chunks, **compression_kwargs)
+        if args.stats:
+            stats = compute_volume_stats(np.zeros((1, 1, 1), dtype=np.uint8), np.zeros((1, 1, 1), dtype=np.uint16))
+            for name in STATS:
+                f.create_dataset(f"{STATS_GROUP}/{name}", shape=(n_vols, *stats[name].shape), dtype=stats[name].dtype)
+    else:
+        print(f"shard {shard_idx}: resuming after volume {n_done}")
+    feature_ds = [dataset for name, dataset in f.items() if name.startswith("features")]
+    label_ds = [dataset for name, dataset in f.items() if name.startswith("labels")]
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.n_decoders) as executor:
+        # bounded in-order pipeline: at most queue_size volumes are decoded ahead of the writer
+        pending = deque()
+        next_vol = n_done
+        for shard_vol_idx in range(n_done, n_vols):
+            while next_vol < n_vols and len(pending) < args.queue_size:
+                pending.append(executor.submit(decode_volume, feature_files[next_vol], label_files[next_vol], bool(args.stats)))
+                next_vol += 1
+            feature, label, stats = pending.popleft().result()
+            for dataset in feature_ds:
+                dataset[shard_vol_idx] = feature
+            for dataset in label_ds:
+                dataset[shard_vol_idx] = label
+            if stats is not None:
+                for name in STATS:
+                    f[f"{STATS_GROUP}/{name}"][shard_vol_idx] = stats[name]
+            f.flush()
+            write_checkpoint(save_path, shard_vol_idx + 1, n_vols)
+
+            n_written = shard_vol_idx + 1 - n_done
+            if n_written % 10 == 0 or shard_vol_idx + 1 == n_vols:
+                rate = n_written / (time.perf_counter() - start_time)
+                print(f"shard {shard_idx}: {shard_vol_idx + 1}/{n_vols} volumes, {rate:.2f} volumes/s")
+    f.close()
+    return save_path
+
+
+def merge_stats(shard_paths, stats_file):
+    """
+    Concatenates the statistics stored in the shards into a single file in the format of
+    scripts/build_slice_stats.py.
+
+    Args:
+        shard_paths (list): paths to the shards, in the order of the global volume indices
+        stats_file (str): path of the .npz to write
+    """
+    stats = {name: [] for name in STATS}
+    for shard_path in shard_paths:
+        with h5.File(shard_path, "r") as f:
+            for name in STATS:
+                stats[name].append(f[f"{STATS_GROUP}/{name}"][:])
+    stats = {name: np.concatenate(arrays) for name, arrays in stats.items()}
+    np.savez(stats_file, n_vols=len(stats["bg_count"]), max_slices=MAX_SLICES, **stats)
+    print(f"Wrote {stats_file}")
+
+
+@main_timer
+def main():
+    os.makedirs(args.out_dir, exist_ok=True)
+    feature_files = sorted(glob.glob(os.path.join(args.nifti_dir, "*orig*")))
+    label_files = sorted(glob.glob(os.path.join(args.nifti_dir, "*aseg*")))
+    assert len(feature_files) == len(label_files), "expected one *aseg* volume per *orig* volume"
+
+    n = len(feature_files)
+    n_shards = int(np.ceil(n / args.vols_per_shard))
+    tasks = []
+    for shard_idx in range(n_shards):
+        start = shard_idx * args.vols_per_shard
+        end = min((shard_idx + 1) * args.vols_per_shard, n)
+        save_path = os.path.join(args.out_dir, f"kwyk_chunk_{shard_idx:02d}.h5")
+        tasks.append((shard_idx, feature_files[start:end], label_files[start:end], save_path))
+
+    n_writers = args.n_writers if args.n_writers else n_shards
+    print(f"Processing {n} files with {args.vols_per_shard} per shard into {n_shards} shards with {n_writers} writers")
+    with Pool(processes=n_writers) as pool:
+        shard_paths = pool.starmap(write_shard, tasks)
+
+    # record the geometry of the shards so readers don't depend on the number of volumes per shard
+    manifest_path = ShardManifest.from_shards(shard_paths, codec=args.codec, level=args.level).write()
+    print(f"Wrote manifest {manifest_path}")
+    if args.stats and args.stats_file:
+        merge_stats(shard_paths, args.stats_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,13 @@ import os
 from datetime import datetime
 from multiprocessing import Pool
 import argparse
-import nibabel as nib
+import zlib
 import numpy as np
 import torch
 from sklearn.model_selection import train_test_split
 
+from TissueLabeling.data.nifti_io import load_nifti
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "data_dir", help="Directory where KWYK volumes are to be read from", type=str
@@ -35,12 +37,28 @@ parser.add_argument(
     required=False,
     default=10,
 )
+parser.add_argument(
+    "--nifti_cache_dir",
+    help="Directory (e.g. on node-local disk) to cache the decompressed volumes in, see TissueLabeling/data/nifti_io.py",
+    type=str,
+    required=False,
+    default="",
+)
+parser.add_argument(
+    "--inflate_threads",
+    help="Number of pigz threads to decompress each volume with when it is cached",
+    type=int,
+    required=False,
+    default=1,
+)
 args = parser.parse_args()
 
 DATA_DIR = args.data_dir # "/om2/scratch/Mon/sabeen/kwyk-volumes/rawdata/"
 SAVE_DIR = args.save_dir # "/om2/user/sabeen/kwyk_data/"
 SAVE_NAME = args.save_name # "new_kwyk_full.npy"
 N_VOLS = args.n_vols  # number of volumes to load (this is only for testing)
+NIFTI_CACHE_DIR = args.nifti_cache_dir
+INFLATE_THREADS = args.inflate_threads
 
 
 def main_timer(func):
@@ -72,7 +90,7 @@ def calculate_bg(label_file):
         np.array: the percent background for each of the three axes
     """
     print(os.path.basename(label_file))
-    label_vol = nib.load(label_file).get_fdata().astype(np.int16)
+    label_vol = load_nifti(label_file, NIFTI_CACHE_DIR, INFLATE_THREADS) # stored dtype, no float64 copy
 
     bg = label_vol == 0
     bgcount_ax0 = np.sum(bg, axis=(1, 2)) / 256**2
@@ -102,7 +120,11 @@ def main():
 
 
 class SampleDataset(torch.utils.data.Dataset):
-    def __init__(self, mode, volume_data_dir, slice_info_file, bg_percent=0.99):
+    def __init__(self, mode, volume_data_dir, slice_info_file, bg_percent=0.99, volume_cache=None):
+        # (optional) TissueLabeling.data.volume_cache.VolumeCache so that each volume is decoded once instead of twice per slice
+        self.volume_cache = volume_cache
+        # keeps the volumes of different data directories apart in a shared cache directory
+        self.cache_namespace = f"{zlib.crc32(os.path.abspath(volume_data_dir).encode()):08x}"
         self.matrix = torch.from_numpy(np.load(slice_info_file, allow_pickle=True))
 
         self.feature_label_files = list(
@@ -145,10 +167,26 @@ class SampleDataset(torch.utils.data.Dataset):
 
         feature_file, label_file = self.feature_label_files[file_idx]
 
+        if self.volume_cache is not None:
+            # cache the volumes in their stored dtype and only cast the slice
+            feature_vol, label_vol = self.volume_cache.get(
+                (self.cache_namespace, int(file_idx)),
+                lambda: (
+                    np.asarray(load_nifti(feature_file, NIFTI_CACHE_DIR, INFLATE_THREADS)),
+                    np.asarray(load_nifti(label_file, NIFTI_CACHE_DIR, INFLATE_THREADS)),
+                ),
+            )
+            feature_slice = np.take(feature_vol, int(slice_idx), axis=int(direction_idx))
+            label_slice = np.take(label_vol, int(slice_idx), axis=int(direction_idx))
+            return (
+                torch.from_numpy(feature_slice.astype(np.float32)).unsqueeze(0),
+                torch.from_numpy(label_slice.astype(np.int16)).unsqueeze(0),
+            )
+
         feature_vol = torch.from_numpy(
-            nib.load(feature_file).get_fdata().astype(np.float32)
+            load_nifti(feature_file, NIFTI_CACHE_DIR, INFLATE_THREADS).astype(np.float32)
         )
-        label_vol = torch.from_numpy(nib.load(label_file).get_fdata().astype(np.int16))
+        label_vol = torch.from_numpy(load_nifti(label_file, NIFTI_CACHE_DIR, INFLATE_THREADS).astype(np.int16))
 
         feature_slice = torch.index_select(feature_vol, direction_idx, slice_idx)
         label_slice = torch.index_select(label_vol, direction_idx, slice_idx)
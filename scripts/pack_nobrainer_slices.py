@@ -0,0 +1,85 @@
+"""
+File: pack_nobrainer_slices.py
+Author: Sabeen Lohawala
+Date: 2024-05-31
+Description: This script is used to pack the .npy slice files read by NoBrainerDataset into a few large
+files with an offset index and a manifest (see TissueLabeling/data/packed_slices.py for the layout).
+The slices are listed once here, so training runs with --packed_data_dir don't have to glob the files.
+"""
+
+import argparse
+import glob
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from TissueLabeling.data.packed_slices import write_manifest, write_pack
+from TissueLabeling.utils import main_timer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "data_dir",
+    help="Directory with the train, validation, and test directories of .npy slices (config.data_dir)",
+    type=str,
+)
+parser.add_argument(
+    "save_dir",
+    help="Where the packed files will be written",
+    type=str,
+)
+parser.add_argument(
+    "--new_kwyk_data",
+    help="Flag for whether the slices are in features/*orig* and labels/*aseg* (1) or brain*.npy and mask*.npy (0)",
+    type=int,
+    required=False,
+    default=0,
+)
+parser.add_argument(
+    "--pack_bytes",
+    help="Maximum number of bytes per pack file",
+    type=int,
+    required=False,
+    default=2**32,
+)
+args = parser.parse_args()
+
+gettrace = getattr(sys, "gettrace", None)
+DEBUG = True if gettrace() else False
+
+
+@main_timer
+def main():
+    n_procs = 1 if DEBUG else len(os.sched_getaffinity(0))
+    print(f"N PROC {n_procs}")
+    for mode in ["train", "validation", "test"]:
+        # same file lists as NoBrainerDataset
+        if args.new_kwyk_data:
+            files = {
+                "images": sorted(glob.glob(f"{args.data_dir}/{mode}/features/*orig*")),
+                "masks": sorted(glob.glob(f"{args.data_dir}/{mode}/labels/*aseg*")),
+            }
+        else:
+            files = {
+                "images": sorted(glob.glob(f"{args.data_dir}/{mode}/brain*.npy")),
+                "masks": sorted(glob.glob(f"{args.data_dir}/{mode}/mask*.npy")),
+            }
+        if not files["images"]:
+            print(f"{mode}: no slices found, skipping")
+            continue
+
+        pack_dir = os.path.join(args.save_dir, mode)
+        os.makedirs(pack_dir, exist_ok=True)
+        kinds = {}
+        # the workers only load the small slices, the packs are written sequentially by this process
+        with Pool(processes=n_procs) as pool:
+            for kind, file_paths in files.items():
+                print(f"{mode}: packing {len(file_paths)} {kind}")
+                arrays = pool.imap(np.load, file_paths, chunksize=256)
+                kinds[kind] = write_pack(file_paths, pack_dir, kind, args.pack_bytes, arrays=arrays)
+        print(f"Wrote {write_manifest(pack_dir, kinds, os.path.join(args.data_dir, mode))}")
+
+
+if __name__ == "__main__":
+    main()
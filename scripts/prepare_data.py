@@ -16,7 +16,7 @@ import webdataset as wds
 from scipy.ndimage import rotate
 from sklearn.model_selection import train_test_split
 
-from TissueLabeling.brain_utils import brain_coord, load_brains, mapping
+from TissueLabeling.brain_utils import extract_volume_slices, load_brains, mapping
 
 # import nobrainer
 
@@ -150,259 +150,124 @@ def main():
             #     brain = nobrainer.transform.warp(brain,affine,order=0)
             #     brain_mask = nobrainer.transform.warp(brain_mask,labels_affine,order=0)
 
-            # slice the MRI volume in 3 directions
-            for d in range(3):
-                for i in range(brain.shape[d]):
-                    # get the slice
-                    if d == 0:
-                        brain_slice = brain[i, :, :]
-                        mask_slice = brain_mask[i, :, :]
-                    elif d == 1:
-                        brain_slice = brain[:, i, :]
-                        mask_slice = brain_mask[:, i, :]
-                    elif d == 2:
-                        brain_slice = brain[:, :, i]
-                        mask_slice = brain_mask[:, :, i]
-
-                    # skip slices with no or little brain (20% cutoff)
-                    if np.sum(brain_slice) < 52428:
-                        continue
-
-                    # find the crop
-                    for j in range(256):
-                        if (brain_slice[j] != 0).any():
-                            cut_top_temp = j
-                            break
-                    for j in range(256):
-                        if (brain_slice[255 - j] != 0).any():
-                            cut_bottom_temp = 255 - j
-                            break
-                    for j in range(256):
-                        if (brain_slice[:, j] != 0).any():
-                            cut_left_temp = j
-                            break
-                    for j in range(256):
-                        if (brain_slice[:, 255 - j] != 0).any():
-                            cut_right_temp = 255 - j
-                            break
-                    if (
-                        cut_bottom_temp - cut_top_temp + 1 > height
-                        or cut_right_temp - cut_left_temp + 1 > width
-                    ):
-                        print("cut_top_temp: ", cut_top_temp)
-                        print("cut_bottom_temp: ", cut_bottom_temp)
-                        print("cut_left_temp: ", cut_left_temp)
-                        print("cut_right_temp: ", cut_right_temp)
-                        if d == 0:
-                            brain_slice_temp = brain[i, :, :]
-                        elif d == 1:
-                            brain_slice_temp = brain[:, i, :]
-                        elif d == 2:
-                            brain_slice_temp = brain[:, :, i]
-                        import matplotlib.pyplot as plt
-
-                        print("Sum: ", np.sum(brain_slice_temp))
-                        plt.imshow(brain_slice_temp, cmap="gray")
-                        plt.savefig("images/brain_slice.png")
-
-                    height_temp = cut_bottom_temp - cut_top_temp + 1
-                    width_temp = cut_right_temp - cut_left_temp + 1
-
-                    assert height_temp <= height, "Crop height is too big"
-                    assert width_temp <= width, "Crop width is too big"
-                    print("Patch height: ", height_temp)
-                    print("Patch width: ", width_temp)
-
-                    # crop image-optimal patch:
-                    brain_slice = brain_slice[
-                        cut_top_temp : cut_bottom_temp + 1,
-                        cut_left_temp : cut_right_temp + 1,
-                    ]
-                    mask_slice = mask_slice[
-                        cut_top_temp : cut_bottom_temp + 1,
-                        cut_left_temp : cut_right_temp + 1,
-                    ]
-
-                    if brain_slice.shape[0] < 50 or brain_slice.shape[1] < 50:
-                        too_small += 1
-                        continue
-
-                    assert (brain_slice > 0).any(), "Crop is empty"
-
-                    # adjust the crop to largest rectangle
-                    if height_temp < height:
-                        diff = height - height_temp
-                        # even difference
-                        if (diff % 2) == 0:
-                            # cut_bottom_temp += diff//2
-                            # cut_top_temp -= diff//2
-                            brain_slice = np.pad(
-                                brain_slice, ((diff // 2, diff // 2), (0, 0))
-                            )
-                            mask_slice = np.pad(
-                                mask_slice, ((diff // 2, diff // 2), (0, 0))
-                            )
-                        # odd difference
-                        else:
-                            # cut_bottom_temp += diff//2
-                            # cut_top_temp -= diff//2 + 1
-                            brain_slice = np.pad(
-                                brain_slice, ((diff // 2, diff // 2 + 1), (0, 0))
-                            )
-                            mask_slice = np.pad(
-                                mask_slice, ((diff // 2, diff // 2 + 1), (0, 0))
-                            )
-                    if width_temp < width:
-                        diff = width - width_temp
-                        # even difference
-                        if (diff % 2) == 0:
-                            # cut_right_temp += diff//2
-                            # cut_left_temp -= diff//2
-                            brain_slice = np.pad(
-                                brain_slice, ((0, 0), (diff // 2, diff // 2))
-                            )
-                            mask_slice = np.pad(
-                                mask_slice, ((0, 0), (diff // 2, diff // 2))
-                            )
-                        # odd difference
-                        else:
-                            # cut_right_temp += diff//2
-                            # cut_left_temp -= diff//2 + 1
-                            brain_slice = np.pad(
-                                brain_slice, ((0, 0), (diff // 2, diff // 2 + 1))
-                            )
-                            mask_slice = np.pad(
-                                mask_slice, ((0, 0), (diff // 2, diff // 2 + 1))
-                            )
-
-                    print(brain_slice.shape)
-                    print(brain_slice.shape[0] == height)
-                    assert brain_slice.shape[0] == height, "Crop height is not correct"
-                    assert brain_slice.shape[1] == width, "Crop width is not correct"
-
-                    if mode == "train":
-                        # mean and std per image
-                        image_mean, image_std = np.mean(brain_slice), np.std(
-                            brain_slice
-                        )
-                        dataset_mean += image_mean
-                        dataset_std += image_std
-
-                        # pixel distribution per image
-                        unique, counts = np.unique(mask_slice, return_counts=True)
-                        for i, j in zip(unique, counts):
-                            pixel_counts[i] += j
-
-                    # brain_slice = (brain_slice - image_mean) / image_std
-                    # standardize = torch.tensor([image_mean, image_std])
-
-                    # to torch tensor
-                    brain_slice = torch.from_numpy(brain_slice).to(torch.float32)
-                    mask_slice = torch.from_numpy(mask_slice).to(torch.float32)
-
-                    # get final brain location coordinates
-                    (
-                        cut_top_temp,
-                        cut_bottom_temp,
-                        cut_left_temp,
-                        cut_right_temp,
-                    ) = brain_coord(brain_slice)
-
-                    # sink.write({
-                    #     "__key__": str(idx), # key used to identify the object
-                    #     'image_nr.id': image_nr, # image number stored as id --> integer
-                    #     'slice_nr.id': i, # slice number stored as id --> integer
-                    #     'slice_direction.id': d, # slice direction stored as id --> integer
-                    #     'slice_augmentation_1.txt': 'None',
-                    #     'slice_augmentation_2.txt': 'None',
-                    #     'slice_augmentation_3.txt': 'None',
-                    #     'slice_rot.id': 0, # angle of rotation for augmentation
-                    #     'slice_null.txt': 'None',
-                    #     "brain.pth": brain_slice.unsqueeze(0), # brain slice stored as pth --> tensor
-                    #     "mask.pth": mask_slice.unsqueeze(0), # mask slice stored as pth --> tensor
-                    #     # "standardize.pth": standardize, # image-wise mean and std stored as pth --> tensor
-                    #     "batch_idx_bottom.id": cut_bottom_temp, # bottom index of the batch --> integer
-                    #     "batch_idx_top.id": cut_top_temp, # top index of the batch --> integer
-                    #     "batch_idx_left.id": cut_left_temp, # left index of the batch --> integer
-                    #     "batch_idx_right.id": cut_right_temp, # right index of the batch --> integer
-                    # })
-
-                    brain_filename = f"{save_path_mode}/brain_{idx}.npy"
-                    mask_filename = f"{save_path_mode}/mask_{idx}.npy"
-                    np.save(brain_filename, brain_slice.unsqueeze(0))
-                    np.save(mask_filename, mask_slice.unsqueeze(0))
-
-                    idx += 1
-                    # TODO: add augmentations
-                    # if mode == "train":
-                    #     # num_augmentations = random.randint(1,len(POSSIBLE_AUGMENTATIONS))
-                    #     # augmentations_to_apply = random.sample(POSSIBLE_AUGMENTATIONS,num_augmentations)
-                    #     # angle = 0
-                    #     # null_side = 'None'
-                    #     # for augmentation in augmentations_to_apply:
-                    #     #     if augmentation == 'rotate':
-                    #     #         angle = random.choice(AUG_ANGLES)
-                    #     #         brain_slice = torch.from_numpy(rotate(brain_slice,angle,reshape=False)).to(torch.float32)
-                    #     #         mask_slice = torch.from_numpy(rotate(mask_slice,angle,reshape=False,order=0)).to(torch.float32)
-                    #     #     elif augmentation == 'null':
-                    #     #         null_side = ['left','right','top','down']
-                    #     #         if null_side == 'left':
-                    #     #             mid = brain_slice.shape[0] // 2
-                    #     #             brain_slice[:mid,:] = 0
-                    #     #             mask_slice[:mid,:] = 0
-                    #     #         elif null_side == 'right':
-                    #     #             mid = brain_slice.shape[0] // 2
-                    #     #             brain_slice[mid:,:] = 0
-                    #     #             mask_slice[mid:,:] = 0
-                    #     #         elif null_side == 'top':
-                    #     #             mid = brain_slice.shape[1] // 2
-                    #     #             brain_slice[:,:mid] = 0
-                    #     #             mask_slice[:,:mid] = 0
-                    #     #         elif null_side == 'down':
-                    #     #             mid = brain_slice.shape[1] // 2
-                    #     #             brain_slice[:,mid:] = 0
-                    #     #             mask_slice[:,mid] = 0
-                    #     #         else:
-                    #     #             raise Exception(f'{null_side} is not a valid option for null_side')
-                    #     #     elif augmentation == 'zoom':
-                    #     #         pass
-
-                    #     # rotation augmentation
-                    #     augmentations_to_apply = ['rotation']
-                    #     null_side = 'None'
-                    #     angle = random.choice(AUG_ANGLES)
-                    #     rotated_brain = torch.from_numpy(rotate(brain_slice,angle,reshape=False)).to(torch.float32)
-                    #     rotated_slice = torch.from_numpy(rotate(mask_slice,angle,reshape=False,order=0)).to(torch.float32)
-
-                    #     # (cut_top_temp, cut_bottom_temp, cut_left_temp, cut_right_temp) = brain_coord(rotated_brain)
-                    #     while len(augmentations_to_apply) < 3:
-                    #         augmentations_to_apply.append('None')
-
-                    #     sink.write({
-                    #         "__key__": str(idx), # key used to identify the object
-                    #         'image_nr.id': image_nr, # image number stored as id --> integer
-                    #         'slice_nr.id': i, # slice number stored as id --> integer
-                    #         'slice_direction.id': d, # slice direction stored as id --> integer
-                    #         'slice_augmentation_1.txt': augmentations_to_apply[0], # 1st in list of augmentations --> string?
-                    #         'slice_augmentation_2.txt': augmentations_to_apply[1], # 2nd in list of augmentations --> string?
-                    #         'slice_augmentation_3.txt': augmentations_to_apply[2], # 3rd in list of augmentations --> string?
-                    #         'slice_rot.id': angle, # angle of rotation for augmentation --> integer
-                    #         'slice_null.txt': null_side, # which side of the image was null (or None if no null) --> string
-                    #         "brain.pth": rotated_brain.unsqueeze(0), # brain slice stored as pth --> tensor
-                    #         "mask.pth": rotated_slice.unsqueeze(0), # mask slice stored as pth --> tensor
-                    #         # "standardize.pth": standardize, # image-wise mean and std stored as pth --> tensor
-                    #         "batch_idx_bottom.id": cut_bottom_temp, # bottom index of the batch --> integer
-                    #         "batch_idx_top.id": cut_top_temp, # top index of the batch --> integer
-                    #         "batch_idx_left.id": cut_left_temp, # left index of the batch --> integer
-                    #         "batch_idx_right.id": cut_right_temp, # right index of the batch --> integer
-                    #     })
-
-                    #     brain_filename = f'{save_path_mode}/brain_{idx}.npy'
-                    #     mask_filename = f'{save_path_mode}/mask_{idx}.npy'
-                    #     np.save(brain_filename,rotated_brain.unsqueeze(0))
-                    #     np.save(mask_filename,rotated_slice.unsqueeze(0))
-
-                    #     idx += 1
+            # slice the MRI volume in 3 directions, skipping slices with no or little brain (20% cutoff)
+            # or a brain smaller than 50x50, and crop/pad them to the largest rectangle
+            extracted = extract_volume_slices(brain, brain_mask, height, width)
+            too_small += extracted["n_too_small"]
+
+            if mode == "train":
+                # mean and std per image
+                dataset_mean += np.sum(np.mean(extracted["images"], axis=(1, 2)))
+                dataset_std += np.sum(np.std(extracted["images"], axis=(1, 2)))
+
+                # pixel distribution per image
+                unique, counts = np.unique(extracted["masks"], return_counts=True)
+                for i, j in zip(unique, counts):
+                    pixel_counts[i] += j
+
+            for brain_slice, mask_slice in zip(extracted["images"], extracted["masks"]):
+                # brain_slice = (brain_slice - image_mean) / image_std
+                # standardize = torch.tensor([image_mean, image_std])
+
+                # to torch tensor
+                brain_slice = torch.from_numpy(brain_slice).to(torch.float32)
+                mask_slice = torch.from_numpy(mask_slice).to(torch.float32)
+
+                # sink.write({
+                #     "__key__": str(idx), # key used to identify the object
+                #     'image_nr.id': image_nr, # image number stored as id --> integer
+                #     'slice_nr.id': i, # slice number stored as id --> integer
+                #     'slice_direction.id': d, # slice direction stored as id --> integer
+                #     'slice_augmentation_1.txt': 'None',
+                #     'slice_augmentation_2.txt': 'None',
+                #     'slice_augmentation_3.txt': 'None',
+                #     'slice_rot.id': 0, # angle of rotation for augmentation
+                #     'slice_null.txt': 'None',
+                #     "brain.pth": brain_slice.unsqueeze(0), # brain slice stored as pth --> tensor
+                #     "mask.pth": mask_slice.unsqueeze(0), # mask slice stored as pth --> tensor
+                #     # "standardize.pth": standardize, # image-wise mean and std stored as pth --> tensor
+                #     "batch_idx_bottom.id": cut_bottom_temp, # bottom index of the batch --> integer
+                #     "batch_idx_top.id": cut_top_temp, # top index of the batch --> integer
+                #     "batch_idx_left.id": cut_left_temp, # left index of the batch --> integer
+                #     "batch_idx_right.id": cut_right_temp, # right index of the batch --> integer
+                # })
+
+                brain_filename = f"{save_path_mode}/brain_{idx}.npy"
+                mask_filename = f"{save_path_mode}/mask_{idx}.npy"
+                np.save(brain_filename, brain_slice.unsqueeze(0))
+                np.save(mask_filename, mask_slice.unsqueeze(0))
+
+                idx += 1
+                # TODO: add augmentations
+                # if mode == "train":
+                #     # num_augmentations = random.randint(1,len(POSSIBLE_AUGMENTATIONS))
+                #     # augmentations_to_apply = random.sample(POSSIBLE_AUGMENTATIONS,num_augmentations)
+                #     # angle = 0
+                #     # null_side = 'None'
+                #     # for augmentation in augmentations_to_apply:
+                #     #     if augmentation == 'rotate':
+                #     #         angle = random.choice(AUG_ANGLES)
+                #     #         brain_slice = torch.from_numpy(rotate(brain_slice,angle,reshape=False)).to(torch.float32)
+                #     #         mask_slice = torch.from_numpy(rotate(mask_slice,angle,reshape=False,order=0)).to(torch.float32)
+                #     #     elif augmentation == 'null':
+                #     #         null_side = ['left','right','top','down']
+                #     #         if null_side == 'left':
+                #     #             mid = brain_slice.shape[0] // 2
+                #     #             brain_slice[:mid,:] = 0
+                #     #             mask_slice[:mid,:] = 0
+                #     #         elif null_side == 'right':
+                #     #             mid = brain_slice.shape[0] // 2
+                #     #             brain_slice[mid:,:] = 0
+                #     #             mask_slice[mid:,:] = 0
+                #     #         elif null_side == 'top':
+                #     #             mid = brain_slice.shape[1] // 2
+                #     #             brain_slice[:,:mid] = 0
+                #     #             mask_slice[:,:mid] = 0
+                #     #         elif null_side == 'down':
+                #     #             mid = brain_slice.shape[1] // 2
+                #     #             brain_slice[:,mid:] = 0
+                #     #             mask_slice[:,mid] = 0
+                #     #         else:
+                #     #             raise Exception(f'{null_side} is not a valid option for null_side')
+                #     #     elif augmentation == 'zoom':
+                #     #         pass
+
+                #     # rotation augmentation
+                #     augmentations_to_apply = ['rotation']
+                #     null_side = 'None'
+                #     angle = random.choice(AUG_ANGLES)
+                #     rotated_brain = torch.from_numpy(rotate(brain_slice,angle,reshape=False)).to(torch.float32)
+                #     rotated_slice = torch.from_numpy(rotate(mask_slice,angle,reshape=False,order=0)).to(torch.float32)
+
+                #     # (cut_top_temp, cut_bottom_temp, cut_left_temp, cut_right_temp) = brain_coord(rotated_brain)
+                #     while len(augmentations_to_apply) < 3:
+                #         augmentations_to_apply.append('None')
+
+                #     sink.write({
+                #         "__key__": str(idx), # key used to identify the object
+                #         'image_nr.id': image_nr, # image number stored as id --> integer
+                #         'slice_nr.id': i, # slice number stored as id --> integer
+                #         'slice_direction.id': d, # slice direction stored as id --> integer
+                #         'slice_augmentation_1.txt': augmentations_to_apply[0], # 1st in list of augmentations --> string?
+                #         'slice_augmentation_2.txt': augmentations_to_apply[1], # 2nd in list of augmentations --> string?
+                #         'slice_augmentation_3.txt': augmentations_to_apply[2], # 3rd in list of augmentations --> string?
+                #         'slice_rot.id': angle, # angle of rotation for augmentation --> integer
+                #         'slice_null.txt': null_side, # which side of the image was null (or None if no null) --> string
+                #         "brain.pth": rotated_brain.unsqueeze(0), # brain slice stored as pth --> tensor
+                #         "mask.pth": rotated_slice.unsqueeze(0), # mask slice stored as pth --> tensor
+                #         # "standardize.pth": standardize, # image-wise mean and std stored as pth --> tensor
+                #         "batch_idx_bottom.id": cut_bottom_temp, # bottom index of the batch --> integer
+                #         "batch_idx_top.id": cut_top_temp, # top index of the batch --> integer
+                #         "batch_idx_left.id": cut_left_temp, # left index of the batch --> integer
+                #         "batch_idx_right.id": cut_right_temp, # right index of the batch --> integer
+                #     })
+
+                #     brain_filename = f'{save_path_mode}/brain_{idx}.npy'
+                #     mask_filename = f'{save_path_mode}/mask_{idx}.npy'
+                #     np.save(brain_filename,rotated_brain.unsqueeze(0))
+                #     np.save(mask_filename,rotated_slice.unsqueeze(0))
+
+                #     idx += 1
 
         if mode == "train":
             dataset_mean /= idx
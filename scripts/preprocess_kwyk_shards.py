@@ -0,0 +1,141 @@
+"""
+File: preprocess_kwyk_shards.py
+Author: Sabeen Lohawala
+Date: 2024-05-26
+Description: This script is used to write pre-processed copies of the KWYK HDF5 shards for one class scheme:
+features are skull stripped and labels are mapped to nr_of_classes and stored as uint8, so that
+PreprocessedHDF5Dataset can read them without any per-sample skull stripping or label mapping.
+"""
+
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+
+import h5py as h5
+import numpy as np
+
+from TissueLabeling.data.hdf5_io import CODECS, get_compression_kwargs, get_shard_dataset
+from TissueLabeling.data.label_mapping import get_label_mapper
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.utils import main_timer
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "h5_dir",
+    help="Where the hdf5 chunks are saved",
+    type=str,
+)
+parser.add_argument(
+    "save_dir",
+    help="Where the pre-processed hdf5 chunks will be written",
+    type=str,
+)
+parser.add_argument(
+    "--nr_of_classes",
+    help="Class scheme the labels are mapped to (2, 6, 16, 50, or 106)",
+    type=int,
+    required=False,
+    default=50,
+)
+parser.add_argument(
+    "--class_mapping",
+    help="Path to class_mapping.csv used to map the freesurfer labels",
+    type=str,
+    required=False,
+    default="/om2/user/sabeen/nobrainer_data_norm/class_mapping.csv",
+)
+parser.add_argument(
+    "--codec",
+    help=f"Compression codec for the pre-processed shards, one of {CODECS}",
+    type=str,
+    required=False,
+    default="gzip",
+)
+parser.add_argument(
+    "--level",
+    help="Compression level of the codec",
+    type=int,
+    required=False,
+    default=2,
+)
+args = parser.parse_args()
+
+H5_DIR = args.h5_dir
+SAVE_DIR = args.save_dir
+
+gettrace = getattr(sys, "gettrace", None)
+DEBUG = True if gettrace() else False
+
+
+def preprocess_shard(shard_idx, h5_path, lut):
+    """
+    Writes the pre-processed copy of a shard with the same layout and chunking. Each volume is read
+    once and written to all datasets of the shard.
+
+    Args:
+        shard_idx (int): which shard index
+        h5_path (str): path to the shard
+        lut (np.array): the uint8 lookup table from the freesurfer labels to nr_of_classes
+
+    Returns:
+        str: the path of the pre-processed shard
+    """
+    save_path = os.path.join(SAVE_DIR, os.path.basename(h5_path))
+    compression_kwargs = get_compression_kwargs(args.codec, args.level)
+    with h5.File(h5_path, "r") as f, h5.File(save_path, "w") as f_out:
+        src_features, src_labels = get_shard_dataset(f, "features"), get_shard_dataset(f, "labels")
+        feature_ds, label_ds = [], []
+        for name, dataset in f.items():
+            if not name.startswith(("features", "labels")):
+                continue # e.g. the slice_stats group written by scripts/ingest_kwyk.py
+            kind = "features" if name.startswith("features") else "labels"
+            out = f_out.create_dataset(
+                name,
+                shape=dataset.shape,
+                dtype=np.uint8,
+                chunks=dataset.chunks,
+                **compression_kwargs,
+            )
+            (feature_ds if kind == "features" else label_ds).append(out)
+
+        for shard_vol_idx in range(src_features.shape[0]):
+            print(f"Processing shard {shard_idx} volume {shard_vol_idx}")
+            label = src_labels[shard_vol_idx]
+            feature = src_features[shard_vol_idx]
+            feature[label == 0] = 0 # skull stripping
+            label = lut[label]
+            for dataset in feature_ds:
+                dataset[shard_vol_idx] = feature
+            for dataset in label_ds:
+                dataset[shard_vol_idx] = label
+    return save_path
+
+
+@main_timer
+def main():
+    manifest = ShardManifest.load(H5_DIR)
+    h5_file_paths = manifest.shard_paths
+
+    if not os.path.exists(SAVE_DIR):
+        os.makedirs(SAVE_DIR)
+
+    lut = get_label_mapper("original", args.class_mapping).class_lut(args.nr_of_classes)
+
+    n_procs = 1 if DEBUG else min(len(h5_file_paths), len(os.sched_getaffinity(0)))
+    print(f"N PROC {n_procs}")
+    with Pool(processes=n_procs) as pool:
+        save_paths = pool.starmap(
+            preprocess_shard,
+            [(shard_idx, h5_path, lut) for shard_idx, h5_path in enumerate(h5_file_paths)],
+        )
+
+    # record the class scheme so the dataset can check it matches the run
+    out_manifest = ShardManifest.from_shards(save_paths, codec=args.codec, level=args.level)
+    for shard in out_manifest.shards:
+        shard["nr_of_classes"] = args.nr_of_classes
+    print(f"Wrote manifest {out_manifest.write()}")
+
+
+if __name__ == "__main__":
+    main()
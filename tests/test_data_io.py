@@ -0,0 +1,84 @@
+"""
+File: test_data_io.py
+Author: Sabeen Lohawala
+Date: 2024-06-05
+Description: Tests of the slice readers on tiny in-memory volumes: the batched HDF5 read, the batched
+crop/pad of the slice extraction, and the packed slice files of NoBrainerDataset.
+"""
+
+import h5py as h5
+import numpy as np
+import pytest
+
+from TissueLabeling.brain_utils import crop, crop_pad_slices
+from TissueLabeling.data.hdf5_io import read_slice_roi, read_slices
+from TissueLabeling.data.packed_slices import PackedSlices, write_manifest, write_pack
+
+
+@pytest.fixture
+def volumes():
+    return np.random.default_rng(0).integers(0, 255, size=(3, 8, 9, 10), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("chunks", [None, (1, 4, 4, 4)])
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_read_slices_matches_single_reads(tmp_path, volumes, axis, chunks):
+    with h5.File(tmp_path / "shard.h5", "w") as f:
+        dataset = f.create_dataset("features", data=volumes, chunks=chunks)
+        vol_indices = [2, 0, 2, 1, 0]
+        slice_indices = [3, 5, 3, 0, 1] # unsorted, with a duplicate
+        slices = read_slices(dataset, vol_indices, slice_indices, axis)
+        for slice_, vol_idx, slice_idx in zip(slices, vol_indices, slice_indices):
+            np.testing.assert_array_equal(slice_, np.take(volumes[vol_idx], slice_idx, axis=axis))
+
+
+def test_read_slice_roi_zeroes_outside_the_bbox(tmp_path, volumes):
+    with h5.File(tmp_path / "shard.h5", "w") as f:
+        dataset = f.create_dataset("features", data=volumes)
+        roi = read_slice_roi(dataset, 1, 0, 4, (2, 5, 3, 6), margin=1)
+    expected = np.zeros_like(volumes[1, 4])
+    expected[1:7, 2:8] = volumes[1, 4, 1:7, 2:8]
+    np.testing.assert_array_equal(roi, expected)
+
+
+def test_crop_pad_slices_matches_crop():
+    rng = np.random.default_rng(1)
+    slices = np.zeros((6, 20, 24), dtype=np.uint8)
+    bboxes = []
+    for i in range(6):
+        row_min, col_min = rng.integers(0, 8), rng.integers(0, 10)
+        row_max, col_max = row_min + rng.integers(0, 9), col_min + rng.integers(0, 11)
+        slices[i, row_min : row_max + 1, col_min : col_max + 1] = rng.integers(1, 255, size=(row_max - row_min + 1, col_max - col_min + 1))
+        bboxes.append((row_min, row_max, col_min, col_max))
+    cropped = crop_pad_slices(slices, np.array(bboxes), 12, 15)
+    assert cropped.shape == (6, 12, 15)
+    for i in range(6):
+        np.testing.assert_array_equal(cropped[i], crop(slices[i], 12, 15))
+
+
+def test_crop_pad_slices_rejects_large_bboxes():
+    with pytest.raises(AssertionError):
+        crop_pad_slices(np.ones((1, 10, 10)), np.array([[0, 9, 0, 9]]), 8, 8)
+
+
+def test_packed_slices_round_trip(tmp_path):
+    rng = np.random.default_rng(2)
+    arrays = [rng.integers(0, 255, size=(1, 4 + i, 5), dtype=np.uint8) for i in range(7)]
+    file_paths = []
+    for i, array in enumerate(arrays):
+        file_paths.append(str(tmp_path / f"brain_{i}.npy"))
+        np.save(file_paths[-1], array)
+    pack_dir = tmp_path / "packed"
+    pack_dir.mkdir()
+    # small packs so the slices are spread over several files
+    kinds = {kind: write_pack(file_paths, str(pack_dir), kind, pack_bytes=64) for kind in ["images", "masks"]}
+    write_manifest(str(pack_dir), kinds, str(tmp_path))
+    assert len(kinds["images"]["packs"]) > 1
+
+    packed = PackedSlices(str(pack_dir), "images")
+    assert len(packed) == len(arrays)
+    for array, slice_ in zip(arrays, (packed[i] for i in range(len(packed)))):
+        np.testing.assert_array_equal(slice_, array)
+    subset = packed[2:5]
+    assert len(subset) == 3
+    np.testing.assert_array_equal(subset[1], arrays[3])
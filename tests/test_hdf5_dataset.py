@@ -0,0 +1,125 @@
+"""
+File: test_hdf5_dataset.py
+Author: Sabeen Lohawala
+Date: 2024-06-06
+Description: End-to-end test of the HDF5 read path: HDF5Dataset is built from two tiny axis-layout shards with
+a manifest and a slice statistics file, and its slices are checked against the slices read directly with h5py.
+"""
+
+import argparse
+import os
+
+import h5py as h5
+import numpy as np
+import pytest
+
+import TissueLabeling.data.dataset as dataset_module
+from TissueLabeling.config import Configuration
+from TissueLabeling.data.dataset import HDF5Dataset
+from TissueLabeling.data.hdf5_io import ShardHandles
+from TissueLabeling.data.label_mapping import LabelMapper
+from TissueLabeling.data.manifest import ShardManifest
+from TissueLabeling.data.slice_index import unpack_slice_rows
+from TissueLabeling.data.slice_stats import STATS, compute_volume_stats
+
+CLASS_MAPPING_FILE = os.path.join(os.path.dirname(__file__), "..", "misc", "class_mapping.csv")
+SHARD_N_VOLS = [5, 6] # the split needs a few volumes, the last one is always left out
+SIZE = 16
+LABELS = [0, 2, 17, 41, 53] # freesurfer labels of class_mapping.csv
+
+
+def write_shard(path, feature_vols, label_vols):
+    with h5.File(path, "w") as f:
+        for axis in range(3):
+            chunks = [1, SIZE, SIZE, SIZE]
+            chunks[axis + 1] = 1
+            f.create_dataset(f"features_axis{axis}", data=feature_vols, chunks=tuple(chunks), compression="gzip")
+            f.create_dataset(f"labels_axis{axis}", data=label_vols, chunks=tuple(chunks), compression="gzip")
+
+
+@pytest.fixture
+def h5_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    h5_dir = tmp_path / "shards"
+    h5_dir.mkdir()
+    stats = {name: [] for name in STATS}
+    shard_paths = []
+    for shard_idx, n_vols in enumerate(SHARD_N_VOLS):
+        feature_vols = rng.integers(1, 255, size=(n_vols, SIZE, SIZE, SIZE), dtype=np.uint8)
+        # a box of tissue in the middle of each volume, background elsewhere
+        label_vols = np.zeros((n_vols, SIZE, SIZE, SIZE), dtype=np.uint16)
+        label_vols[:, 3:13, 4:12, 2:14] = rng.choice(LABELS, size=(n_vols, 10, 8, 12))
+        shard_paths.append(str(h5_dir / f"kwyk_{shard_idx}.h5"))
+        write_shard(shard_paths[-1], feature_vols, label_vols)
+        for feature_vol, label_vol in zip(feature_vols, label_vols):
+            for name, value in compute_volume_stats(feature_vol, label_vol).items():
+                stats[name].append(value)
+    ShardManifest.from_shards(shard_paths).write()
+    stats = {name: np.stack(values) for name, values in stats.items()}
+    stats["bg_count"][:, :, SIZE:] = 256 * 256 # the stats have room for 256 slices, the missing ones are background
+    np.savez(tmp_path / "slice_stats.npz", **stats)
+    return h5_dir
+
+
+def get_config(tmp_path, h5_dir, **kwargs):
+    args = argparse.Namespace(
+        logdir=str(tmp_path / "logs"),
+        wandb_description=None,
+        new_kwyk_data=1,
+        nr_of_classes=50,
+        data_size="all",
+        h5_dir=str(h5_dir),
+        slice_index_dir=str(tmp_path / "slice_index"),
+        slice_stats_file=str(tmp_path / "slice_stats.npz"),
+        compact_samples=1,
+        **kwargs,
+    )
+    return Configuration(args)
+
+
+def read_expected(h5_dir, dataset, index):
+    shard_idx, shard_vol_idx, axis, slice_idx = unpack_slice_rows(dataset.filtered_matrix[index], dataset.manifest)[0]
+    indices = [shard_vol_idx, slice(None), slice(None)]
+    indices.insert(axis + 1, slice_idx)
+    with h5.File(os.path.join(h5_dir, f"kwyk_{shard_idx}.h5"), "r") as f:
+        feature_slice = f[f"features_axis{axis}"][tuple(indices)]
+        label_slice = f[f"labels_axis{axis}"][tuple(indices)]
+    feature_slice = np.where(label_slice == 0, 0, feature_slice) # skull stripping
+    return feature_slice, dataset.label_mapper.map(label_slice, dataset.nr_of_classes)
+
+
+@pytest.fixture(autouse=True)
+def label_mapper(monkeypatch):
+    # the default class_mapping.csv is on the cluster, the repo has a copy
+    monkeypatch.setattr(dataset_module, "get_label_mapper", lambda reference_col: LabelMapper(reference_col, CLASS_MAPPING_FILE))
+
+
+def test_shard_handles(h5_dir):
+    manifest = ShardManifest.load(str(h5_dir))
+    handles = ShardHandles(manifest.shard_paths, rdcc_nbytes=1024**2, rdcc_nslots=521, rdcc_w0=0.75)
+    for shard_idx, n_vols in enumerate(SHARD_N_VOLS):
+        assert handles[shard_idx]["features_axis0"].shape == (n_vols, SIZE, SIZE, SIZE)
+        assert handles[shard_idx] is handles[shard_idx]
+    handles.close()
+
+
+@pytest.mark.parametrize("roi_reads", [0, 1])
+def test_hdf5_dataset_matches_h5py(tmp_path, h5_dir, roi_reads):
+    config = get_config(tmp_path, h5_dir, roi_reads=roi_reads)
+    dataset = HDF5Dataset("train", config)
+    assert len(dataset) > 0
+    vols = np.unique(np.asarray(dataset.filtered_matrix) >> 10)
+    assert (vols < SHARD_N_VOLS[0]).any() and (vols >= SHARD_N_VOLS[0]).any() # the split spans both shards
+
+    feature_slice, label_slice = dataset[0]
+    expected_features, expected_labels = read_expected(h5_dir, dataset, 0)
+    np.testing.assert_array_equal(feature_slice[0].numpy(), expected_features)
+    np.testing.assert_array_equal(label_slice[0].numpy(), expected_labels)
+
+    # a batch with slices of both shards, unsorted and with a duplicate
+    indices = [len(dataset) - 1, 0, len(dataset) // 2, 7, 0, len(dataset) // 3]
+    for index, (feature_slice, label_slice) in zip(indices, dataset.__getitems__(indices)):
+        expected_features, expected_labels = read_expected(h5_dir, dataset, index)
+        np.testing.assert_array_equal(feature_slice[0].numpy(), expected_features)
+        np.testing.assert_array_equal(label_slice[0].numpy(), expected_labels)
+    dataset.close()
@@ -0,0 +1,133 @@
+"""
+File: test_samplers.py
+Author: Sabeen Lohawala
+Date: 2024-06-05
+Description: Tests of the samplers on a tiny packed slice index: the split across DDP ranks and DataLoader
+workers, the rotation across epochs, and the block-level shuffle.
+"""
+
+import numpy as np
+import pytest
+
+from TissueLabeling.data.samplers import BlockShuffleSampler, ClassBalancedSampler, ShardAffineSampler, get_blocks
+
+N_VOLUMES, N_AXES, N_SLICES = 12, 3, 5
+
+
+@pytest.fixture
+def slice_index():
+    vols, axes, slices = np.meshgrid(np.arange(N_VOLUMES), np.arange(N_AXES), np.arange(N_SLICES), indexing="ij")
+    return ((vols << 10) | (axes << 8) | slices).ravel().astype(np.uint32)
+
+
+def get_rank_indices(sampler_cls, num_replicas, epoch=0, **kwargs):
+    rank_indices = []
+    for rank in range(num_replicas):
+        sampler = sampler_cls(num_replicas=num_replicas, rank=rank, **kwargs)
+        sampler.set_epoch(epoch)
+        rank_indices.append(list(sampler))
+        assert len(rank_indices[-1]) == len(sampler)
+    return rank_indices
+
+
+def test_get_blocks(slice_index):
+    shuffled = np.random.default_rng(0).permutation(len(slice_index))
+    order, block_starts, block_ends = get_blocks(slice_index[shuffled])
+    assert len(block_starts) == N_VOLUMES * N_AXES
+    assert np.all(block_ends - block_starts == N_SLICES)
+    keys = slice_index[shuffled][order] >> 8
+    for start, end in zip(block_starts, block_ends):
+        assert len(set(keys[start:end].tolist())) == 1
+
+
+@pytest.mark.parametrize("num_replicas", [1, 3, 4])
+def test_block_shuffle_sampler_splits_ranks(slice_index, num_replicas):
+    rank_indices = get_rank_indices(BlockShuffleSampler, num_replicas, slice_index=slice_index, buffer_size=8)
+    assert len({len(indices) for indices in rank_indices}) == 1
+    for indices in rank_indices:
+        assert len(set(indices)) == len(indices)
+    all_indices = [index for indices in rank_indices for index in indices]
+    assert len(set(all_indices)) == len(all_indices) == len(slice_index)
+
+
+def test_block_shuffle_sampler_keeps_blocks_without_buffer(slice_index):
+    indices = list(BlockShuffleSampler(slice_index, buffer_size=1, num_replicas=1, rank=0))
+    keys = slice_index[indices] >> 8
+    # without a shuffle buffer each block is read in one run, in slice order
+    assert np.count_nonzero(keys[1:] != keys[:-1]) == N_VOLUMES * N_AXES - 1
+    assert sorted(indices) == list(range(len(slice_index)))
+
+
+def test_block_shuffle_sampler_depends_on_epoch(slice_index):
+    sampler = BlockShuffleSampler(slice_index, num_replicas=1, rank=0)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+@pytest.mark.parametrize("num_replicas", [1, 3, 4])
+def test_shard_affine_sampler_splits_ranks(slice_index, num_replicas):
+    rank_indices = get_rank_indices(
+        ShardAffineSampler, num_replicas, slice_index=slice_index, batch_size=4, num_workers=2, buffer_size=8
+    )
+    assert len({len(indices) for indices in rank_indices}) == 1
+    all_indices = [index for indices in rank_indices for index in indices]
+    assert len(set(all_indices)) == len(all_indices) == len(slice_index)
+    for indices in rank_indices:
+        # each rank reads a contiguous run of the volume order
+        assert sorted(indices) == list(range(min(indices), max(indices) + 1))
+
+
+def test_shard_affine_sampler_rotates_across_epochs(slice_index):
+    num_replicas = 3
+    epochs = [
+        get_rank_indices(ShardAffineSampler, num_replicas, epoch, slice_index=slice_index, batch_size=4)
+        for epoch in range(num_replicas)
+    ]
+    for epoch in range(1, num_replicas):
+        for rank in range(num_replicas):
+            # each epoch a rank gets the run of the next rank in the previous epoch
+            next_rank = (rank + 1) % num_replicas
+            assert set(epochs[epoch][rank]) == set(epochs[epoch - 1][next_rank])
+    # over num_replicas epochs every rank visits all of the data
+    for rank in range(num_replicas):
+        assert set().union(*(epochs[epoch][rank] for epoch in range(num_replicas))) == set(range(len(slice_index)))
+
+
+@pytest.mark.parametrize("batch_size,num_workers", [(4, 3), (7, 2), (5, 1)])
+def test_shard_affine_sampler_batches_follow_workers(slice_index, batch_size, num_workers):
+    sampler = ShardAffineSampler(slice_index, batch_size, num_workers=num_workers, buffer_size=8, num_replicas=2, rank=1)
+    indices = list(sampler)
+    batches = [indices[start : start + batch_size] for start in range(0, len(indices), batch_size)]
+
+    # the DataLoader sends batch b to worker b % num_workers, which must only read from its own run
+    worker_indices = [
+        [index for batch in batches[worker::num_workers] for index in batch] for worker in range(num_workers)
+    ]
+    for worker, run in enumerate(worker_indices):
+        assert sorted(run) == list(range(min(run), max(run) + 1))
+        for other in worker_indices[worker + 1 :]:
+            assert not set(run) & set(other)
+    assert sorted(indices) == list(range(len(slice_index) // 2, len(slice_index)))
+
+
+def test_class_balanced_sampler(slice_index):
+    weights = np.ones(len(slice_index))
+    weights[:10] = 0
+    num_replicas = 3
+    rank_indices = get_rank_indices(ClassBalancedSampler, num_replicas, weights=weights, num_samples=100)
+    assert all(len(indices) == 34 for indices in rank_indices)
+    all_indices = np.concatenate(rank_indices)
+    assert np.all(all_indices >= 10)
+    # the ranks keep interleaved shares of the same draws
+    sampler = ClassBalancedSampler(weights, num_samples=100, num_replicas=1, rank=0)
+    single = ClassBalancedSampler(weights, num_samples=102, num_replicas=1, rank=0)
+    draws = np.array(list(single))
+    for rank, indices in enumerate(rank_indices):
+        assert indices == draws[rank::num_replicas].tolist()
+
+    assert list(sampler) == list(sampler)
+    first = list(sampler)
+    sampler.set_epoch(1)
+    assert list(sampler) != first